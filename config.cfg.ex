@@ -17,19 +17,55 @@ plugin_blacklist =
 # The word following the character below is interpreted as a command and passed
 # on to the plugins.
 signal_character = +
-# P1tr processes IRC events and requests in a loop. As soon as all pending
-# items are processed, the process is sent to sleep for an amount of time, which
-# can be specified here. This is a polling strategy that conserves CPU time.
-sleeptime = 0.2
+# Outgoing messages are paced to avoid being disconnected for flooding: up to
+# flood_burst messages are sent at once, after that flood_rate messages per
+# second. Command responses are sent before other traffic, such as memos.
+# Setting flood_rate to 0 disables pacing. Both settings may be overridden in
+# a server section.
+flood_rate = 0.5
+flood_burst = 5
+# If set to a number of seconds, the bot checks for modified plugin source files
+# in this interval and reloads those plugins without reconnecting. Plugins may
+# also be reloaded by the master using the reload command.
+plugin_watch_interval = 0
+# Plugins are only loaded when one of their commands or events is used for the
+# first time. This requires a description of the plugins, which is cached in
+# $home/data/plugins.manifest after they were loaded once. Set to no in order to
+# load all plugins on startup.
+lazy_plugins = yes
+# Plugins keep their data in $home/data. The default storage backend, sqlite,
+# writes only changed entries, to SQLite databases in write-ahead logging mode.
+# Data stored by the shelve backend, which P1tr used before, is imported
+# automatically. Set to shelve in order to keep using it.
+storage_backend = sqlite
+# Each storage keeps up to storage_cache_size values in memory. The least
+# recently used ones are written back and evicted when more are read.
+storage_cache_size = 10000
+# Every checkpoint_interval seconds, the changes of the plugins' storages are
+# written to disk, so that no more than that is lost if the bot crashes. With
+# the sqlite backend, this happens in the background. Set to 0 in order to
+# write the storages on exit only.
+checkpoint_interval = 60
+# The time spent in each plugin's hooks and commands is recorded, unless metrics
+# is set to no. This costs about a microsecond per plugin and event. Set
+# metrics_port to serve these figures in the Prometheus text format at
+# http://metrics_host:metrics_port/metrics. Both settings may be overridden in
+# a server section, e.g. to give each server its own port when running with
+# --shard.
+metrics = yes
+metrics_host = 127.0.0.1
+metrics_port = 0
 
 # This is a sample configuration, demonstrating the available options.
 ;[SampleServer]
 # The bot's nick name on this server.
 ;nick = P1tr-test
 # If the nick name specified above is registered with NickServ, you may provide
-# the password below so that the bot can identify himself. If the nick name is
-# not registered, or NickServ is not available at the server, the value of the
-# property will have no effect.
+# the password below so that the bot can identify himself. Where the server
+# supports SASL, the bot logs in while connecting, before joining any channels;
+# otherwise, it identifies with NickServ right after connecting. If the nick
+# name is not registered, or NickServ is not available at the server, the value
+# of the property will have no effect.
 ;nick_password =
 # The user with this nickname may give the bot admin commands.
 ;master = NickOfBotMaster
@@ -42,6 +78,11 @@ sleeptime = 0.2
 # The global plugin blacklist may be extended on a server-wide basis. Channel
 # settings can only extend the combined global/server plugin blacklist.
 ;plugin_blacklist =
+# If set, every line received from this server is appended to the given file,
+# relative to $home, with a timestamp. Such a capture can be fed through all
+# plugins with "p1tr.py --replay FILE" in order to benchmark them on real
+# traffic.
+;record_traffic = data/capture.gz
 # Each channel the bot is supposed to join has its own section which is named
 # according to the pattern "ServerName|channelName". In this case, ServerName
 # is "SampleServer" - this part must equal the name of the section which holds
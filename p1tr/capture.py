@@ -0,0 +1,230 @@
+"""
+Recording and replaying the traffic a bot receives.
+
+A connection with a TrafficRecorder writes every line it receives from the
+server to a gzip-compressed capture file, prefixed by the time in seconds
+since the recording started. run_replay feeds a capture through a bot with
+all plugins, as fast as possible, and reports how long that took. This makes
+it possible to benchmark changes against real traffic. Given a transcript
+path, run_replay also checks that the changes did not alter the behaviour:
+the lines the bot sent are written to the transcript if it does not exist
+yet, and compared to it otherwise.
+
+Capture files start with a header line, "P1TRCAP 1 HOST PORT NICK", followed
+by one "SECONDS LINE" record per received line.
+"""
+
+import difflib
+import gzip
+import os.path
+import shutil
+import tempfile
+from time import monotonic, perf_counter
+try:
+    import resource
+except ImportError: # Not available on all platforms.
+    resource = None
+from oyoyo.cmdhandler import CommandError
+from oyoyo.parse import parse_raw_irc_command
+from p1tr.connection import split_tags
+from p1tr.event import NO_TAGS
+from p1tr.helpers import BotError
+from p1tr.logwrap import *
+
+"""Format version written to and expected in the capture header."""
+CAPTURE_VERSION = b'1'
+
+"""Seconds between two flushes of the capture file."""
+FLUSH_INTERVAL = 5
+
+
+class TrafficRecorder:
+    """Writes the lines received by a connection to a capture file."""
+
+    def __init__(self, path, host, port, nick):
+        self.path = path
+        self._file = gzip.open(path, 'ab')
+        self._started = monotonic()
+        self._flushed = self._started
+        self._file.write(b' '.join((b'P1TRCAP', CAPTURE_VERSION,
+            host.encode(), str(port).encode(), nick.encode())) + b'\n')
+        info('Recording received traffic to %s.' % path, server=host)
+
+    def record(self, line):
+        """Appends a raw line, without its line terminator."""
+        now = monotonic()
+        self._file.write(('%.6f ' % (now - self._started)).encode() + line +
+                b'\n')
+        if now - self._flushed > FLUSH_INTERVAL:
+            self._file.flush()
+            self._flushed = now
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def read_capture(path):
+    """
+    Reads a capture file. Returns a tuple of the header, as a (host, port,
+    nick) tuple, and a list of (seconds, line) tuples. Raises BotError if the
+    file is not a capture.
+    """
+    records = []
+    header = None
+    offset = 0 # Recording sessions appended to the file follow each other.
+    try:
+        with gzip.open(path, 'rb') as capture:
+            for raw in capture:
+                raw = raw.rstrip(b'\n')
+                if raw.startswith(b'P1TRCAP '):
+                    fields = raw.decode('utf-8', 'replace').split(' ')
+                    if fields[1] != CAPTURE_VERSION.decode() or \
+                            len(fields) < 5:
+                        raise BotError('Unsupported capture format: %s' % raw)
+                    header = header or (fields[2], int(fields[3]), fields[4])
+                    offset = records[-1][0] if records else 0
+                    continue
+                seconds, _, line = raw.partition(b' ')
+                records.append((offset + float(seconds), line))
+    except (OSError, ValueError) as e:
+        raise BotError('Unable to read capture %s: %s' % (path, e))
+    if not header:
+        raise BotError('%s is not a traffic capture.' % path)
+    return header, records
+
+
+class ReplayClient:
+    """
+    Stands in for the connection during a replay; records the lines sent,
+    except for the parameters of those containing credentials.
+    """
+
+    def __init__(self, cmd_handler, host, port, nick):
+        self.host = host
+        self.port = port
+        self.nick = nick
+        self.real_name = nick
+        self.loop = None
+        self.lines = []
+        self.caps = set() # Taken from the CAP ACK lines of the capture
+        self.command_handler = cmd_handler(self)
+
+    def send(self, *args, **kwargs):
+        encoding = kwargs.get('encoding') or 'utf8'
+        bargs = [arg if isinstance(arg, bytes) else arg.encode(encoding)
+                for arg in args]
+        if kwargs.get('quiet'):
+            bargs = bargs[:1] + [b'***']
+        self.lines.append(b' '.join(bargs))
+
+    def call_later(self, delay, callback, *args):
+        """Nothing is scheduled during a replay."""
+        return None
+
+
+def _max_rss():
+    """Peak resident memory of this process as reported by the OS, or 0."""
+    if not resource:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def check_transcript(path, lines):
+    """
+    Writes the lines sent during a replay to the transcript at path if it
+    does not exist, or prints how they differ from it. Returns whether the
+    lines match the transcript. Raises BotError if the transcript cannot be
+    read or written.
+    """
+    sent = [line.decode('utf-8', 'replace') for line in lines]
+    try:
+        if not os.path.exists(path):
+            with open(path, 'w', encoding='utf-8') as transcript:
+                transcript.writelines(line + '\n' for line in sent)
+            print('Wrote %d sent lines to the transcript %s.' % (len(sent),
+                path))
+            return True
+        with open(path, encoding='utf-8') as transcript:
+            recorded = transcript.read().splitlines()
+    except OSError as e:
+        raise BotError('Unable to use transcript %s: %s' % (path, e))
+    diff = list(difflib.unified_diff(recorded, sent, path, 'replay',
+        lineterm=''))
+    if not diff:
+        print('The sent lines match the transcript %s.' % path)
+        return True
+    print('The sent lines differ from the transcript %s:' % path)
+    print('\n'.join(diff))
+    return False
+
+
+def run_replay(config, path, handler_class, transcript=None):
+    """
+    Feeds the capture at path through a bot of the given command handler
+    class, configured by config, and prints a report. The plugins use a
+    temporary home directory, so their real storages and logs are untouched.
+    If a transcript path is given, the lines sent are checked against it; see
+    check_transcript. Returns False if they differ, True otherwise.
+    """
+    header, records = read_capture(path)
+    host, port, nick = header
+    home = tempfile.mkdtemp(prefix='p1tr-replay-')
+    set_logdir(home)
+    try:
+        client = ReplayClient(handler_class, host, port, nick)
+        bot = client.command_handler
+        bot.load_config(config)
+        bot.home = home
+        bot.plugin_watch_interval = 0
+        bot.metrics_port = 0
+        bot.load_plugins()
+        bot.connected()
+        lines = [line for seconds, line in records]
+        errors = 0
+        rss_before = _max_rss()
+        start = perf_counter()
+        for line in lines:
+            tags, line = split_tags(line)
+            prefix, command, args = parse_raw_irc_command(line)
+            if command == b'cap':
+                if len(args) > 2 and args[1] == b'ACK':
+                    client.caps.update(args[-1].decode().split())
+                continue
+            bot.tags = tags
+            try:
+                bot.run(command, prefix, *args)
+            except CommandError:
+                errors += 1
+            bot.tags = NO_TAGS
+        elapsed = perf_counter() - start
+        rss_growth = _max_rss() - rss_before
+        _print_report(bot, records, elapsed, errors, len(client.lines),
+                rss_growth)
+        bot.exit()
+        if transcript:
+            return check_transcript(transcript, client.lines)
+        return True
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def _print_report(bot, records, elapsed, errors, sent, rss_growth):
+    captured = records[-1][0] - records[0][0] if records else 0
+    print('Replayed %d lines (%.1f s of traffic) in %.3f s: %d lines/s.' % (
+        len(records), captured, elapsed, len(records) / elapsed
+        if elapsed else 0))
+    print('%d messages sent, %d lines raised errors.' % (sent, errors))
+    if resource:
+        print('Peak memory grew by %d units of ru_maxrss (KiB on Linux).' %
+                rss_growth)
+    totals = sorted(bot.metrics.plugin_totals().items(),
+            key=lambda item: item[1][2], reverse=True)
+    if totals and bot.metrics.enabled:
+        print('%-16s %10s %8s %12s %10s' % ('Plugin', 'Calls', 'Errors',
+            'Total (ms)', 'Share'))
+        for plugin, (count, plugin_errors, total) in totals:
+            if count:
+                print('%-16s %10d %8d %12.1f %9.1f%%' % (plugin, count,
+                    plugin_errors, total * 1000,
+                    total / elapsed * 100 if elapsed else 0))
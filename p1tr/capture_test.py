@@ -0,0 +1,96 @@
+import configparser
+import contextlib
+import io
+import os.path
+import shutil
+import tempfile
+import unittest
+from p1tr import logwrap
+from p1tr.capture import ReplayClient, TrafficRecorder, check_transcript, \
+        read_capture, run_replay
+from p1tr.p1tr import BotHandler
+from p1tr.plugin import discover_plugins
+from p1tr.test import test
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'transcript')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _check(self, lines):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = check_transcript(self.path, lines)
+        return result, output.getvalue()
+
+    @test
+    def capture_test(self):
+        """Recorded lines are read back in order."""
+        path = os.path.join(self.directory, 'capture.gz')
+        recorder = TrafficRecorder(path, 'irc.example.org', 6667, 'P1tr')
+        recorder.record(b':Ford!ford@example.org PRIVMSG #p1tr :Hello')
+        recorder.record(b'PING :irc.example.org')
+        recorder.close()
+        header, records = read_capture(path)
+        self.assertEqual(header, ('irc.example.org', 6667, 'P1tr'))
+        self.assertEqual([line for seconds, line in records],
+                [b':Ford!ford@example.org PRIVMSG #p1tr :Hello',
+                    b'PING :irc.example.org'])
+
+    @test
+    def replay_client_test(self):
+        """The replay client records sent lines, hiding credentials."""
+        client = ReplayClient(lambda client: None, 'irc.example.org', 6667,
+                'P1tr')
+        client.send('PRIVMSG', '#p1tr', ':Hello')
+        client.send(b'AUTHENTICATE', b'c2VjcmV0', quiet=True)
+        self.assertEqual(client.lines, [b'PRIVMSG #p1tr :Hello',
+            b'AUTHENTICATE ***'])
+
+    @test
+    def transcript_test(self):
+        """Transcripts are written once and compared afterwards."""
+        lines = [b'PRIVMSG #p1tr :Hello', b'PRIVMSG #p1tr :42']
+        result, output = self._check(lines)
+        self.assertTrue(result)
+        self.assertTrue(output.startswith('Wrote 2 sent lines'))
+        result, output = self._check(lines)
+        self.assertTrue(result)
+        self.assertTrue(output.startswith('The sent lines match'))
+        result, output = self._check(lines[:1] + [b'PRIVMSG #p1tr :43'])
+        self.assertFalse(result)
+        self.assertTrue('\n-PRIVMSG #p1tr :42\n+PRIVMSG #p1tr :43' in output)
+
+    @test
+    def replay_transcript_test(self):
+        """Replays report whether the sent lines match the transcript."""
+        path = os.path.join(self.directory, 'capture.gz')
+        recorder = TrafficRecorder(path, 'irc.example.org', 6667, 'P1tr')
+        recorder.record(b'PING :irc.example.org')
+        recorder.close()
+        config = configparser.ConfigParser()
+        config.read_dict({'General': {'home': '', 'plugin_blacklist': '',
+            'signal_character': '+', 'lazy_plugins': 'False'},
+            'irc.example.org': {'nick': 'P1tr', 'port': '6667'}})
+        # Without plugins, only the PONG is sent.
+        config['General']['plugin_blacklist'] = ' '.join(
+                discover_plugins(config))
+        logdir = logwrap._logdir
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertTrue(run_replay(config, path, BotHandler,
+                    self.path))
+                self.assertTrue(run_replay(config, path, BotHandler,
+                    self.path))
+                with open(self.path, 'a') as transcript:
+                    transcript.write('PRIVMSG #p1tr :Hello\n')
+                self.assertFalse(run_replay(config, path, BotHandler,
+                    self.path))
+        finally:
+            logwrap.set_logdir(logdir)
+        with open(self.path) as transcript:
+            self.assertEqual(transcript.readline(), 'PONG irc.example.org\n')
@@ -0,0 +1,286 @@
+"""
+Membership and prefix modes of the channels the bot is in.
+
+Member lists used to exist only while a NAMES reply was being received. The
+ChannelTracker of a BotHandler (its channels attribute) instead keeps them
+up to date from NAMES, JOIN, PART, KICK, QUIT, NICK and MODE, so plugins can
+look up who is in a channel, and with which prefixes, without asking the
+server. Lookups are case-insensitive according to the server's case mapping.
+
+If the server supports the IRCv3 capabilities extended-join, account-notify,
+account-tag and away-notify, the services accounts and away messages of the
+members are tracked as well.
+"""
+
+"""Characters which are lower case versions of others in the rfc1459 mapping."""
+_RFC1459_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~',
+        'abcdefghijklmnopqrstuvwxyz{}|^')
+
+def irc_lower(string, casemapping='rfc1459'):
+    """
+    Returns the lower case version of a nick or channel name according to the
+    given case mapping, as advertised by the server's CASEMAPPING parameter.
+    Names comparing equal on IRC have the same lower case version.
+    """
+    if casemapping == 'ascii':
+        return string.lower()
+    return string.translate(_RFC1459_LOWER)
+
+
+class ChannelTracker:
+    """
+    Members of every channel the bot is in, with their prefixes (e.g. '@' for
+    operators, '+' for voiced users). The prefixes string of a member holds
+    all prefixes they have, ordered from the most to the least privileged.
+
+    The prefix and channel mode characters default to the common ones, and
+    are taken from the server's ISUPPORT reply (see set_isupport) if it sends
+    them.
+    """
+
+    def __init__(self):
+        self.casemapping = 'rfc1459'
+        self.prefix_modes = 'ohv' # Modes granting the prefixes below
+        self.prefix_chars = '@%+' # From the most to the least privileged
+        # Channel modes taking a parameter always, and only when being set.
+        self.param_modes = 'beIkq'
+        self.set_param_modes = 'fjl'
+        self.reset()
+
+    def reset(self):
+        """Forgets all channels, e.g. after a reconnect."""
+        self._channels = {} # Members by lower case channel name; see _add
+        self._names = {} # Channel names as seen on join, by lower case name
+        self._synced = set() # Lower case names of channels with a member list
+        self._pending = {} # Member lists being received, by lower case name
+        self._user_channels = {} # Lower case channel names by lower case nick
+        self._accounts = {} # Account, or '' if logged out, by lower case nick
+        self._away = {} # Away messages by lower case nick
+
+    def set_isupport(self, tokens):
+        """
+        Applies the relevant parameters of the server's ISUPPORT (005) reply,
+        given as a list of "KEY=VALUE" strings.
+        """
+        for token in tokens:
+            key, _, value = token.partition('=')
+            if key == 'CASEMAPPING' and value:
+                self.casemapping = value
+            elif key == 'PREFIX' and value.startswith('(') and ')' in value:
+                modes, chars = value[1:].split(')', 1)
+                if len(modes) == len(chars):
+                    self.prefix_modes = modes
+                    self.prefix_chars = chars
+            elif key == 'CHANMODES' and value.count(',') >= 3:
+                always, param, set_param = value.split(',')[:3]
+                self.param_modes = always + param
+                self.set_param_modes = set_param
+
+    def _lower(self, name):
+        return irc_lower(name, self.casemapping)
+
+    def _add(self, lchannel, nick, prefixes=''):
+        lnick = self._lower(nick)
+        self._channels[lchannel][lnick] = (nick, prefixes)
+        self._user_channels.setdefault(lnick, set()).add(lchannel)
+
+    def _remove(self, lchannel, lnick):
+        self._channels[lchannel].pop(lnick, None)
+        channels = self._user_channels.get(lnick)
+        if channels is not None:
+            channels.discard(lchannel)
+            if not channels:
+                del self._user_channels[lnick]
+                self._accounts.pop(lnick, None)
+                self._away.pop(lnick, None)
+
+    def _sort_prefixes(self, prefixes):
+        return ''.join(char for char in self.prefix_chars if char in prefixes)
+
+    # Updates, called by the BotHandler:
+
+    def joined(self, channel, nick, own=False, account=None):
+        """
+        Records that nick joined the channel; own if it was the bot. account
+        is given by extended-join, '*' if the user is not logged in.
+        """
+        lchannel = self._lower(channel)
+        if own:
+            self.parted(channel, nick, True)
+            self._channels[lchannel] = {}
+            self._names[lchannel] = channel
+        if lchannel in self._channels:
+            self._add(lchannel, nick)
+            if account is not None:
+                self.set_account(nick, account)
+
+    def parted(self, channel, nick, own=False):
+        """
+        Records that nick left the channel, by parting or being kicked; own if
+        it was the bot.
+        """
+        lchannel = self._lower(channel)
+        if not lchannel in self._channels:
+            return
+        if own:
+            for lnick in list(self._channels[lchannel]):
+                self._remove(lchannel, lnick)
+            del self._channels[lchannel]
+            del self._names[lchannel]
+            self._synced.discard(lchannel)
+            self._pending.pop(lchannel, None)
+        else:
+            self._remove(lchannel, self._lower(nick))
+
+    def quit(self, nick):
+        """Removes nick from all channels."""
+        lnick = self._lower(nick)
+        for lchannel in list(self._user_channels.get(lnick, ())):
+            self._remove(lchannel, lnick)
+
+    def renamed(self, oldnick, newnick):
+        lold = self._lower(oldnick)
+        lnew = self._lower(newnick)
+        channels = self._user_channels.pop(lold, set())
+        for lchannel in channels:
+            _, prefixes = self._channels[lchannel].pop(lold)
+            self._channels[lchannel][lnew] = (newnick, prefixes)
+        if channels:
+            self._user_channels.setdefault(lnew, set()).update(channels)
+            for user_data in (self._accounts, self._away):
+                if lold in user_data:
+                    user_data[lnew] = user_data.pop(lold)
+
+    def set_account(self, nick, account):
+        """
+        Records the account nick is logged in to; '*', '' or None if they are
+        not logged in. Only accounts of channel members are kept.
+        """
+        lnick = self._lower(nick)
+        if lnick in self._user_channels:
+            self._accounts[lnick] = '' if account in (None, '*') else account
+
+    def set_away(self, nick, message):
+        """Records nick's away message; None or '' if they are back."""
+        lnick = self._lower(nick)
+        if message:
+            if lnick in self._user_channels:
+                self._away[lnick] = message
+        else:
+            self._away.pop(lnick, None)
+
+    def mode(self, channel, modes, params):
+        """
+        Applies a channel mode change, given as the mode string (e.g. "+ov")
+        and the list of its parameters.
+        """
+        lchannel = self._lower(channel)
+        if not lchannel in self._channels:
+            return
+        members = self._channels[lchannel]
+        params = list(params)
+        adding = True
+        for mode in modes:
+            if mode in '+-':
+                adding = mode == '+'
+            elif mode in self.prefix_modes:
+                if not params:
+                    return
+                lnick = self._lower(params.pop(0))
+                if not lnick in members:
+                    continue
+                nick, prefixes = members[lnick]
+                char = self.prefix_chars[self.prefix_modes.index(mode)]
+                prefixes = prefixes.replace(char, '')
+                if adding:
+                    prefixes = self._sort_prefixes(prefixes + char)
+                members[lnick] = (nick, prefixes)
+            elif mode in self.param_modes or \
+                    (adding and mode in self.set_param_modes):
+                if params:
+                    params.pop(0)
+
+    def names_received(self, channel, names):
+        """Adds a part of a NAMES reply, given as a list of prefixed nicks."""
+        pending = self._pending.setdefault(self._lower(channel), [])
+        for name in names:
+            nick = name.lstrip(self.prefix_chars)
+            pending.append((nick, self._sort_prefixes(name[:len(name) -
+                len(nick)])))
+
+    def names_finished(self, channel):
+        """
+        Completes a NAMES reply. The received list replaces the channel's
+        member list, if the bot is in the channel. Returns the list as a
+        dictionary of the most significant prefix (or '') by nick.
+        """
+        lchannel = self._lower(channel)
+        pending = self._pending.pop(lchannel, [])
+        if lchannel in self._channels:
+            listed = set()
+            for nick, prefixes in pending:
+                listed.add(self._lower(nick))
+                self._add(lchannel, nick, prefixes)
+            for lnick in [lnick for lnick in self._channels[lchannel]
+                    if not lnick in listed]:
+                self._remove(lchannel, lnick)
+            self._synced.add(lchannel)
+        return dict((nick, prefixes[:1]) for nick, prefixes in pending)
+
+    # Queries, for use by plugins:
+
+    def channels(self):
+        """Returns the names of all channels the bot is in."""
+        return list(self._names.values())
+
+    def is_synced(self, channel):
+        """
+        True if the bot is in the channel and has received its member list,
+        so that the membership of every user is known.
+        """
+        return self._lower(channel) in self._synced
+
+    def members(self, channel):
+        """Returns the nicks of all members of the channel."""
+        return [nick for nick, _ in
+                self._channels.get(self._lower(channel), {}).values()]
+
+    def prefixes(self, channel, nick):
+        """
+        Returns the prefixes of nick in the channel, '' if they have none, or
+        None if nick is not known to be in the channel.
+        """
+        member = self._channels.get(self._lower(channel), {}).get(
+                self._lower(nick))
+        return member[1] if member else None
+
+    def is_member(self, channel, nick):
+        return self.prefixes(channel, nick) is not None
+
+    def has_prefix(self, channel, nick, prefix):
+        """
+        True if nick has the given prefix in the channel, or a more privileged
+        one. For example, has_prefix(channel, nick, '+') is True for voiced
+        users and operators.
+        """
+        prefixes = self.prefixes(channel, nick)
+        if not prefixes or not prefix in self.prefix_chars:
+            return False
+        return self.prefix_chars.index(prefixes[0]) <= \
+                self.prefix_chars.index(prefix)
+
+    def account(self, nick):
+        """
+        Returns the services account nick is logged in to, '' if they are
+        known not to be logged in, or None if this is unknown.
+        """
+        return self._accounts.get(self._lower(nick))
+
+    def away(self, nick):
+        """Returns the away message of nick, or None if they are not away."""
+        return self._away.get(self._lower(nick))
+
+    def channels_of(self, nick):
+        """Returns the names of the channels nick is known to be in."""
+        return [self._names[lchannel] for lchannel in
+                self._user_channels.get(self._lower(nick), ())]
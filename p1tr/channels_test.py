@@ -0,0 +1,155 @@
+import unittest
+from p1tr.channels import ChannelTracker, irc_lower
+from p1tr.test import test
+
+class ChannelTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = ChannelTracker()
+        self.tracker.joined('#p1tr', 'P1tr', own=True)
+        self.tracker.names_received('#p1tr', ['@P1tr', '@+Ford', '+Arthur',
+            'Trillian'])
+        self.tracker.names_finished('#p1tr')
+
+    @test
+    def names_test(self):
+        """NAMES replies set the member list and the prefixes."""
+        self.assertTrue(self.tracker.is_synced('#p1tr'))
+        self.assertEqual(sorted(self.tracker.members('#p1tr')),
+                ['Arthur', 'Ford', 'P1tr', 'Trillian'])
+        self.assertEqual(self.tracker.prefixes('#p1tr', 'Ford'), '@+')
+        self.assertEqual(self.tracker.prefixes('#p1tr', 'Trillian'), '')
+        self.assertIsNone(self.tracker.prefixes('#p1tr', 'Zaphod'))
+        self.assertTrue(self.tracker.has_prefix('#p1tr', 'Ford', '+'))
+        self.assertTrue(self.tracker.has_prefix('#p1tr', 'Arthur', '+'))
+        self.assertFalse(self.tracker.has_prefix('#p1tr', 'Arthur', '@'))
+        # A later reply replaces the member list.
+        self.tracker.names_received('#p1tr', ['@P1tr', 'Ford'])
+        self.assertEqual(self.tracker.names_finished('#p1tr'),
+                {'P1tr': '@', 'Ford': ''})
+        self.assertEqual(sorted(self.tracker.members('#p1tr')),
+                ['Ford', 'P1tr'])
+
+    @test
+    def isupport_prefix_test(self):
+        """The prefixes advertised by the server are used."""
+        self.tracker.set_isupport(['PREFIX=(qaohv)~&@%+',
+            'CHANMODES=b,k,l,imnt'])
+        self.tracker.joined('#other', 'P1tr', own=True)
+        self.tracker.names_received('#other', ['~Zaphod', '%@Marvin'])
+        self.tracker.names_finished('#other')
+        self.assertEqual(self.tracker.prefixes('#other', 'Marvin'), '@%')
+        self.assertTrue(self.tracker.has_prefix('#other', 'Zaphod', '&'))
+        self.tracker.mode('#other', '+kq-o', ['secret', 'Marvin', 'Marvin'])
+        self.assertEqual(self.tracker.prefixes('#other', 'Marvin'), '~%')
+
+    @test
+    def join_part_test(self):
+        """Joins and parts of other users update the member list."""
+        self.tracker.joined('#p1tr', 'Zaphod')
+        self.assertTrue(self.tracker.is_member('#p1tr', 'Zaphod'))
+        self.assertEqual(self.tracker.prefixes('#p1tr', 'Zaphod'), '')
+        self.tracker.parted('#p1tr', 'Zaphod')
+        self.assertFalse(self.tracker.is_member('#p1tr', 'Zaphod'))
+        # Channels the bot is not in are not tracked.
+        self.tracker.joined('#other', 'Zaphod')
+        self.assertEqual(self.tracker.members('#other'), [])
+
+    @test
+    def own_part_test(self):
+        """Channels the bot leaves or is kicked from are forgotten."""
+        self.tracker.parted('#p1tr', 'P1tr', own=True)
+        self.assertEqual(self.tracker.channels(), [])
+        self.assertFalse(self.tracker.is_synced('#p1tr'))
+        self.assertEqual(self.tracker.channels_of('Ford'), [])
+
+    @test
+    def kick_test(self):
+        """Kicked users are removed from the channel."""
+        self.tracker.parted('#p1tr', 'Arthur')
+        self.assertFalse(self.tracker.is_member('#p1tr', 'Arthur'))
+        self.assertTrue(self.tracker.is_member('#p1tr', 'Ford'))
+
+    @test
+    def quit_test(self):
+        """Users quitting are removed from all channels."""
+        self.tracker.joined('#other', 'P1tr', own=True)
+        self.tracker.joined('#other', 'Ford')
+        self.tracker.quit('Ford')
+        self.assertFalse(self.tracker.is_member('#p1tr', 'Ford'))
+        self.assertFalse(self.tracker.is_member('#other', 'Ford'))
+        self.assertEqual(self.tracker.channels_of('Ford'), [])
+
+    @test
+    def rename_test(self):
+        """Renamed users keep their channels, prefixes, account and away."""
+        self.tracker.set_account('Ford', 'ford')
+        self.tracker.set_away('Ford', 'Hitchhiking')
+        self.tracker.renamed('Ford', 'Ix')
+        self.assertFalse(self.tracker.is_member('#p1tr', 'Ford'))
+        self.assertEqual(self.tracker.prefixes('#p1tr', 'Ix'), '@+')
+        self.assertEqual(self.tracker.account('Ix'), 'ford')
+        self.assertEqual(self.tracker.away('Ix'), 'Hitchhiking')
+        self.assertIsNone(self.tracker.account('Ford'))
+
+    @test
+    def mode_test(self):
+        """Prefix mode changes are applied; other modes are skipped."""
+        self.tracker.mode('#p1tr', '+bo-v', ['*!*@spam', 'Trillian', 'Arthur'])
+        self.assertEqual(self.tracker.prefixes('#p1tr', 'Trillian'), '@')
+        self.assertEqual(self.tracker.prefixes('#p1tr', 'Arthur'), '')
+        self.tracker.mode('#p1tr', '+v', ['Trillian'])
+        self.assertEqual(self.tracker.prefixes('#p1tr', 'Trillian'), '@+')
+
+    @test
+    def casemapping_test(self):
+        """Names are compared according to the server's case mapping."""
+        self.assertTrue(self.tracker.is_member('#P1TR', 'ford'))
+        self.tracker.joined('#p1tr', 'Slarti[Bart]')
+        self.assertTrue(self.tracker.is_member('#p1tr', 'slarti{bart}'))
+        self.assertEqual(irc_lower('A[]\\~'), 'a{}|^')
+        self.assertEqual(irc_lower('A[]\\~', 'ascii'), 'a[]\\~')
+        tracker = ChannelTracker()
+        tracker.set_isupport(['CASEMAPPING=ascii'])
+        tracker.joined('#p1tr', 'P1tr', own=True)
+        tracker.joined('#p1tr', 'Slarti[Bart]')
+        self.assertTrue(tracker.is_member('#P1TR', 'slarti[bart]'))
+        self.assertFalse(tracker.is_member('#p1tr', 'slarti{bart}'))
+
+    @test
+    def account_test(self):
+        """Accounts and away messages are only kept for channel members."""
+        self.tracker.joined('#p1tr', 'Zaphod', account='zaphod')
+        self.tracker.joined('#p1tr', 'Marvin', account='*')
+        self.assertEqual(self.tracker.account('Zaphod'), 'zaphod')
+        self.assertEqual(self.tracker.account('Marvin'), '')
+        self.assertIsNone(self.tracker.account('Arthur'))
+        self.tracker.set_account('Stranger', 'stranger')
+        self.tracker.set_away('Stranger', 'Elsewhere')
+        self.assertIsNone(self.tracker.account('Stranger'))
+        self.assertIsNone(self.tracker.away('Stranger'))
+        self.tracker.set_away('Zaphod', 'Partying')
+        self.assertEqual(self.tracker.away('Zaphod'), 'Partying')
+        self.tracker.set_away('Zaphod', '')
+        self.assertIsNone(self.tracker.away('Zaphod'))
+
+    @test
+    def last_channel_test(self):
+        """
+        Accounts and away messages are forgotten once a user leaves their
+        last channel.
+        """
+        self.tracker.joined('#other', 'P1tr', own=True)
+        for channel in ('#p1tr', '#other'):
+            self.tracker.joined(channel, 'Zaphod', account='zaphod')
+        self.tracker.set_away('Zaphod', 'Partying')
+        self.tracker.parted('#p1tr', 'Zaphod')
+        self.assertEqual(self.tracker.account('Zaphod'), 'zaphod')
+        self.assertEqual(self.tracker.away('Zaphod'), 'Partying')
+        self.tracker.parted('#other', 'Zaphod')
+        self.assertIsNone(self.tracker.account('Zaphod'))
+        self.assertIsNone(self.tracker.away('Zaphod'))
+        # Likewise when the bot leaves the last shared channel.
+        self.tracker.set_account('Ford', 'ford')
+        self.tracker.parted('#p1tr', 'P1tr', own=True)
+        self.assertIsNone(self.tracker.account('Ford'))
@@ -0,0 +1,382 @@
+"""
+Connection handling based on asyncio.
+
+oyoyo's IRCApp polls every connection and then sleeps for a fixed amount of
+time, which delays every response by up to that amount and wakes up an idle
+bot several times a second. The IRCConnection class in this module is driven
+by an asyncio event loop instead and only runs when data actually arrives.
+It mimics oyoyo's IRCClient, so that BotHandler and the plugins keep working
+on top of it unchanged.
+
+On connect, IRCv3 capabilities are negotiated (see WANTED_CAPS) before the
+registration completes. Message tags are split off each line before oyoyo
+parses it, and made available to the command handler as its tags attribute
+while the line is handled. If a nick password is configured and the server
+supports SASL, the bot logs in to its account during the negotiation, so it
+is identified before the registration completes and it joins any channels.
+"""
+
+import asyncio
+import base64
+from types import MappingProxyType
+from oyoyo import helpers
+from oyoyo.cmdhandler import CommandError
+from oyoyo.parse import parse_raw_irc_command
+from p1tr.event import NO_TAGS
+from p1tr.logwrap import debug, error, info, warning
+from p1tr.sendqueue import SendQueue, PRIORITY_NORMAL, PRIORITY_URGENT, \
+        URGENT_COMMANDS
+
+"""Seconds to wait before the first reconnection attempt."""
+RECONNECT_DELAY = 5
+
+"""Upper limit for the reconnection delay, which doubles on every failure."""
+MAX_RECONNECT_DELAY = 300
+
+"""
+The welcome numeric, as passed on by oyoyo, which confirms the registration.
+The connect_cb is called when it is received.
+"""
+REGISTERED_COMMANDS = (b'001', b'welcome')
+
+"""IRCv3 capabilities requested from servers offering them."""
+WANTED_CAPS = ('multi-prefix', 'extended-join', 'account-notify',
+        'account-tag', 'away-notify', 'server-time', 'batch')
+
+"""Seconds to wait for the server to complete a SASL authentication."""
+SASL_TIMEOUT = 15
+
+"""Numerics of the SASL authentication, as passed on by oyoyo."""
+RPL_LOGGEDIN = b'900'
+RPL_SASLSUCCESS = b'903'
+SASL_FAILURES = (b'902', b'904', b'905', b'906', b'907', b'908')
+
+"""Replacements of the escape sequences in message tag values."""
+_TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def _unescape_tag(value):
+    if not '\\' in value:
+        return value
+    result = []
+    escaped = False
+    for char in value:
+        if escaped:
+            result.append(_TAG_ESCAPES.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            result.append(char)
+    return ''.join(result)
+
+
+def split_tags(line):
+    """
+    Splits the IRCv3 message tags off a raw line. Returns a read-only mapping
+    of the tags by name, and the rest of the line.
+    """
+    if not line.startswith(b'@'):
+        return NO_TAGS, line
+    raw_tags, _, line = line[1:].partition(b' ')
+    tags = {}
+    for tag in raw_tags.decode('utf-8', 'replace').split(';'):
+        name, _, value = tag.partition('=')
+        if name:
+            tags[name] = _unescape_tag(value)
+    return MappingProxyType(tags), line.lstrip(b' ')
+
+
+class IRCConnection(asyncio.Protocol):
+    """
+    A connection to a single IRC server. Accepts the same keyword arguments as
+    oyoyo's IRCClient (host, port, nick, real_name, connect_cb) and provides
+    the same send method and command_handler attribute. Unlike oyoyo's,
+    connect_cb is only called once the server has accepted the registration.
+
+    Outgoing lines pass through a SendQueue, configured by the flood_rate
+    (lines per second) and flood_burst keyword arguments. It is available as
+    the send_queue attribute once the connection has been started.
+
+    If the recorder attribute is set to a p1tr.capture.TrafficRecorder, all
+    received lines are recorded.
+
+    The caps attribute holds the names of the IRCv3 capabilities enabled on
+    the current connection.
+
+    If the nick_password keyword argument is given, the connection logs in to
+    the services account named like its nick with SASL PLAIN, if the server
+    supports it. The account attribute holds the name of the account logged
+    in to, or None.
+
+    The connection is re-established automatically when it is lost, unless
+    the command handler's intended_disconnect attribute is set. In that case,
+    the optional closed_cb keyword argument is called with the connection.
+    """
+
+    def __init__(self, cmd_handler, **kwargs):
+        self.nick = None
+        self.real_name = None
+        self.host = None
+        self.port = None
+        self.connect_cb = None
+        self.closed_cb = None
+        self.flood_rate = 0.5
+        self.flood_burst = 5
+        self.loop = None
+        self.transport = None
+        self.send_queue = None
+        self.recorder = None
+        self.nick_password = None
+        self.caps = set()
+        self.account = None
+        self._offered_caps = {} # Values by capability name
+        self._sasl_timer = None
+        self._buffer = b''
+        self._reconnect_delay = RECONNECT_DELAY
+        self.__dict__.update(kwargs)
+        self.command_handler = cmd_handler(self)
+
+    def start(self, loop):
+        """Schedules connecting to the server on the given event loop."""
+        self.loop = loop
+        if not self.send_queue:
+            self.send_queue = SendQueue(self._write, loop, self.flood_rate,
+                    self.flood_burst)
+        return loop.create_task(self._connect())
+
+    def call_later(self, delay, callback, *args):
+        """
+        Runs callback with the given arguments after delay seconds on this
+        connection's event loop. Returns a handle which can be cancelled.
+        """
+        return self.loop.call_later(delay, callback, *args)
+
+    async def _connect(self):
+        info('Connecting to %s:%d...' % (self.host, self.port),
+                server=self.host)
+        try:
+            await self.loop.create_connection(lambda: self, self.host,
+                    self.port)
+        except OSError as e:
+            error('Connection failed: %s' % e, server=self.host)
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if getattr(self.command_handler, 'intended_disconnect', False):
+            if self.closed_cb:
+                self.closed_cb(self)
+            return
+        info('Reconnecting in %d seconds.' % self._reconnect_delay,
+                server=self.host)
+        self.loop.call_later(self._reconnect_delay, self.start, self.loop)
+        self._reconnect_delay = min(self._reconnect_delay * 2,
+                MAX_RECONNECT_DELAY)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._buffer = b''
+        self._reconnect_delay = RECONNECT_DELAY
+        self.caps = set()
+        self.account = None
+        self._offered_caps = {}
+        # Registration is suspended until the negotiation has ended. Servers
+        # without capabilities ignore this.
+        self.send('CAP', 'LS', '302')
+        helpers.nick(self, self.nick)
+        helpers.user(self, self.nick, self.real_name)
+
+    def data_received(self, data):
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            if self.recorder:
+                self.recorder.record(line.rstrip(b'\r'))
+            try:
+                self._handle_line(line)
+            except Exception as e:
+                # A malformed line must not cost the lines buffered after it.
+                error('Unable to handle "%s": %s: %s' % (line.rstrip(b'\r'),
+                    e.__class__.__name__, e), server=self.host)
+
+    def _handle_line(self, line):
+        """Parses a raw line received from the server and handles it."""
+        tags, line = split_tags(line)
+        prefix, command, args = parse_raw_irc_command(line)
+        if command == b'cap':
+            self._negotiate_caps(args)
+            return
+        if command == b'authenticate' or command == RPL_LOGGEDIN or \
+                command == RPL_SASLSUCCESS or command in SASL_FAILURES:
+            self._authenticate(command, args)
+            return
+        self.command_handler.tags = tags
+        try:
+            self.command_handler.run(command, prefix, *args)
+        except CommandError:
+            pass # Already logged by the command handler.
+        finally:
+            self.command_handler.tags = NO_TAGS
+        if command in REGISTERED_COMMANDS and self.connect_cb:
+            self.connect_cb(self)
+
+    def _negotiate_caps(self, args):
+        """
+        Handles a CAP reply: requests the wanted capabilities the server
+        offers, and records the ones it acknowledges.
+        """
+        if len(args) < 3:
+            return
+        subcommand = args[1].upper()
+        more = len(args) > 3 and args[2] == b'*' # Reply continues
+        names = args[-1].decode('utf-8', 'replace').split()
+        if subcommand == b'LS':
+            self._offered_caps.update(name.partition('=')[::2]
+                    for name in names)
+            if more:
+                return
+            wanted = [cap for cap in WANTED_CAPS if cap in self._offered_caps]
+            mechanisms = self._offered_caps.get('sasl')
+            if self.nick_password and mechanisms is not None and \
+                    (not mechanisms or 'PLAIN' in mechanisms.split(',')):
+                wanted.append('sasl')
+            if wanted:
+                self.send('CAP', 'REQ', ':' + ' '.join(wanted))
+            else:
+                self._end_caps()
+        elif subcommand == b'ACK':
+            for name in names:
+                if name.startswith('-'):
+                    self.caps.discard(name[1:])
+                else:
+                    self.caps.add(name)
+            if not more:
+                info('Enabled capabilities: %s' % ' '.join(sorted(self.caps)),
+                        server=self.host)
+                if 'sasl' in self.caps and self.nick_password:
+                    self.send('AUTHENTICATE', 'PLAIN')
+                    self._sasl_timer = self.loop.call_later(SASL_TIMEOUT,
+                            self._sasl_timed_out)
+                else:
+                    self._end_caps()
+        elif subcommand == b'NAK':
+            self._end_caps()
+        elif subcommand == b'DEL':
+            self.caps.difference_update(names)
+
+    def _end_caps(self):
+        self.send('CAP', 'END')
+
+    def _authenticate(self, command, args):
+        """
+        Handles the server's part of the SASL PLAIN authentication: sends the
+        credentials when asked for them, and ends the negotiation once the
+        authentication succeeded or failed.
+        """
+        if command == b'authenticate':
+            if args and args[0] == b'+':
+                payload = base64.b64encode('\0'.join((self.nick, self.nick,
+                    self.nick_password)).encode('utf-8'))
+                # The payload is sent in chunks of 400 bytes. A chunk of
+                # exactly that size must be followed by an empty one.
+                chunks = [payload[start:start + 400]
+                        for start in range(0, len(payload), 400)]
+                if len(chunks[-1]) == 400:
+                    chunks.append(b'+')
+                for chunk in chunks:
+                    self.send(b'AUTHENTICATE', chunk, quiet=True)
+        elif command == RPL_LOGGEDIN:
+            if len(args) > 2:
+                self.account = args[2].decode('utf-8', 'replace')
+                info('Logged in as %s.' % self.account, server=self.host)
+        elif command == RPL_SASLSUCCESS:
+            self._end_sasl()
+        else:
+            warning('SASL authentication failed: %s' % args[-1].decode(
+                'utf-8', 'replace'), server=self.host)
+            self._end_sasl()
+
+    def _sasl_timed_out(self):
+        warning('SASL authentication timed out.', server=self.host)
+        self.send('AUTHENTICATE', '*')
+        self._end_sasl()
+
+    def _end_sasl(self):
+        if self._sasl_timer:
+            self._sasl_timer.cancel()
+            self._sasl_timer = None
+            self._end_caps()
+
+    def connection_lost(self, exc):
+        warning('Disconnected from the server.', server=self.host)
+        self.transport = None
+        if self._sasl_timer:
+            self._sasl_timer.cancel()
+            self._sasl_timer = None
+        dropped = self.send_queue.clear()
+        if dropped:
+            warning('Dropped %d queued lines.' % dropped, server=self.host)
+        self._schedule_reconnect()
+
+    def send(self, *args, **kwargs):
+        """
+        Queues a message for the server. All arguments are joined with spaces;
+        str arguments are encoded using the encoding keyword argument, which
+        defaults to utf8. The priority keyword argument selects the lane of
+        the send queue; see p1tr.sendqueue. If the quiet keyword argument is
+        true, the message is not logged, as it contains credentials.
+        """
+        encoding = kwargs.get('encoding') or 'utf8'
+        priority = kwargs.get('priority', PRIORITY_NORMAL)
+        bargs = [arg if isinstance(arg, bytes) else arg.encode(encoding)
+                for arg in args]
+        msg = b' '.join(bargs)
+        if not self.transport:
+            warning('Not connected, dropping: %s' % msg, server=self.host)
+            return
+        if bargs[0].upper() in URGENT_COMMANDS:
+            priority = PRIORITY_URGENT
+        if not kwargs.get('quiet'):
+            debug('---> send "%s"' % msg, server=self.host)
+        self.send_queue.put(msg + b'\r\n', priority)
+
+    def _write(self, data):
+        """Writes queued data to the socket, if still connected."""
+        if self.transport:
+            self.transport.write(data)
+
+    def close(self):
+        """Closes the connection without reconnecting."""
+        self.command_handler.intended_disconnect = True
+        if self.transport:
+            self.transport.close()
+        if self.recorder:
+            self.recorder.close()
+
+
+def serve(connections):
+    """
+    Connects all given IRCConnection instances and serves them until all of
+    them have been closed intentionally, or KeyboardInterrupt is raised, which
+    is passed on to the caller.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    active = set(connections)
+    def _closed(connection):
+        active.discard(connection)
+        if not active:
+            loop.stop()
+    for connection in connections:
+        connection.closed_cb = _closed
+        connection.start(loop)
+    try:
+        loop.run_forever()
+    finally:
+        for connection in connections:
+            connection.closed_cb = None
+            connection.close()
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
@@ -0,0 +1,42 @@
+import unittest
+from p1tr.connection import IRCConnection
+from p1tr.event import NO_TAGS
+from p1tr.test import test
+
+class _Handler:
+    """Records the commands run, failing on those named 'fail'."""
+
+    def __init__(self, client):
+        self.client = client
+        self.tags = NO_TAGS
+        self.commands = []
+
+    def run(self, command, prefix, *args):
+        if command == b'fail':
+            raise ValueError('Failing as requested')
+        self.commands.append((command, prefix) + args)
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = IRCConnection(_Handler, host='irc.example.org')
+        self.commands = self.connection.command_handler.commands
+
+    @test
+    def split_lines_test(self):
+        """Lines split across reads are handled once complete."""
+        self.connection.data_received(b':Ford!f@example.org PRIVMSG #p1tr :He')
+        self.assertEqual(self.commands, [])
+        self.connection.data_received(b'llo\r\nPING :irc.example.org\r\n')
+        self.assertEqual(self.commands, [
+            (b'privmsg', b'Ford!f@example.org', b'#p1tr', b'Hello'),
+            (b'ping', None, b'irc.example.org')])
+
+    @test
+    def malformed_line_test(self):
+        """Lines which cannot be handled do not stop the following ones."""
+        self.connection.data_received(b'@a=b\r\n:Ford!f@example.org\r\n'
+                b'FAIL now\r\nPING :irc.example.org\r\n')
+        self.assertEqual(self.commands, [(b'ping', None, b'irc.example.org')])
+        self.assertEqual(self.connection.command_handler.tags, NO_TAGS)
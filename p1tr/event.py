@@ -0,0 +1,83 @@
+"""
+Event envelopes, which are handed to the plugins' on_* hooks.
+
+An event is decoded and parsed exactly once by the bot, no matter how many
+plugins are interested in it. Plugins opt in to receiving events by decorating
+their hooks with p1tr.plugin.event_hook; all other hooks keep receiving the
+positional arguments documented in p1tr.plugin.Plugin.
+"""
+
+from collections import namedtuple
+from operator import attrgetter
+from types import MappingProxyType
+
+"""Tags of events without IRCv3 message tags."""
+NO_TAGS = MappingProxyType({})
+
+"""
+Positional parameters of the hooks which can receive events, expressed as
+Event fields. The order matches the signatures in p1tr.plugin.Plugin.
+"""
+HOOK_FIELDS = {
+        'on_privmsg': ('server', 'channel', 'prefix', 'message'),
+        'on_notice': ('server', 'channel', 'prefix', 'message'),
+        'on_modechanged': ('server', 'channel', 'prefix', 'message'),
+        'on_useraction': ('server', 'channel', 'prefix', 'message'),
+        'on_userjoin': ('server', 'channel', 'prefix'),
+        'on_userpart': ('server', 'channel', 'prefix', 'message'),
+        'on_userkicked': ('server', 'channel', 'prefix', 'message'),
+        'on_userquit': ('server', 'prefix', 'message'),
+        'on_userrenamed': ('server', 'prefix', 'message'),
+        }
+
+"""
+Functions turning an Event into the tuple of positional arguments a hook
+expects. Used to serve hooks which do not receive events.
+"""
+LEGACY_ARGUMENTS = dict((hook, attrgetter(*fields))
+        for hook, fields in HOOK_FIELDS.items())
+
+
+class Event(namedtuple('Event', ['server', 'channel', 'prefix', 'nick',
+    'user', 'host', 'message', 'account', 'tags'])):
+    """
+    Immutable, decoded view of a single IRC event.
+
+    * server - The server identifier, "host:port".
+    * channel - The channel the event occured in; the bot's nick for queries,
+      empty if the event is not bound to a channel (quit, rename).
+    * prefix - The full nick!user@host of the user causing the event.
+    * nick, user, host - The parts of the prefix; user and host are empty if
+      the prefix does not contain them.
+    * message - The message text. For renames, this is the new nick; for mode
+      changes the mode string, and for kicks the reason.
+    * account - The services account the user is logged in to, if the server
+      tagged the message with it (IRCv3 account-tag), otherwise None.
+    * tags - Read-only mapping of the IRCv3 message tags of the event by tag
+      name, e.g. 'time' for server-time or 'batch'. Valueless tags map to ''.
+
+    Use Event.create instead of instantiating this class directly.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, server, channel, prefix, message='', tags=NO_TAGS):
+        """
+        Builds an event, splitting the prefix into its parts. tags must be a
+        read-only mapping.
+        """
+        nick, _, rest = prefix.partition('!')
+        user, _, host = rest.partition('@')
+        return cls(server, channel, prefix, nick, user, host, message,
+                tags.get('account'), tags)
+
+
+def event_from_arguments(hook, args):
+    """
+    Builds an Event from the positional arguments of a hook call, which are
+    given as a tuple. This is the reverse of LEGACY_ARGUMENTS.
+    """
+    fields = dict(zip(HOOK_FIELDS[hook], args))
+    return Event.create(fields.get('server', ''), fields.get('channel', ''),
+            fields.get('prefix', ''), fields.get('message', ''))
@@ -0,0 +1,443 @@
+"""
+Minimal stand-in IRC server for local testing and benchmarking.
+
+It speaks just enough of the protocol to serve P1tr and simple test clients:
+registration via NICK and USER, JOIN, PART, NAMES, PRIVMSG, NOTICE, PING,
+QUIT, and for channel operators KICK and MODE +o/-o/+v/-v. The first user to
+join a channel becomes its operator, like on real networks.
+
+A NickServ pseudo-user answers IDENTIFY and ACC requests sent by PRIVMSG, in
+the format used by freenode's services. Any password is accepted. IDENTIFY
+logs the user in to the account named like their current nick, until they
+disconnect; ACC only reports them as identified while they keep that nick.
+
+The IRCv3 capabilities in CAPS are offered through CAP negotiation. Clients
+enabling them get all prefixes in NAMES (multi-prefix), the account and real
+name in JOIN (extended-join), ACCOUNT and AWAY notifications of their channel
+peers (account-notify, away-notify), and account and time tags on messages
+(account-tag, server-time). batch is accepted, but no batches are sent.
+With sasl, clients may log in with AUTHENTICATE PLAIN before registering,
+which has the same effect as identifying with NickServ under the given
+account name.
+
+There is no flood protection, there are no other modes and no real
+authentication, so never expose it to the public.
+"""
+
+import asyncio
+import base64
+import binascii
+import datetime
+from time import monotonic
+from p1tr.logwrap import debug
+
+"""Prefix of the NickServ pseudo-user's messages."""
+NICKSERV_PREFIX = 'NickServ!NickServ@services.'
+
+"""IRCv3 capabilities offered by default."""
+CAPS = ('multi-prefix', 'extended-join', 'account-notify', 'account-tag',
+        'away-notify', 'server-time', 'batch', 'sasl')
+
+
+class StandInServer:
+    """
+    Keeps track of the connected users and channels. Call start to listen on
+    a local port, which is available as the port attribute afterwards. Pass
+    an empty caps tuple to emulate a server without capability negotiation.
+    """
+
+    def __init__(self, name='irc.localhost', caps=CAPS):
+        self.name = name
+        self.caps = tuple(caps)
+        self.port = None
+        self.users = {} # Registered sessions by nick
+        self.channels = {} # Sets of member nicks by channel name
+        self.operators = {} # Sets of operator nicks by channel name
+        self.voiced = {} # Sets of voiced nicks by channel name
+        self.identified = set() # Nicks identified with NickServ
+        self._server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Starts listening. Port 0 picks a free port."""
+        loop = asyncio.get_event_loop()
+        self._server = await loop.create_server(lambda: Session(self), host,
+                port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        """Stops listening and disconnects all users."""
+        self._server.close()
+        for session in list(self.users.values()):
+            session.transport.close()
+
+    def broadcast(self, channel, line, exclude=None, source=None):
+        """
+        Sends a line to all members of a channel, except exclude. source is
+        the session causing the line, if any; see Session.send.
+        """
+        for nick in self.channels.get(channel, ()):
+            if nick != exclude:
+                self.users[nick].send(line, source)
+
+    def leave(self, channel, nick):
+        """Removes nick from the channel, and the channel once it is empty."""
+        members = self.channels.get(channel, set())
+        members.discard(nick)
+        self.operators.get(channel, set()).discard(nick)
+        self.voiced.get(channel, set()).discard(nick)
+        if not members:
+            self.channels.pop(channel, None)
+            self.operators.pop(channel, None)
+            self.voiced.pop(channel, None)
+
+
+class Session(asyncio.Protocol):
+    """
+    Server side of a single client connection. opened_at is the monotonic
+    time the connection was accepted at, for benchmarks of the time a client
+    needs to get ready.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.nick = None
+        self.user = None
+        self.real_name = ''
+        self.account = None
+        self.caps = set()
+        self.negotiating = False # Registration waits for CAP END
+        self.sasl_mechanism = None # Set while a SASL login is in progress
+        self.opened_at = None
+        self.registered = False
+        self.transport = None
+        self._buffer = b''
+
+    @property
+    def prefix(self):
+        return '%s!%s@localhost' % (self.nick, self.user or self.nick)
+
+    def write(self, line):
+        if not self.transport.is_closing(): # E.g. while the server stops
+            self.transport.write(line.encode('utf-8') + b'\r\n')
+
+    def send(self, line, source=None):
+        """
+        Writes a line caused by the source session, adding the message tags
+        this session enabled.
+        """
+        tags = []
+        if 'server-time' in self.caps:
+            tags.append('time=' + datetime.datetime.utcnow().strftime(
+                '%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z')
+        if 'account-tag' in self.caps and source and source.account:
+            tags.append('account=' + source.account)
+        self.write('@%s %s' % (';'.join(tags), line) if tags else line)
+
+    def peers(self):
+        """Returns the other sessions sharing a channel with this one."""
+        nicks = set()
+        for members in self.server.channels.values():
+            if self.nick in members:
+                nicks |= members
+        nicks.discard(self.nick)
+        return [self.server.users[nick] for nick in nicks]
+
+    def reply(self, numeric, *params):
+        """Sends a numeric reply, addressed to this session's nick."""
+        self.write(' '.join((':' + self.server.name, numeric,
+            self.nick or '*') + params))
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.opened_at = monotonic()
+
+    def connection_lost(self, exc):
+        self._leave_all('Connection closed')
+
+    def data_received(self, data):
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            line = line.decode('utf-8', 'replace').strip()
+            if line:
+                self.handle(line)
+
+    def handle(self, line):
+        """Parses a line from the client and calls the matching handler."""
+        debug('<--- %s' % line)
+        if ' :' in line:
+            head, trailing = line.split(' :', 1)
+            params = head.split() + [trailing]
+        else:
+            params = line.split()
+        command = params.pop(0).upper()
+        handler = getattr(self, 'irc_' + command, None)
+        if handler:
+            try:
+                handler(*params)
+            except TypeError:
+                self.reply('461', command, ':Not enough parameters')
+        elif self.registered:
+            self.reply('421', command, ':Unknown command')
+
+    def _leave_all(self, message):
+        if not self.nick in self.server.users:
+            return
+        quit_line = ':%s QUIT :%s' % (self.prefix, message)
+        notified = set()
+        for channel, members in list(self.server.channels.items()):
+            if self.nick in members:
+                self.server.leave(channel, self.nick)
+                for nick in members - notified:
+                    self.server.users[nick].send(quit_line, self)
+                notified |= members
+        del self.server.users[self.nick]
+        self.server.identified.discard(self.nick)
+
+    def _try_register(self):
+        if self.registered or self.negotiating or not self.nick or \
+                not self.user:
+            return
+        self.registered = True
+        self.server.users[self.nick] = self
+        self.reply('001', ':Welcome to the stand-in IRC server, %s' %
+                self.nick)
+        self.reply('376', ':End of /MOTD command.')
+
+    def irc_NICK(self, nick, *rest):
+        if nick in self.server.users and self.server.users[nick] is not self:
+            self.reply('433', nick, ':Nickname is already in use')
+            return
+        if self.registered:
+            line = ':%s NICK :%s' % (self.prefix, nick)
+            del self.server.users[self.nick]
+            self.server.identified.discard(self.nick)
+            for channel, members in self.server.channels.items():
+                if self.nick in members:
+                    members.discard(self.nick)
+                    members.add(nick)
+                for ranked in (self.server.operators.get(channel, set()),
+                        self.server.voiced.get(channel, set())):
+                    if self.nick in ranked:
+                        ranked.discard(self.nick)
+                        ranked.add(nick)
+            self.server.users[nick] = self
+            self.write(line)
+            for other in self.peers():
+                other.send(line, self)
+        self.nick = nick
+        self._try_register()
+
+    def irc_USER(self, user, mode='', unused='', real_name='', *rest):
+        self.user = user
+        self.real_name = real_name
+        self._try_register()
+
+    def irc_CAP(self, subcommand, *params):
+        if not self.server.caps:
+            self.reply('421', 'CAP', ':Unknown command')
+            return
+        subcommand = subcommand.upper()
+        if subcommand == 'LS':
+            if not self.registered:
+                self.negotiating = True
+            offered = self.server.caps
+            if params and params[0] >= '302': # Capabilities may have values
+                offered = [cap + '=PLAIN' if cap == 'sasl' else cap
+                        for cap in offered]
+            self.write(':%s CAP %s LS :%s' % (self.server.name,
+                self.nick or '*', ' '.join(offered)))
+        elif subcommand == 'LIST':
+            self.write(':%s CAP %s LIST :%s' % (self.server.name,
+                self.nick or '*', ' '.join(sorted(self.caps))))
+        elif subcommand == 'REQ' and params:
+            requested = params[0].split()
+            if not self.registered:
+                self.negotiating = True
+            if all(cap.lstrip('-') in self.server.caps for cap in requested):
+                for cap in requested:
+                    if cap.startswith('-'):
+                        self.caps.discard(cap[1:])
+                    else:
+                        self.caps.add(cap)
+                reply = 'ACK'
+            else:
+                reply = 'NAK'
+            self.write(':%s CAP %s %s :%s' % (self.server.name,
+                self.nick or '*', reply, params[0]))
+        elif subcommand == 'END':
+            self.negotiating = False
+            self._try_register()
+
+    def irc_AUTHENTICATE(self, data, *rest):
+        if not 'sasl' in self.caps or self.registered:
+            self.reply('904', ':SASL authentication failed')
+        elif data == '*':
+            self.sasl_mechanism = None
+            self.reply('906', ':SASL authentication aborted')
+        elif not self.sasl_mechanism:
+            if data.upper() == 'PLAIN':
+                self.sasl_mechanism = 'PLAIN'
+                self.write('AUTHENTICATE +')
+            else:
+                self.reply('908', 'PLAIN', ':are available SASL mechanisms')
+                self.reply('904', ':SASL authentication failed')
+        else:
+            # Payloads of up to 400 bytes fit into a single line.
+            self.sasl_mechanism = None
+            try:
+                _, account, password = base64.b64decode(data).decode(
+                        'utf-8').split('\0')
+            except (binascii.Error, UnicodeDecodeError, ValueError):
+                account = password = ''
+            if not account or not password:
+                self.reply('904', ':SASL authentication failed')
+                return
+            self.account = account
+            if account == self.nick:
+                self.server.identified.add(self.nick)
+            self.reply('900', self.prefix, account,
+                    ':You are now logged in as %s' % account)
+            self.reply('903', ':SASL authentication successful')
+
+    def irc_PING(self, token='', *rest):
+        self.write(':%s PONG %s :%s' % (self.server.name, self.server.name,
+            token))
+
+    def irc_JOIN(self, channels, *rest):
+        for channel in channels.split(','):
+            if self.nick in self.server.channels.get(channel, ()):
+                continue
+            if not channel in self.server.channels:
+                self.server.operators[channel] = set([self.nick])
+            self.server.channels.setdefault(channel, set()).add(self.nick)
+            line = ':%s JOIN %s' % (self.prefix, channel)
+            extended = '%s %s :%s' % (line, self.account or '*',
+                    self.real_name)
+            for nick in self.server.channels[channel]:
+                member = self.server.users[nick]
+                member.send(extended if 'extended-join' in member.caps else
+                        line, self)
+            self.irc_NAMES(channel)
+
+    def irc_PART(self, channels, message='', *rest):
+        for channel in channels.split(','):
+            if self.nick in self.server.channels.get(channel, ()):
+                self.server.broadcast(channel, ':%s PART %s :%s' % (
+                    self.prefix, channel, message), source=self)
+                self.server.leave(channel, self.nick)
+
+    def irc_NAMES(self, channels='', *rest):
+        for channel in filter(None, channels.split(',')):
+            members = self.server.channels.get(channel, ())
+            operators = self.server.operators.get(channel, ())
+            voiced = self.server.voiced.get(channel, ())
+            if 'multi-prefix' in self.caps:
+                names = sorted(('@' if nick in operators else '') +
+                        ('+' if nick in voiced else '') + nick
+                        for nick in members)
+            else:
+                names = sorted(('@' if nick in operators else
+                    '+' if nick in voiced else '') + nick for nick in members)
+            # Keep the replies well below the line length limit.
+            for start in range(0, len(names), 20):
+                self.reply('353', '=', channel, ':' + ' '.join(
+                    names[start:start + 20]))
+            self.reply('366', channel, ':End of /NAMES list.')
+
+    def _is_operator(self, channel):
+        if self.nick in self.server.operators.get(channel, ()):
+            return True
+        self.reply('482', channel, ":You're not channel operator")
+        return False
+
+    def irc_KICK(self, channel, nick, reason='', *rest):
+        if not nick in self.server.channels.get(channel, ()):
+            self.reply('441', nick, channel, ":They aren't on that channel")
+        elif self._is_operator(channel):
+            self.server.broadcast(channel, ':%s KICK %s %s :%s' % (
+                self.prefix, channel, nick, reason or nick), source=self)
+            self.server.leave(channel, nick)
+
+    def irc_MODE(self, target, modes='', *params):
+        if not target in self.server.channels:
+            return # User modes are not supported.
+        if not modes:
+            self.reply('324', target, '+')
+            return
+        if not self._is_operator(target):
+            return
+        params = list(params)
+        adding = True
+        for mode in modes:
+            if mode in '+-':
+                adding = mode == '+'
+                continue
+            if not mode in 'ov' or not params:
+                self.reply('472', mode, ':is unknown mode char to me')
+                continue
+            nick = params.pop(0)
+            if not nick in self.server.channels[target]:
+                continue
+            ranked = (self.server.operators if mode == 'o' else
+                    self.server.voiced).setdefault(target, set())
+            if adding:
+                ranked.add(nick)
+            else:
+                ranked.discard(nick)
+            self.server.broadcast(target, ':%s MODE %s %s%s %s' % (self.prefix,
+                target, '+' if adding else '-', mode, nick), source=self)
+
+    def irc_PRIVMSG(self, target, message='', *rest):
+        if target.lower() == 'nickserv':
+            self._nickserv(message.split())
+            return
+        self._deliver('PRIVMSG', target, message)
+
+    def irc_NOTICE(self, target, message='', *rest):
+        self._deliver('NOTICE', target, message)
+
+    def irc_AWAY(self, message='', *rest):
+        if message:
+            line = ':%s AWAY :%s' % (self.prefix, message)
+            self.reply('306', ':You have been marked as being away')
+        else:
+            line = ':%s AWAY' % self.prefix
+            self.reply('305', ':You are no longer marked as being away')
+        for peer in self.peers():
+            if 'away-notify' in peer.caps:
+                peer.send(line, self)
+
+    def _deliver(self, command, target, message):
+        line = ':%s %s %s :%s' % (self.prefix, command, target, message)
+        if target in self.server.channels:
+            self.server.broadcast(target, line, exclude=self.nick, source=self)
+        elif target in self.server.users:
+            self.server.users[target].send(line, self)
+        else:
+            self.reply('401', target, ':No such nick/channel')
+
+    def _nickserv(self, params):
+        """Handles a request to the NickServ pseudo-user."""
+        def notice(text):
+            self.write(':%s NOTICE %s :%s' % (NICKSERV_PREFIX, self.nick,
+                text))
+        command = params[0].upper() if params else ''
+        if command == 'IDENTIFY' and len(params) > 1:
+            self.server.identified.add(self.nick)
+            self.account = self.nick
+            notice('You are now identified for %s.' % self.nick)
+            for peer in self.peers():
+                if 'account-notify' in peer.caps:
+                    peer.send(':%s ACCOUNT %s' % (self.prefix, self.account),
+                            self)
+        elif command == 'ACC' and len(params) > 1:
+            status = 3 if params[1] in self.server.identified else 0
+            notice('%s ACC %d' % (params[1], status))
+        else:
+            notice('Unknown command. Use IDENTIFY PASSWORD or ACC NICK.')
+
+    def irc_QUIT(self, message='', *rest):
+        self._leave_all(message)
+        self.transport.close()
@@ -29,6 +29,7 @@ _logdir = 'log'
 _loglevel = logging.ERROR
 _to_stderr = True
 _loggers = dict()
+_forward_queue = None
 
 _default_format = logging.Formatter('%(asctime)s %(levelname)s\t%(message)s')
 _channel_format = logging.Formatter('%(asctime)s %(message)s')
@@ -77,6 +78,21 @@ def set_console_output(value):
     _to_stderr = value
     _clear_loggers()
 
+def set_forwarding(queue):
+    """
+    Instead of writing log messages, put them into the given queue as
+    ('log', severity, message, kwargs) tuples. Used by worker processes to hand
+    their log messages to the supervisor process, which writes them using
+    forward_record. Pass None to write log messages directly again.
+    """
+    global _forward_queue
+    _forward_queue = queue
+
+def forward_record(record):
+    """Writes a log message received from a worker process."""
+    _, severity, message, kwargs = record
+    log(severity, message, **kwargs)
+
 def get_logger(name):
     """Fetches an existing logger or creates a new one, if it doesn't exist."""
     global _loglevel, _logdir, _to_stderr, _default_format, _channel_format
@@ -85,6 +101,9 @@ def get_logger(name):
     # Doesn't exist. Create new one and configure it.
     logger = logging.getLogger(name)
     logger.setLevel(_loglevel)
+    # Only use the handlers below, even if the root logger has been configured,
+    # e.g. by oyoyo.
+    logger.propagate = False
     if name == '__global__':
         path = os.path.join(_logdir, 'global.log')
     else:
@@ -110,6 +129,10 @@ def log(severity, message, **kwargs):
     Common logic for all logging functions. The severity is a lowercase string,
     e.g. debug, info, warning, error, critical.
     """
+    if _forward_queue:
+        if getattr(logging, severity.upper()) >= _loglevel:
+            _forward_queue.put(('log', severity, message, kwargs))
+        return
     try:
         if 'plugin' in kwargs:
             getattr(get_logger(kwargs['plugin']), severity)(message)
@@ -0,0 +1,109 @@
+"""
+Cached descriptions of the available plugins.
+
+Importing and initializing a plugin may be expensive: its module is executed,
+and its storages are opened. The plugin manifest remembers the commands and
+hooks of every plugin which has been loaded before, so that the bot can defer
+loading a plugin until one of its commands is used or one of its hooks is
+triggered.
+
+A manifest entry is valid as long as the modification times of the plugin's
+directory and source file are unchanged.
+"""
+
+from collections import namedtuple
+import inspect
+import json
+import os
+import os.path
+from p1tr.logwrap import *
+from p1tr.plugin import AuthorizationProvider, Plugin
+
+"""Format version of the manifest file. Mismatching files are ignored."""
+MANIFEST_VERSION = 1
+
+"""
+Description of a single plugin:
+* name - The plugin's directory name.
+* source - Path of the plugin's source file.
+* stamp - Modification times of the source file's directory and the file
+  itself, as a list, at the time of the description.
+* commands - Names of the commands provided by the plugin.
+* hooks - Names of the Plugin.on_* hooks the plugin overrides.
+* auth_provider - True if the plugin is an AuthorizationProvider.
+"""
+PluginInfo = namedtuple('PluginInfo', ['name', 'source', 'stamp', 'commands',
+    'hooks', 'auth_provider'])
+
+
+def source_stamp(path):
+    """
+    Returns the modification times of the directory containing path and of
+    path itself as a list, or None if either cannot be accessed.
+    """
+    try:
+        return [os.path.getmtime(os.path.dirname(path) or '.'),
+                os.path.getmtime(path)]
+    except (OSError, TypeError):
+        return None
+
+
+def describe_plugin(name, plugin):
+    """Creates the PluginInfo of a loaded plugin instance."""
+    source = inspect.getsourcefile(type(plugin))
+    commands = []
+    for member_name, member in inspect.getmembers(plugin):
+        annotations = getattr(member, '__annotations__', None)
+        if isinstance(annotations, dict) and annotations.get('command') == True:
+            commands.append(member_name)
+    hooks = [hook for hook in dir(Plugin) if hook.startswith('on_') and
+            getattr(type(plugin), hook) is not getattr(Plugin, hook)]
+    return PluginInfo(name, source, source_stamp(source), commands, hooks,
+            isinstance(plugin, AuthorizationProvider))
+
+
+def is_current(info):
+    """True if the plugin's source has not been modified since describing."""
+    return info.stamp is not None and source_stamp(info.source) == info.stamp
+
+
+def read_manifest(path):
+    """
+    Reads the manifest file at path. Returns a dictionary of PluginInfo
+    tuples by plugin name, which is empty if the file is missing or invalid.
+    """
+    try:
+        with open(path, 'r') as manifest_file:
+            data = json.load(manifest_file)
+        if data.get('version') != MANIFEST_VERSION:
+            return {}
+        return dict((name, PluginInfo(name, **fields))
+                for name, fields in data['plugins'].items())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        warning('Ignoring invalid plugin manifest at %s: %s' % (path, e))
+        return {}
+
+
+def write_manifest(path, infos):
+    """
+    Writes the given dictionary of PluginInfo tuples by plugin name to the
+    manifest file at path. The file is replaced atomically, since several
+    worker processes may write it at the same time.
+    """
+    data = {'version': MANIFEST_VERSION,
+            'plugins': dict((name, info._asdict())
+                for name, info in infos.items())}
+    for fields in data['plugins'].values():
+        del fields['name']
+    temp_path = '%s.%d' % (path, os.getpid())
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(data, manifest_file, indent=1, sort_keys=True)
+        os.replace(temp_path, path)
+    except OSError as e:
+        warning('Unable to write plugin manifest at %s: %s' % (path, e))
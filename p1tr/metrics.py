@@ -0,0 +1,274 @@
+"""
+Timing of plugin hooks and commands.
+
+Every handler the bot calls into a plugin with is wrapped by Metrics.wrap,
+which counts the calls and exceptions, and records the time spent in a
+histogram. The checkpoints of the plugins' storages are recorded likewise.
+The metrics are available through the stats command of the admin plugin, and
+optionally over HTTP in the Prometheus text format (see export_metrics),
+along with the statistics of the storages' caches and of the send queue.
+"""
+
+import asyncio
+from bisect import bisect_left
+from time import perf_counter
+from p1tr.logwrap import *
+
+"""Upper bounds of the latency histogram buckets, in seconds."""
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Series:
+    """
+    Call count, error count and latency histogram of a single hook or command
+    of a plugin. The buckets list has one more entry than BUCKETS, counting
+    the calls slower than the largest bound.
+    """
+
+    __slots__ = ('kind', 'plugin', 'name', 'errors', 'total', 'buckets')
+
+    def __init__(self, kind, plugin, name):
+        self.kind = kind
+        self.plugin = plugin
+        self.name = name
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    @property
+    def count(self):
+        return sum(self.buckets)
+
+    def observe(self, seconds):
+        self.total += seconds
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def quantile(self, fraction):
+        """
+        Returns the upper bound of the bucket containing the given quantile,
+        or None if it lies beyond the largest bound.
+        """
+        threshold = self.count * fraction
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return None
+
+
+class Metrics:
+    """
+    Collection of all series of one bot instance. If enabled is False, wrap
+    returns the functions unchanged and nothing is recorded.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.series = {} # Series by (kind, plugin, name)
+        # Returns the CacheInfo of the plugins' storages by (plugin,
+        # identifier); set by the bot.
+        self.storage_caches = dict
+        # Returns the statistics of the send queue by lane name, see
+        # p1tr.sendqueue.SendQueue.stats; set by the bot.
+        self.send_queue = dict
+
+    def get_series(self, kind, plugin, name):
+        key = (kind, plugin, name)
+        if not key in self.series:
+            self.series[key] = Series(kind, plugin, name)
+        return self.series[key]
+
+    def wrap(self, kind, plugin, name, func):
+        """
+        Returns a function which calls func and records the call in the
+        series of the given kind ('hook' or 'command'), plugin name and hook
+        or command name. Exceptions are counted and passed on.
+        """
+        if not self.enabled:
+            return func
+        series = self.get_series(kind, plugin, name)
+        buckets = series.buckets
+        # This runs for every event and plugin, so observe is inlined.
+        def timed(*args):
+            start = perf_counter()
+            try:
+                result = func(*args)
+            except Exception:
+                series.errors += 1
+                series.observe(perf_counter() - start)
+                raise
+            elapsed = perf_counter() - start
+            series.total += elapsed
+            buckets[bisect_left(BUCKETS, elapsed)] += 1
+            return result
+        return timed
+
+    def plugin_totals(self):
+        """
+        Returns the number of calls, the number of errors, and the total time
+        spent in hooks and commands for each plugin, as tuples in a dictionary
+        by plugin name.
+        """
+        totals = {}
+        for series in self.series.values():
+            if series.kind == 'checkpoint':
+                continue
+            count, errors, total = totals.get(series.plugin, (0, 0, 0.0))
+            totals[series.plugin] = (count + series.count,
+                    errors + series.errors, total + series.total)
+        return totals
+
+
+def _label(value):
+    """Escapes a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+            '\\n')
+
+
+def prometheus_text(sources):
+    """
+    Renders the metrics of all given bot instances in the Prometheus text
+    exposition format. The sources are a dictionary of Metrics instances by
+    server identifier.
+    """
+    histogram = ['# HELP p1tr_handler_seconds Time spent in plugin hooks, \
+commands and storage checkpoints.', '# TYPE p1tr_handler_seconds histogram']
+    errors = ['# HELP p1tr_handler_errors_total Exceptions raised by plugin \
+hooks and commands, and failed checkpoint writes.',
+        '# TYPE p1tr_handler_errors_total counter']
+    for server, metrics in sorted(sources.items()):
+        for key in sorted(metrics.series):
+            series = metrics.series[key]
+            labels = 'server="%s",plugin="%s",kind="%s",name="%s"' % (
+                    _label(server), _label(series.plugin), series.kind,
+                    _label(series.name))
+            cumulative = 0
+            for bound, count in zip(BUCKETS, series.buckets):
+                cumulative += count
+                histogram.append('p1tr_handler_seconds_bucket{%s,le="%s"} %d'
+                        % (labels, bound, cumulative))
+            histogram.append('p1tr_handler_seconds_bucket{%s,le="+Inf"} %d' %
+                    (labels, series.count))
+            histogram.append('p1tr_handler_seconds_sum{%s} %r' % (labels,
+                series.total))
+            histogram.append('p1tr_handler_seconds_count{%s} %d' % (labels,
+                series.count))
+            errors.append('p1tr_handler_errors_total{%s} %d' % (labels,
+                series.errors))
+    return '\n'.join(histogram + errors + _storage_cache_text(sources) +
+            _send_queue_text(sources)) + '\n'
+
+
+def _storage_cache_text(sources):
+    """Renders the cache statistics of the plugins' storages."""
+    lines = []
+    caches = dict((server, metrics.storage_caches())
+            for server, metrics in sources.items())
+    for field, metric, kind, help_text in (
+            ('hits', 'p1tr_storage_cache_hits_total', 'counter',
+                'Storage reads served from the cache.'),
+            ('misses', 'p1tr_storage_cache_misses_total', 'counter',
+                'Storage reads from disk.'),
+            ('evictions', 'p1tr_storage_cache_evictions_total', 'counter',
+                'Values evicted from storage caches.'),
+            ('currsize', 'p1tr_storage_cache_entries', 'gauge',
+                'Values in storage caches.')):
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for server in sorted(caches):
+            for (plugin, identifier), info in sorted(caches[server].items()):
+                lines.append('%s{server="%s",plugin="%s",storage="%s"} %d' % (
+                    metric, _label(server), _label(plugin),
+                    _label(identifier), getattr(info, field)))
+    return lines
+
+
+def _send_queue_text(sources):
+    """Renders the statistics of the send queues' lanes."""
+    lines = []
+    queues = dict((server, metrics.send_queue())
+            for server, metrics in sources.items())
+    for field, metric, kind, help_text in (
+            ('depth', 'p1tr_send_queue_lines', 'gauge',
+                'Lines waiting in the send queue.'),
+            ('sent', 'p1tr_send_queue_sent_total', 'counter',
+                'Lines sent through the send queue.'),
+            ('dropped', 'p1tr_send_queue_dropped_total', 'counter',
+                'Queued lines dropped when the connection was lost.'),
+            ('total_wait', 'p1tr_send_queue_wait_seconds_total', 'counter',
+                'Time sent lines waited in the send queue.'),
+            ('max_wait', 'p1tr_send_queue_max_wait_seconds', 'gauge',
+                'Longest time a sent line waited in the send queue.')):
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for server in sorted(queues):
+            for lane, stats in sorted(queues[server].items()):
+                lines.append('%s{server="%s",lane="%s"} %r' % (metric,
+                    _label(server), lane, stats[field]))
+    return lines
+
+
+class MetricsExporter(asyncio.Protocol):
+    """
+    Answers HTTP GET requests for /metrics with the metrics of the registered
+    sources. One instance serves each connection; the sources dictionary is
+    shared by all of them.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self.transport = None
+        self._buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._buffer += data
+        if not b'\r\n\r\n' in self._buffer and not b'\n\n' in self._buffer:
+            if len(self._buffer) > 8192:
+                self.transport.close()
+            return
+        request = self._buffer.split(b'\n', 1)[0].decode('latin-1').split()
+        if len(request) >= 2 and request[0] == 'GET' and \
+                request[1].split('?')[0] == '/metrics':
+            self._respond('200 OK', prometheus_text(self.sources),
+                    'text/plain; version=0.0.4')
+        else:
+            self._respond('404 Not Found', 'Not found.\n', 'text/plain')
+
+    def _respond(self, status, body, content_type):
+        body = body.encode('utf-8')
+        self.transport.write(('HTTP/1.0 %s\r\nContent-Type: %s\r\n'
+            'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status,
+                content_type, len(body))).encode('latin-1') + body)
+        self.transport.close()
+
+
+"""Metrics sources of the running exporters, by (host, port)."""
+_exporters = {}
+
+def export_metrics(loop, host, port, server, metrics):
+    """
+    Makes the given Metrics instance of the bot connected to server available
+    over HTTP at http://host:port/metrics. Bot instances of one process using
+    the same address share a listening socket.
+    """
+    address = (host, port)
+    if address in _exporters:
+        _exporters[address][server] = metrics
+        return
+    sources = {server: metrics}
+    _exporters[address] = sources
+    def _started(task):
+        if task.exception():
+            error('Unable to serve metrics at %s:%d: %s' % (host, port,
+                task.exception()))
+            del _exporters[address]
+        else:
+            info('Serving metrics at http://%s:%d/metrics' % address)
+    task = loop.create_task(loop.create_server(
+        lambda: MetricsExporter(sources), host, port))
+    task.add_done_callback(_started)
@@ -1,23 +1,93 @@
-from oyoyo.client import IRCClient
-from oyoyo.client import IRCApp
 from oyoyo.cmdhandler import DefaultCommandHandler
 from oyoyo import helpers
 
 import argparse
+from collections import namedtuple
 import configparser
+import functools
 import inspect
 import logging
 import os
 import os.path
+import shutil
 import sys
+from time import perf_counter
+from types import MappingProxyType, MethodType
 sys.path.insert(0, os.getcwd())
 
+from p1tr.capture import run_replay, TrafficRecorder
+from p1tr.channels import ChannelTracker
 from p1tr.config import config_wizard, read_or_default, load_config
-from p1tr.helpers import BotError
+from p1tr.connection import IRCConnection, serve
+from p1tr.event import Event, HOOK_FIELDS, LEGACY_ARGUMENTS, NO_TAGS
+from p1tr.helpers import boolify, BotError
 from p1tr.logwrap import *
+from p1tr.manifest import describe_plugin, is_current, read_manifest, \
+        write_manifest
+from p1tr.metrics import Metrics, export_metrics
 from p1tr.plugin import *
+from p1tr.storage import BACKENDS as STORAGE_BACKENDS, DEFAULT_BACKEND, \
+        MAX_CACHED
+from p1tr.supervisor import Supervisor, server_sections
 from p1tr.test import run_tests
 
+"""
+Rank annotations a command may carry, ordered from the most to the least
+privileged. If a command carries more than one, the first one listed here wins.
+"""
+RANKS = ('master', 'owner', 'op', 'hop', 'voice', 'authenticated')
+
+"""
+Everything needed to run a command, resolved once at plugin load time:
+the plugin instance, the bound command method, the required rank (or None),
+and the authorizer method of the authorization provider for that rank (or
+None, if the command may be executed right away).
+"""
+CommandEntry = namedtuple('CommandEntry',
+        ['plugin', 'method', 'rank', 'authorizer'])
+
+"""Names of all event hooks a plugin may override."""
+HOOKS = tuple(name for name in dir(Plugin) if name.startswith('on_'))
+
+
+def _source_state(path):
+    """
+    Returns the given path of a source file and its modification time, which
+    is None if the file cannot be accessed.
+    """
+    try:
+        return (path, os.path.getmtime(path))
+    except (OSError, TypeError):
+        return (path, None)
+
+
+def _copy_shared_data(shared_path, path):
+    """
+    Copies the files a plugin kept in shared_path, before its storages were
+    namespaced, to the namespaced path, unless that exists already. Every
+    namespace gets its own copy. Raises PluginError if copying fails.
+    """
+    if os.path.exists(path) or not os.path.isdir(shared_path):
+        return
+    names = [name for name in os.listdir(shared_path)
+            if not name.endswith('.lock') and
+            os.path.isfile(os.path.join(shared_path, name))]
+    if not names:
+        return
+    # Copied into place at once, so an interrupted copy is started over.
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.makedirs(temporary)
+        for name in names:
+            shutil.copy2(os.path.join(shared_path, name), temporary)
+        os.rename(temporary, path)
+    except OSError as e:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise PluginError('Unable to copy %s to %s: %s' % (shared_path, path,
+            e))
+    warning('Copied the data in %s to %s, since several servers are \
+configured. The old files are no longer used.' % (shared_path, path))
+
 
 class BotHandler(DefaultCommandHandler):
 
@@ -28,6 +98,21 @@ class BotHandler(DefaultCommandHandler):
     """
     commands = dict()
 
+    """
+    Read-only mapping of command names to CommandEntry tuples. Built by
+    load_plugins, so that dispatching a command is a single lookup.
+    """
+    dispatch = MappingProxyType({})
+
+    """
+    Read-only mapping of hook names (see HOOKS) to tuples of handlers for all
+    plugins overriding that hook. Plugins keeping the no-op default of a hook
+    are never called for the corresponding event. The handlers of the hooks in
+    p1tr.event.HOOK_FIELDS take a single Event; the others take the
+    positional arguments documented in Plugin.
+    """
+    subscribers = MappingProxyType(dict((hook, ()) for hook in HOOKS))
+
     """
     One plugin should serve as the authorization provider. The first
     non-blacklisted plugin is used.
@@ -37,11 +122,92 @@ class BotHandler(DefaultCommandHandler):
     """Set to True if the P1tr instance on this server should be terminated."""
     intended_disconnect = False
 
-    """Temporary storage for loading nicklists for channels."""
-    nicks = {}
+    """
+    Members and their prefixes of the channels the bot is in, as a
+    p1tr.channels.ChannelTracker. It is updated before the plugins are
+    notified of joins and mode changes, and after they were notified of
+    users leaving or renaming themselves, so they can still look up where
+    those users were.
+    """
+    channels = None
+
+    """
+    IRCv3 message tags of the line being handled, as a read-only mapping.
+    Set by the connection.
+    """
+    tags = NO_TAGS
+
+    """Identifier of this connection's server, as passed to the plugins."""
+    server = ''
+
+    """
+    If set, the plugins' storages are kept in a sub-directory of this name
+    within their data directories. Set to the server section if several are
+    configured, so that no two connections share a storage file, whether they
+    are served by one process or by workers.
+    """
+    storage_namespace = ''
+
+    """Backend of the plugins' storages; see p1tr.storage."""
+    storage_backend = DEFAULT_BACKEND
+
+    """Number of values each of the plugins' storages keeps cached."""
+    storage_cache_size = MAX_CACHED
+
+    """
+    Source file path and modification time of each loaded plugin's module, by
+    plugin name. Used to detect modified plugins.
+    """
+    plugin_files = dict()
+
+    """
+    Seconds between two checks for modified plugins, which are reloaded
+    automatically. 0 disables the checks.
+    """
+    plugin_watch_interval = 0
+    _plugin_watch = None
+
+    """
+    Seconds between two checkpoints, which write the changes of the plugins'
+    storages to disk in the background. 0 disables checkpoints, so that the
+    storages are only written on exit.
+    """
+    checkpoint_interval = 60
+    _checkpoint_timer = None
+
+    """
+    Descriptions of all available plugins, loaded or not, as PluginInfo
+    tuples (see p1tr.manifest) by plugin name.
+    """
+    manifest = dict()
+
+    """
+    Commands of the plugins whose loading was deferred, mapped to the names of
+    the providing plugins.
+    """
+    lazy_commands = dict()
+
+    """
+    If True, plugins described by an up-to-date plugin manifest are only
+    loaded once one of their commands or hooks is used.
+    """
+    lazy_plugins = True
+
+    """
+    Call counts and latencies of the plugins' hooks and commands; see
+    p1tr.metrics. Recording is skipped if metrics_enabled is False. If
+    metrics_port is set, they are served over HTTP at
+    metrics_host:metrics_port.
+    """
+    metrics = None
+    metrics_enabled = True
+    metrics_host = '127.0.0.1'
+    metrics_port = 0
 
     def load_config(self, config):
         self.config = config
+        self.server = '%s:%d' % (self.client.host, self.client.port)
+        self.channels = ChannelTracker()
         self.home = self.config.get('General', 'home') or ''
         info('Bot home: ' + self.home)
         self.global_plugin_blacklist = self.config.get('General',
@@ -52,47 +218,456 @@ class BotHandler(DefaultCommandHandler):
         info('Signal character: ' + self.signal_character)
         self.master = read_or_default(self.config, self.client.host, 'master',
                 '')
+        self.plugin_watch_interval = read_or_default(self.config, 'General',
+                'plugin_watch_interval', 0, float)
+        self.lazy_plugins = read_or_default(self.config, 'General',
+                'lazy_plugins', True, boolify)
+        self.metrics_enabled = read_or_default(self.config, 'General',
+                'metrics', True, boolify)
+        self.metrics_host = read_or_default(self.config, self.client.host,
+                'metrics_host', read_or_default(self.config, 'General',
+                    'metrics_host', '127.0.0.1'))
+        self.metrics_port = read_or_default(self.config, self.client.host,
+                'metrics_port', read_or_default(self.config, 'General',
+                    'metrics_port', 0, int), int)
+        self.checkpoint_interval = read_or_default(self.config, 'General',
+                'checkpoint_interval', 60, float)
+        self.storage_backend = read_or_default(self.config, 'General',
+                'storage_backend', DEFAULT_BACKEND)
+        if not self.storage_backend in STORAGE_BACKENDS:
+            warning('Unknown storage backend %s; using %s.' % (
+                self.storage_backend, DEFAULT_BACKEND))
+            self.storage_backend = DEFAULT_BACKEND
+        self.storage_cache_size = read_or_default(self.config, 'General',
+                'storage_cache_size', MAX_CACHED, int)
 
     def load_plugins(self):
         """
         Loads all plugins that are not blacklisted globally.
         Search order: extra_path -> $workingDir/plugins -> $p1trHome/plugins ->
             $installDir/plugins
+
+        If lazy_plugins is set, plugins which are described in the plugin
+        manifest and have not been modified since are not loaded yet; see
+        get_plugin. Authorization providers are always loaded right away.
         """
+        # Each connection gets its own plugin instances; do not share the
+        # class-level defaults between servers.
+        self.plugins = dict()
+        self.commands = dict()
+        self.plugin_files = dict()
+        self.manifest = dict()
+        self.lazy_commands = dict()
+        self.metrics = Metrics(self.metrics_enabled)
+        self.metrics.storage_caches = self.storage_cache_info
+        self.metrics.send_queue = self.send_queue_stats
+        manifest_path = os.path.join(self.home, 'data', 'plugins.manifest')
+        cached = read_manifest(manifest_path) if self.lazy_plugins else {}
         for plugin_dir_name in discover_plugins(self.config):
+            plugin_info = cached.get(plugin_dir_name)
+            if plugin_info and is_current(plugin_info) and not \
+                    (plugin_info.auth_provider and not self.auth_provider):
+                debug('Deferring loading plugin ' + plugin_dir_name + '.')
+                self.manifest[plugin_dir_name] = plugin_info
+                for name in plugin_info.commands:
+                    self.lazy_commands[name] = plugin_dir_name
+                continue
             try:
-                debug('Trying to load plugin ' + plugin_dir_name + '...')
-                this_plugin = load_by_name(plugin_dir_name)
-                # If this is a meta plugin, add the bot attribute:
-                if hasattr(this_plugin, '__annotations__') and \
-                        this_plugin.__annotations__['meta_plugin']:
-                    debug(plugin_dir_name + ' is a meta plugin.')
-                    this_plugin.bot = self
-                # Register as authorization provider, if possible:
-                if not self.auth_provider and \
-                        isinstance(this_plugin, AuthorizationProvider):
-                    self.auth_provider = this_plugin
-                    info('Authorization provider: ' + plugin_dir_name)
-                # Set data storage path:
-                this_plugin.data_path = os.path.join(self.home, 'data',
-                        plugin_dir_name)
-                # Scan for command methods:
-                for member in inspect.getmembers(this_plugin):
-                    try:
-                        if member[1].__annotations__['command'] == True:
-                            self.commands[member[0]] = this_plugin
-                            debug('Registered command ' + member[0] +
-                                    ' for plugin ' + plugin_dir_name)
-                    except (AttributeError, KeyError): pass # Not a command
-
-                self.plugins[plugin_dir_name] = this_plugin
-                self.plugins[plugin_dir_name].initialize()
-                # Load plugin-specific settings
-                this_plugin.load_settings(self.config)
-                info('Plugin ' + plugin_dir_name + ' was loaded.')
+                plugin = self.load_plugin(plugin_dir_name)
+                self.manifest[plugin_dir_name] = describe_plugin(
+                        plugin_dir_name, plugin)
             except PluginError as pe:
                 error('Plugin ' + plugin_dir_name +
                         ' could not be loaded: ' + str(pe))
+        if self.lazy_plugins:
+            updated = dict(cached)
+            updated.update(self.manifest)
+            if updated != cached:
+                write_manifest(manifest_path, updated)
+        self._build_dispatch_table()
+        self._build_subscriber_index()
+
+    def get_plugin(self, plugin_name):
+        """
+        Returns the instance of the named plugin, loading it first if loading
+        was deferred. Returns None if there is no such plugin, or if it cannot
+        be loaded.
+        """
+        if plugin_name in self.plugins:
+            return self.plugins[plugin_name]
+        if not plugin_name in self.manifest:
+            return None
+        changed = self._forget_lazy_commands(plugin_name)
+        try:
+            plugin = self.load_plugin(plugin_name)
+        except PluginError as pe:
+            error('Plugin ' + plugin_name + ' could not be loaded: ' + str(pe))
+            del self.manifest[plugin_name]
+            plugin = None
+        self._build_dispatch_table(changed)
+        self._build_subscriber_index()
+        return plugin
+
+    def get_command(self, name):
+        """
+        Returns the CommandEntry of the named command, loading the providing
+        plugin first if necessary. Returns None if there is no such command.
+        """
+        entry = self.dispatch.get(name)
+        if not entry and name in self.lazy_commands:
+            self.get_plugin(self.lazy_commands[name])
+            entry = self.dispatch.get(name)
+        return entry
+
+    def _forget_lazy_commands(self, plugin_name):
+        """
+        Removes the deferred commands of a plugin which is about to be loaded.
+        Returns their names.
+        """
+        names = [name for name, owner in self.lazy_commands.items()
+                if owner == plugin_name]
+        for name in names:
+            del self.lazy_commands[name]
+        return names
+
+    def load_plugin(self, plugin_dir_name, fresh=False):
+        """
+        Loads and initializes a single plugin and registers its commands. If
+        fresh is True, the plugin's module is imported again. Raises
+        PluginError on failure, in which case nothing is registered.
+
+        The dispatch table and the subscriber index are not updated; this is
+        left to the caller.
+        """
+        debug('Trying to load plugin ' + plugin_dir_name + '...')
+        this_plugin = self._import_plugin(plugin_dir_name, fresh)
+        self._start_plugin(plugin_dir_name, this_plugin)
+        self._register_plugin(plugin_dir_name, this_plugin)
+        info('Plugin ' + plugin_dir_name + ' was loaded.')
+        return this_plugin
+
+    def _import_plugin(self, plugin_dir_name, fresh=False):
+        """
+        Creates an instance of the named plugin and records the state of its
+        source file. Raises PluginError if the module cannot be imported.
+        """
+        this_plugin = load_by_name(plugin_dir_name, fresh)
+        self.plugin_files[plugin_dir_name] = _source_state(
+                inspect.getsourcefile(type(this_plugin)))
+        return this_plugin
+
+    def _start_plugin(self, plugin_dir_name, this_plugin):
+        """
+        Injects the bot and the storage settings into a plugin instance, then
+        initializes it and loads its settings. If this fails, the storages the
+        plugin opened are closed again, and PluginError is raised.
+        """
+        # If this is a meta plugin, add the bot attribute:
+        if getattr(this_plugin, '__annotations__', {}).get('meta_plugin'):
+            debug(plugin_dir_name + ' is a meta plugin.')
+            this_plugin.bot = self
+        # Set data storage path:
+        this_plugin.data_path = os.path.join(self.home, 'data',
+                plugin_dir_name)
+        if self.storage_namespace:
+            shared_path = this_plugin.data_path
+            this_plugin.data_path = os.path.join(shared_path,
+                    self.storage_namespace)
+            _copy_shared_data(shared_path, this_plugin.data_path)
+        this_plugin.storage_backend = self.storage_backend
+        this_plugin.storage_cache_size = self.storage_cache_size
+        try:
+            this_plugin.initialize()
+            # Load plugin-specific settings
+            this_plugin.load_settings(self.config)
+        except Exception as e:
+            this_plugin.close_all_storages()
+            if isinstance(e, PluginError):
+                raise
+            raise PluginError('Plugin "%s" could not be initialized: %s: %s'
+                    % (plugin_dir_name, e.__class__.__name__, e))
+
+    def _register_plugin(self, plugin_dir_name, this_plugin):
+        """
+        Registers an initialized plugin and its commands. The plugin becomes
+        the authorization provider if there is none yet and it is able to.
+        """
+        if not self.auth_provider and \
+                isinstance(this_plugin, AuthorizationProvider):
+            self.auth_provider = this_plugin
+            info('Authorization provider: ' + plugin_dir_name)
+        # Scan for command methods:
+        for member in inspect.getmembers(this_plugin):
+            try:
+                if member[1].__annotations__['command'] == True:
+                    self.commands[member[0]] = this_plugin
+                    debug('Registered command ' + member[0] +
+                            ' for plugin ' + plugin_dir_name)
+            except (AttributeError, KeyError): pass # Not a command
+        self.plugins[plugin_dir_name] = this_plugin
+
+    def _unregister_plugin(self, plugin_name):
+        """
+        Removes a plugin and its commands from the registry. Returns the names
+        of the removed commands.
+        """
+        plugin = self.plugins.pop(plugin_name)
+        removed = [name for name, owner in self.commands.items()
+                if owner is plugin]
+        for name in removed:
+            del self.commands[name]
+        if self.auth_provider is plugin:
+            self.auth_provider = None
+        return removed
+
+    def unload_plugin(self, plugin_name):
+        """
+        Terminates a plugin, closes its storages and unregisters its commands.
+        Returns the names of the removed commands. Like load_plugin, this does
+        not update the dispatch table and the subscriber index.
+        """
+        plugin = self.plugins[plugin_name]
+        plugin.on_quit()
+        plugin.close_all_storages()
+        removed = self._unregister_plugin(plugin_name)
+        info('Plugin ' + plugin_name + ' was unloaded.')
+        return removed
+
+    def reload_plugin(self, plugin_name):
+        """
+        Replaces a plugin with a new instance from its freshly imported module,
+        without disconnecting. Storages are closed and opened again. Only the
+        dispatch table entries of the plugin's commands are rebuilt, unless
+        the authorization provider changes.
+
+        The old instance stays registered until the new one is initialized,
+        so no command is ever dispatched without its authorizer. Raises
+        PluginError if the plugin was never loaded, or if it cannot be loaded
+        again; in the latter case, the old instance is initialized again and
+        kept.
+        """
+        if not plugin_name in self.plugin_files and \
+                not plugin_name in self.manifest:
+            raise PluginError('Plugin "%s" is not loaded.' % plugin_name)
+        old = self.plugins.get(plugin_name)
+        plugin = self._import_plugin(plugin_name, fresh=True)
+        if old:
+            # The new instance opens the same storages.
+            old.on_quit()
+            old.close_all_storages()
+        try:
+            self._start_plugin(plugin_name, plugin)
+        except PluginError:
+            if old:
+                self._restore_plugin(plugin_name, old)
+            raise
+        changed = self._forget_lazy_commands(plugin_name)
+        auth_changed = False
+        if old:
+            auth_changed = self.auth_provider is old
+            changed += self._unregister_plugin(plugin_name)
+        self._register_plugin(plugin_name, plugin)
+        auth_changed = auth_changed or self.auth_provider is plugin
+        self.manifest[plugin_name] = describe_plugin(plugin_name, plugin)
+        changed += [name for name, owner in self.commands.items()
+                if owner is plugin]
+        if auth_changed: # All authorizers are replaced.
+            self._build_dispatch_table()
+        else:
+            self._build_dispatch_table(changed)
+        self._build_subscriber_index()
+        info('Plugin ' + plugin_name + ' was reloaded.')
+
+    def _restore_plugin(self, plugin_name, plugin):
+        """
+        Initializes the old instance of a plugin whose reload failed again. If
+        even that fails, the plugin is unloaded.
+        """
+        try:
+            self._start_plugin(plugin_name, plugin)
+            info('Plugin %s was restored.' % plugin_name)
+        except PluginError as pe:
+            error('Plugin %s could not be restored: %s' % (plugin_name, pe))
+            self._unregister_plugin(plugin_name)
+            self._build_dispatch_table()
+            self._build_subscriber_index()
+
+    def _watch_plugins(self):
+        """
+        Reloads all plugins whose source files changed since they were
+        loaded, then schedules the next check.
+        """
+        for plugin_name, state in list(self.plugin_files.items()):
+            current = _source_state(state[0])
+            if current == state:
+                continue
+            info('Plugin %s was modified. Reloading...' % plugin_name)
+            try:
+                self.reload_plugin(plugin_name)
+            except PluginError as pe:
+                # Do not retry until the file changes again.
+                self.plugin_files[plugin_name] = current
+                error('Plugin %s could not be reloaded: %s' % (plugin_name,
+                    pe))
+        self._plugin_watch = self.client.call_later(
+                self.plugin_watch_interval, self._watch_plugins)
+
+    def _checkpoint(self, plugins=None):
+        """
+        Checkpoints the storages of all loaded plugins, one plugin per
+        iteration of the event loop, so that events are handled in between.
+        Then schedules the next checkpoint.
+
+        The time spent is recorded in the checkpoint metrics of each plugin:
+        "collect" for the changes being gathered on the event loop, and one
+        series per storage for its write in the background.
+        """
+        if plugins is None:
+            plugins = list(self.plugins.items())
+        if not plugins:
+            self._checkpoint_timer = self.client.call_later(
+                    self.checkpoint_interval, self._checkpoint)
+            return
+        plugin_name, plugin = plugins.pop()
+        start = perf_counter()
+        writes = plugin.checkpoint_storages()
+        if writes is None:
+            writes = []
+        elif self.metrics.enabled:
+            self.metrics.get_series('checkpoint', plugin_name,
+                    'collect').observe(perf_counter() - start)
+        for identifier, future in writes:
+            future.add_done_callback(functools.partial(self._write_done,
+                plugin_name, identifier))
+        self._checkpoint_timer = self.client.call_later(0, self._checkpoint,
+                plugins)
+
+    def storage_cache_info(self):
+        """
+        Returns the p1tr.storage.CacheInfo of every open storage of the loaded
+        plugins, in a dictionary by (plugin name, identifier).
+        """
+        return dict(((plugin_name, identifier), cache_info)
+                for plugin_name, plugin in self.plugins.items()
+                for identifier, cache_info in
+                    plugin.storage_cache_info().items())
+
+    def send_queue_stats(self):
+        """
+        Returns the statistics of the connection's send queue by lane name;
+        see p1tr.sendqueue.SendQueue.stats. The dictionary is empty if the
+        connection has no send queue (yet).
+        """
+        send_queue = getattr(self.client, 'send_queue', None)
+        return send_queue.stats() if send_queue else {}
+
+    def _write_done(self, plugin_name, identifier, future):
+        """Called in the writer thread; passes the result on to _written."""
+        try:
+            self.client.loop.call_soon_threadsafe(self._written, plugin_name,
+                    identifier, future)
+        except RuntimeError:
+            pass # The event loop was closed on exit.
+
+    def _written(self, plugin_name, identifier, future):
+        """Records a background write of a checkpoint in the metrics."""
+        if not self.metrics.enabled:
+            return
+        series = self.metrics.get_series('checkpoint', plugin_name,
+                identifier)
+        if future.exception():
+            series.errors += 1 # Logged by the storage.
+        else:
+            series.observe(future.result())
+
+    def _build_dispatch_table(self, names=None):
+        """
+        Resolves the method, required rank and authorizer of every registered
+        command ahead of time. Must be called whenever the commands dictionary
+        or the authorization provider change. If only some commands changed,
+        their names may be given, so that only their entries are replaced.
+        """
+        if names is None:
+            table = {}
+            names = self.commands.keys()
+        else:
+            table = dict(self.dispatch)
+        for name in names:
+            table.pop(name, None)
+            if name in self.commands:
+                table[name] = self._make_command_entry(name,
+                        self.commands[name])
+        self.dispatch = MappingProxyType(table)
+
+    def _make_command_entry(self, name, plugin):
+        """
+        Builds the CommandEntry of the command name, provided by plugin. The
+        entry's method is timed.
+        """
+        method = getattr(plugin, name)
+        annotations = getattr(method, '__annotations__', {})
+        rank = None
+        for candidate in RANKS:
+            if 'require_' + candidate in annotations:
+                rank = candidate
+                break
+        authorizer = None
+        if rank and self.auth_provider:
+            authorizer = getattr(self.auth_provider, 'authorize_' + rank)
+        return CommandEntry(plugin, self.metrics.wrap('command',
+            type(plugin).__name__.lower(), name, method), rank, authorizer)
+
+    def _build_subscriber_index(self):
+        """
+        Determines which plugins override which Plugin.on_* hooks. Must be
+        called whenever the plugins dictionary changes. Plugins whose loading
+        was deferred are subscribed with a handler which loads them first;
+        they are not loaded just to be notified of on_quit.
+        """
+        index = {}
+        deferred = [plugin_info for name, plugin_info in self.manifest.items()
+                if not name in self.plugins]
+        for hook in HOOKS:
+            default = getattr(Plugin, hook)
+            handlers = [self._make_handler(plugin, hook)
+                    for plugin in self.plugins.values()
+                    if getattr(type(plugin), hook, default) is not default]
+            if hook != 'on_quit':
+                handlers += [functools.partial(self._load_and_call,
+                    plugin_info.name, hook)
+                    for plugin_info in deferred if hook in plugin_info.hooks]
+            index[hook] = tuple(handlers)
+            debug('Subscribers of %s: %d' % (hook, len(index[hook])))
+        self.subscribers = MappingProxyType(index)
+
+    def _make_handler(self, plugin, hook):
+        """
+        Returns the callable invoked for the hook of the plugin. Hooks taking
+        events are called directly, bypassing the positional-argument shim
+        of the event_hook decorator. Hooks which could take events, but still
+        use positional arguments, are wrapped to unpack the event. All
+        handlers are timed.
+        """
+        method = getattr(plugin, hook)
+        annotations = getattr(method, '__annotations__', {})
+        if not hook in HOOK_FIELDS:
+            handler = method
+        elif 'event_hook' in annotations:
+            handler = MethodType(annotations['event_hook'], plugin)
+        else:
+            to_arguments = LEGACY_ARGUMENTS[hook]
+            handler = lambda event: method(*to_arguments(event))
+        return self.metrics.wrap('hook', type(plugin).__name__.lower(), hook,
+                handler)
+
+    def _load_and_call(self, plugin_name, hook, *args):
+        """
+        Handler of a hook of a plugin whose loading was deferred. Loads the
+        plugin and passes the call on to it.
+        """
+        plugin = self.get_plugin(plugin_name)
+        if plugin:
+            return self._make_handler(plugin, hook)(*args)
 
     def _for_each_plugin(self, func):
         """
@@ -102,159 +677,202 @@ class BotHandler(DefaultCommandHandler):
         for plugin_name in self.plugins:
             func(self.plugins[plugin_name])
 
+    def _notify(self, hook, *args):
+        """
+        Calls the given hook with the given arguments on all plugins
+        subscribed to it.
+        """
+        for handler in self.subscribers[hook]:
+            handler(*args)
+
+    def _event(self, channel, prefix, message='', source=None):
+        """
+        Creates the Event of the line being handled. If the server tags
+        messages with accounts, the account of the sender is recorded.
+
+        If the event is about another user than the sender, like the target
+        of a kick, prefix is that user's and source the sender's. The account
+        tag belongs to the sender then, so the event carries no account.
+        """
+        event = Event.create(self.server, channel, prefix, message, self.tags)
+        sender = event.nick
+        if source is not None:
+            sender = source.split('!')[0]
+            event = event._replace(account=None)
+        if 'account-tag' in self.client.caps:
+            self.channels.set_account(sender, self.tags.get('account'))
+        return event
+
     def privmsg(self, nick, chan, msg):
+        msg = msg.decode()
         # Check if this is actually a PRIVMSG, not an action.
-        if msg.decode().startswith('\x01ACTION'):
-            self.action(nick, chan, msg)
+        if msg.startswith('\x01ACTION'):
+            self._notify('on_useraction', self._event(chan.decode(),
+                nick.decode(), ' '.join(msg.split()[1:])))
             return
         # Regular PRIVMSG from here onwarts
-        def _plugin_handler(plugin):
-            ret_val = plugin.on_privmsg('%s:%d' % (self.client.host,
-                self.client.port), chan.decode(), nick.decode(),
-                msg.decode())
+        event = self._event(chan.decode(), nick.decode(), msg)
+        nick = event.prefix
+        chan = event.channel
+        for handler in self.subscribers['on_privmsg']:
+            ret_val = handler(event)
             if isinstance(ret_val, str) and len(ret_val) > 0:
-                self.client.send('PRIVMSG', chan, ':' + ret_val)
-        self._for_each_plugin(_plugin_handler)
+                self.client.send('PRIVMSG', chan, ':' + ret_val,
+                        priority=PRIORITY_HIGH)
         # Check for commands
         try:
-            cmd = ''
-            args = []
-            msg = msg.decode()
-            if chan.decode() == self.client.nick:
-                respond_to = nick.decode().split('!')[0]
+            if chan == self.client.nick:
+                respond_to = event.nick
             else:
-                respond_to = chan.decode()
+                respond_to = chan
             if msg.startswith(self.signal_character):
-                parts = msg.replace(self.signal_character, '').split(' ')
+                parts = msg[len(self.signal_character):].split(' ')
                 cmd = parts[0]
                 args = parts[1:]
             elif msg.startswith(self.client.nick):
                 parts = msg.replace(self.client.nick, '', 1).split(' ')
                 cmd = parts[1]
                 args = parts[2:]
-            elif chan.decode() == self.client.nick: # In case of query
+            elif chan == self.client.nick: # In case of query
                 parts = msg.split(' ')
                 cmd = parts[0]
                 args = parts[1:]
             else:
                 return
             # Attempt to issue command, silently fail if this is not one.
-            if cmd not in self.commands: return # Not a command
+            entry = self.get_command(cmd)
+            if not entry: return # Not a command
             # If command requires authorization, delegate execution to the
             # authorization provider, if available.
-            server_str = self.client.host + ':' + str(self.client.port)
-            if self.auth_provider and \
-                    has_annotation(self.commands[cmd], cmd, 'require_master'):
-                self.auth_provider.authorize_master(server_str,
-                        chan.decode(), nick.decode(),
-                        msg, self.commands[cmd], cmd)
-                return
-            elif self.auth_provider and \
-                    has_annotation(self.commands[cmd], cmd, 'require_owner'):
-                self.auth_provider.authorize_owner(server_str,
-                        chan.decode(), nick.decode(),
-                        msg, self.commands[cmd], cmd)
-                return
-            elif self.auth_provider and \
-                    has_annotation(self.commands[cmd], cmd, 'require_op'):
-                self.auth_provider.authorize_op(server_str,
-                        chan.decode(), nick.decode(),
-                        msg, self.commands[cmd], cmd)
-                return
-            elif self.auth_provider and \
-                    has_annotation(self.commands[cmd], cmd, 'require_hop'):
-                self.auth_provider.authorize_hop(server_str,
-                        chan.decode(), nick.decode(),
-                        msg, self.commands[cmd], cmd)
+            if entry.authorizer:
+                entry.authorizer(self.server, chan, nick, msg, entry.plugin, cmd)
                 return
-            elif self.auth_provider and \
-                    has_annotation(self.commands[cmd], cmd, 'require_voice'):
-                self.auth_provider.authorize_voice(server_str,
-                        chan.decode(), nick.decode(),
-                        msg, self.commands[cmd], cmd)
+            if entry.rank and (entry.rank != 'master' or
+                    event.nick != self.master):
+                # Without an auth provider, only allow master commands to
+                # users with a fitting nick, and no other privileged commands.
+                # This is the least we can do for security.
                 return
-            elif self.auth_provider and \
-                    has_annotation(self.commands[cmd], cmd,
-                            'require_authenticated'):
-                self.auth_provider.authorize_authenticated(server_str,
-                        chan.decode(), nick.decode(),
-                        msg, self.commands[cmd], cmd)
-                return
-            elif not self.auth_provider and \
-                    has_annotation(self.commands[cmd], cmd, 'require_master'):
-                # Even if no auth provider is available, restrict master
-                # commands to users with a fitting nick. This is the least
-                # we can do for security.
-                if nick.decode().split('!')[0] != self.master: return
             # Not a privileged command. Handle as usual.
-            ret_val = getattr(self.commands[cmd], cmd)(server_str,
-                    chan.decode(), nick.decode(), args)
+            ret_val = entry.method(self.server, chan, nick, args)
             # If text was returned, send it as a response.
             if isinstance(ret_val, str) or isinstance(ret_val, bytes):
-                self.client.send('PRIVMSG', respond_to, ':' + ret_val)
-                self._for_each_plugin(lambda plugin:
-                        plugin.on_privmsg(server_str, respond_to,
-                            self.client.nick, ret_val))
-        except (ValueError, KeyError): pass
-
-    def join(self, nick, chan):
-        nick = nick.decode()
-        if nick.split('!')[0] == self.client.nick:
-            self._for_each_plugin(lambda plugin:
-                    plugin.on_join(self.client.host + ':' + str(self.client.port),
-                        chan.decode()))
+                self.client.send('PRIVMSG', respond_to, ':' + ret_val,
+                        priority=PRIORITY_HIGH)
+                self._notify('on_privmsg', Event.create(self.server,
+                    respond_to, self.client.nick, ret_val))
+        except (IndexError, ValueError, KeyError): pass
+
+    def join(self, nick, chan, *args):
+        """With extended-join, args are the account and the real name."""
+        event = self._event(chan.decode(), nick.decode())
+        own = event.nick == self.client.nick
+        account = args[0].decode() if args and \
+                'extended-join' in self.client.caps else None
+        self.channels.joined(event.channel, event.nick, own, account)
+        if own:
+            self._notify('on_join', self.server, event.channel)
+        else:
+            self._notify('on_userjoin', event)
+
+    def part(self, nick, chan, msg=b''):
+        event = self._event(chan.decode(), nick.decode(),
+                msg.decode())
+        own = event.nick == self.client.nick
+        if own:
+            self._notify('on_part', self.server, event.channel)
+        else:
+            self._notify('on_userpart', event)
+        self.channels.parted(event.channel, event.nick, own)
+
+    def kick(self, nick, chan, target, reason=b''):
+        """Called when someone, given as target, is kicked by nick."""
+        event = self._event(chan.decode(), target.decode(),
+                reason.decode(), nick.decode())
+        own = event.nick == self.client.nick
+        if own:
+            self._notify('on_kicked', self.server, event.channel,
+                    event.message)
         else:
-            self._for_each_plugin(lambda plugin:
-                    plugin.on_userjoin(self.client.host + ':' + str(self.client.port),
-                        chan.decode(), nick))
+            self._notify('on_userkicked', event)
+        self.channels.parted(event.channel, event.nick, own)
 
     def connected(self):
-        self._for_each_plugin(lambda plugin:
-                plugin.on_connect(self.client.host + ':' + str(self.client.port)))
+        self.channels.reset()
+        if self.plugin_watch_interval and not self._plugin_watch:
+            self._plugin_watch = self.client.call_later(
+                    self.plugin_watch_interval, self._watch_plugins)
+        if self.checkpoint_interval and not self._checkpoint_timer:
+            self._checkpoint_timer = self.client.call_later(
+                    self.checkpoint_interval, self._checkpoint)
+        if self.metrics_enabled and self.metrics_port:
+            export_metrics(self.client.loop, self.metrics_host,
+                    self.metrics_port, self.server, self.metrics)
+        self._notify('on_connect', self.server)
 
     def action(self, nick, chan, msg):
         """Called on actions (you usually do those with /me)"""
-        self._for_each_plugin(lambda plugin:
-                plugin.on_useraction(self.client.host + ':' +
-                    str(self.client.port), chan.decode(),
-                    nick.decode(),
-                    ' '.join(msg.decode().split()[1:])))
+        self._notify('on_useraction', self._event(chan.decode(),
+            nick.decode(), ' '.join(msg.decode().split()[1:])))
 
     def notice(self, nick, chan, msg):
         """Usually issued by the server or services."""
-        self._for_each_plugin(lambda plugin:
-                plugin.on_notice(self.client.host + ':' +
-                    str(self.client.port), chan.decode(),
-                    nick.decode(), msg.decode()))
+        self._notify('on_notice', self._event(chan.decode(),
+            nick.decode(), msg.decode()))
 
     def nick(self, oldnick, newnick):
         """Called when a user renames themselves."""
-        self._for_each_plugin(lambda plugin:
-                plugin.on_userrenamed(self.client.host + ':' +
-                    str(self.client.port), oldnick.decode(),
-                    newnick.decode()))
+        event = self._event('', oldnick.decode(),
+                newnick.decode())
+        if event.nick == self.client.nick:
+            self.client.nick = event.message
+        self._notify('on_userrenamed', event)
+        self.channels.renamed(event.nick, event.message)
+
+    def account(self, nick, account):
+        """Called when a user logs in or out (IRCv3 account-notify)."""
+        self.channels.set_account(nick.decode().split('!')[0],
+                account.decode())
+
+    def away(self, nick, message=b''):
+        """Called when a user goes away or comes back (IRCv3 away-notify)."""
+        self.channels.set_away(nick.decode().split('!')[0], message.decode())
+
+    def batch(self, nick, *args):
+        """
+        Batches (IRCv3 batch) need no special treatment; the lines within a
+        batch are handled as usual, and carry its reference in their batch
+        tag.
+        """
 
     def mode(self, nick, chan, *args):
         """Called on MODE responses."""
         msg = args[0]
-        self._for_each_plugin(lambda plugin:
-                plugin.on_modechanged(self.client.host + ':' +
-                    str(self.client.port), chan.decode(),
-                    nick.decode(), msg.decode()))
+        event = self._event(chan.decode(), nick.decode(),
+                msg.decode())
+        if event.channel != self.client.nick: # Not a user mode
+            self.channels.mode(event.channel, event.message,
+                    [arg.decode() for arg in args[1:]])
+        self._notify('on_modechanged', event)
 
     def quit(self, nick, message):
-        """Called on disconnect."""
-        self._for_each_plugin(lambda plugin:
-                plugin.on_userquit(self.client.host + ':' + str(self.client.port),
-                    nick.decode(), message.decode()))
-        # Reconnect if disconnect was unintended
-        if not self.intended_disconnect:
-            self.client.connect()
+        """
+        Called when a user disconnects. Reconnecting after the bot itself was
+        disconnected is up to the connection.
+        """
+        event = self._event('', nick.decode(), message.decode())
+        self._notify('on_userquit', event)
+        self.channels.quit(event.nick)
 
     def exit(self):
         """Called on bot termination."""
-        self._for_each_plugin(lambda plugin:
-                plugin.on_quit())
+        if self._plugin_watch:
+            self._plugin_watch.cancel()
+            self._plugin_watch = None
+        if self._checkpoint_timer:
+            self._checkpoint_timer.cancel()
+            self._checkpoint_timer = None
+        self._notify('on_quit')
         self._for_each_plugin(lambda plugin:
                 plugin.close_all_storages())
 
@@ -262,33 +880,33 @@ class BotHandler(DefaultCommandHandler):
         """Unhandled commands go to this handler."""
         cmd = cmd.decode()
         if cmd == '353': # Channel member list
-            channel = args[3].decode()
             # The member list may be spread across multiple messages
-            if not channel in self.nicks:
-                self.nicks[channel] = {}
-            for nick in args[4].decode().split():
-                if nick[0] in ('@', '%', '+'):
-                    self.nicks[channel][nick[1:]] = nick[0]
-                else:
-                    self.nicks[channel][nick] = ''
+            self.channels.names_received(args[3].decode(),
+                    args[4].decode().split())
         elif cmd == '366': # Channel member list fetching done.
             channel = args[2].decode()
-            self._for_each_plugin(lambda plugin:
-                    plugin.on_names(self.client.host + ':' +
-                        str(self.client.port), channel,
-                        self.nicks[channel]))
-            self.nicks[channel] = {}
+            self._notify('on_names', self.server, channel,
+                    self.channels.names_finished(channel))
+        elif cmd == '005': # Parameters supported by the server
+            self.channels.set_isupport([arg.decode() for arg in args[1:-1]])
         elif cmd == '372': # MOTD
-            self._for_each_plugin(lambda plugin:
-                    plugin.on_motd(self.client.host + ':' +
-                        str(self.client.port), args[2].decode()))
+            self._notify('on_motd', self.server, args[2].decode())
         else:
             debug('Unknown command: [' + cmd + '] ' + str(args),
                     server=self.client.host)
 
 
 def on_connect(client):
+    """
+    Called once the server accepted the registration. If SASL was available,
+    the bot is already logged in to its account at this point, so channels
+    are joined identified.
+    """
     client.command_handler.connected()
+    if client.nick_password and not client.account:
+        # SASL is not supported by the server, or failed.
+        client.send('PRIVMSG', 'NickServ', ':IDENTIFY ' + client.nick_password,
+                quiet=True)
     # Join channels listed in the configuration file.
     debug('Joining startup channels...')
     for section in client.command_handler.config.sections():
@@ -297,6 +915,71 @@ def on_connect(client):
     # TODO: Auto-op if configured.
 
 
+def connect_servers(config, sections=None):
+    """
+    Creates a connection with loaded plugins for each server section of the
+    configuration, or only for the given server sections. Returns a dictionary
+    of the connections by section name. The connections are not yet started.
+
+    If the configuration has several server sections, each connection's
+    plugins keep their storages in data/<plugin>/<section>; otherwise in
+    data/<plugin>. The files in data/<plugin> are copied to each section's
+    directory when it is first used.
+    """
+    clients = dict()
+    shared = len(server_sections(config)) > 1
+    default_flood_rate = read_or_default(config, 'General', 'flood_rate',
+            0.5, float)
+    default_flood_burst = read_or_default(config, 'General', 'flood_burst',
+            5, int)
+    for section in config:
+        if section != 'General' and not '|' in section:
+            if sections is not None and not section in sections:
+                continue
+            try:
+                clients[section] = IRCConnection(BotHandler,
+                        host=section,
+                        port=config.getint(section, 'port'),
+                        nick=config.get(section, 'nick'),
+                        nick_password=read_or_default(config, section,
+                            'nick_password', ''),
+                        connect_cb=on_connect,
+                        flood_rate=read_or_default(config, section,
+                            'flood_rate', default_flood_rate, float),
+                        flood_burst=read_or_default(config, section,
+                            'flood_burst', default_flood_burst, int))
+                if shared:
+                    clients[section].command_handler.storage_namespace = \
+                            section
+                clients[section].command_handler.load_config(config)
+                clients[section].command_handler.load_plugins()
+                capture_path = read_or_default(config, section,
+                        'record_traffic', '')
+                if capture_path:
+                    clients[section].recorder = TrafficRecorder(
+                            os.path.join(clients[section].command_handler.home,
+                                capture_path), section,
+                            clients[section].port, clients[section].nick)
+            except (KeyError, configparser.NoOptionError): pass # Not a server.
+            except ValueError as ve:
+                info('Config section ' + section + ' will be ignored: ' + str(ve))
+    return clients
+
+
+def run_bot(clients):
+    """
+    Serves the given connections until they are closed or the bot is
+    interrupted, then terminates the plugins.
+    """
+    info('Startup complete.')
+    try:
+        serve(list(clients.values()))
+    except KeyboardInterrupt:
+        for client in clients:
+            clients[client].command_handler.exit()
+        info('All clients terminated. Goodbye!')
+
+
 def main():
     argparser = argparse.ArgumentParser(description='P1tr TNG - IRC bot.')
     argparser.add_argument('-c', '--conf', help='path to configuration file',
@@ -308,10 +991,20 @@ def main():
             help='runs plugin test suites and exits afterwards. Requires valid \
 configuration',
             action='store_const', const=True, default=False)
+    argparser.add_argument('-r', '--replay',
+            help='feeds a traffic capture through all plugins as fast as \
+possible, reports the performance and exits. Requires valid configuration',
+            action='store', metavar='FILE')
+    argparser.add_argument('--transcript',
+            help='with --replay: writes the lines the bot sent to FILE, or \
+shows how they differ from FILE if it exists',
+            action='store', metavar='FILE')
+    argparser.add_argument('-s', '--shard',
+            help='runs each server in a separate worker process, watched by a \
+supervisor process',
+            action='store_const', const=True, default=False)
     args = argparser.parse_args()
 
-    clients = dict()
-    connections = dict()
     config_path = args.conf
 
     # Launch configuration wizard, if desired, before bot launch
@@ -336,34 +1029,22 @@ configuration',
         run_tests(config)
         return # Exit after tests
 
-    application = IRCApp()
-    application.sleep_time = read_or_default(config, 'General', 'sleeptime',
-            0.2, lambda val: float(val))
+    if args.replay:
+        try:
+            if not run_replay(config, args.replay, BotHandler,
+                    args.transcript):
+                sys.exit(1) # The transcript differs.
+        except BotError as be:
+            critical(str(be))
+            sys.exit(1)
+        return
 
-    info('Connecting to servers...')
-    for section in config:
-        if section != 'General' and not '|' in section:
-            try:
-                clients[section] = IRCClient(BotHandler,
-                        host=section,
-                        port=config.getint(section, 'port'),
-                        nick=config.get(section, 'nick'),
-                        connect_cb=on_connect)
-                clients[section].command_handler.load_config(config)
-                clients[section].command_handler.load_plugins()
-                application.addClient(clients[section], autoreconnect=True)
-            except (KeyError, configparser.NoOptionError): pass # Not a server.
-            except ValueError as ve:
-                info('Config section ' + section + ' will be ignored: ' + str(ve))
+    if args.shard:
+        Supervisor(config_path, config, connect_servers, run_bot).run()
+        return
 
-    info('Startup complete.')
-    try:
-        application.run()
-    except KeyboardInterrupt:
-        for client in clients:
-            clients[client].command_handler.exit()
-        application.stop()
-        info('All clients terminated. Goodbye!')
+    info('Connecting to servers...')
+    run_bot(connect_servers(config))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,295 @@
+import asyncio
+import configparser
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+from types import MappingProxyType
+import p1tr.p1tr
+from p1tr.capture import ReplayClient
+from p1tr.connection import IRCConnection, WANTED_CAPS
+from p1tr.ircd import StandInServer
+from p1tr.p1tr import BotHandler, connect_servers, on_connect
+from p1tr.plugin import PluginError, discover_plugins, load_by_name
+from p1tr.test import test
+
+class _User(asyncio.Protocol):
+    """Client of a test user, sending raw lines and ignoring the replies."""
+
+    def __init__(self, nick):
+        self.nick = nick
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send('NICK ' + self.nick)
+        self.send('USER %s localhost localhost :Test user' % self.nick)
+
+    def send(self, line):
+        self.transport.write(line.encode('utf-8') + b'\r\n')
+
+
+class BotTest(unittest.TestCase):
+    """
+    Runs a bot without plugins against the stand-in server, in the channels
+    #p1tr and #other.
+    """
+
+    caps = None # Those of the stand-in server, unless set
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        server = StandInServer() if self.caps is None else \
+                StandInServer(caps=self.caps)
+        self.server = self.loop.run_until_complete(server.start())
+        config = configparser.ConfigParser()
+        config.read_dict({'General': {'home': '', 'plugin_blacklist': '',
+            'signal_character': '+', 'checkpoint_interval': '0'},
+            '127.0.0.1': {'nick': 'P1tr', 'port': str(self.server.port)},
+            '127.0.0.1|p1tr': {}, '127.0.0.1|other': {}})
+        self.bot = IRCConnection(BotHandler, host='127.0.0.1',
+                port=self.server.port, nick='P1tr', nick_password='secret',
+                connect_cb=on_connect, flood_rate=0)
+        self.handler = self.bot.command_handler
+        self.handler.load_config(config)
+        self.events = []
+        subscribers = dict(self.handler.subscribers)
+        subscribers['on_userkicked'] = (self.events.append,)
+        self.handler.subscribers = MappingProxyType(subscribers)
+        self.bot.start(self.loop)
+        self._wait(lambda: all('P1tr' in self.server.channels.get(channel,
+            ()) for channel in ('#p1tr', '#other')))
+        self._wait(lambda: self.handler.channels.is_synced('#p1tr') and
+                self.handler.channels.is_synced('#other'))
+        self.users = []
+
+    def tearDown(self):
+        self.bot.close()
+        for user in self.users:
+            user.transport.close()
+        self.server.stop()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.loop.close()
+
+    def _wait(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Timed out waiting for the bot.')
+            self.loop.run_until_complete(asyncio.sleep(0.005))
+
+    def _user(self, nick, *channels, identify=False):
+        """Connects a test user, who joins the given channels."""
+        _, user = self.loop.run_until_complete(self.loop.create_connection(
+            lambda: _User(nick), '127.0.0.1', self.server.port))
+        self.users.append(user)
+        if identify:
+            user.send('PRIVMSG NickServ :IDENTIFY secret')
+        user.send('JOIN ' + ','.join(channels))
+        self._wait(lambda: all(self.handler.channels.is_member(channel, nick)
+            for channel in channels))
+        return user
+
+    @test
+    def negotiation_test(self):
+        """The wanted capabilities are enabled, and the bot logs in."""
+        self.assertEqual(self.bot.caps, set(WANTED_CAPS + ('sasl',)))
+        self.assertEqual(self.bot.account, 'P1tr')
+        self.assertTrue('P1tr' in self.server.identified)
+
+    @test
+    def extended_join_test(self):
+        """Accounts are taken from extended joins."""
+        self._user('Ford', '#p1tr', identify=True)
+        self._user('Arthur', '#p1tr')
+        self.assertEqual(self.handler.channels.account('Ford'), 'Ford')
+        self.assertEqual(self.handler.channels.account('Arthur'), '')
+
+    @test
+    def account_notify_test(self):
+        """Logins of channel members are tracked."""
+        arthur = self._user('Arthur', '#p1tr')
+        arthur.send('PRIVMSG NickServ :IDENTIFY secret')
+        self._wait(lambda: self.handler.channels.account('Arthur'))
+        self.assertEqual(self.handler.channels.account('Arthur'), 'Arthur')
+
+    @test
+    def account_tag_test(self):
+        """Accounts are taken from the tags of messages."""
+        self._user('Ford', '#p1tr')
+        self.server.users['Ford'].account = 'ford_prefect'
+        self.server.users['Ford'].irc_PRIVMSG('#p1tr', 'Hello')
+        self._wait(lambda: self.handler.channels.account('Ford'))
+        self.assertEqual(self.handler.channels.account('Ford'),
+                'ford_prefect')
+
+    @test
+    def kick_account_test(self):
+        """The account of a kicker is not recorded for the kicked user."""
+        self._user('Arthur', '#p1tr', '#other')
+        zaphod = self._user('Zaphod', '#p1tr', identify=True)
+        self.server.operators['#p1tr'].add('Zaphod')
+        zaphod.send('KICK #p1tr Arthur :Get off my ship')
+        self._wait(lambda: not self.handler.channels.is_member('#p1tr',
+            'Arthur'))
+        self.assertEqual(self.handler.channels.account('Arthur'), '')
+        self.assertEqual(self.handler.channels.account('Zaphod'), 'Zaphod')
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.events[0].nick, 'Arthur')
+        self.assertEqual(self.events[0].message, 'Get off my ship')
+        self.assertIsNone(self.events[0].account)
+
+
+class NoCapsBotTest(BotTest):
+    """Runs the bot against a server without capability negotiation."""
+
+    caps = ()
+
+    @test
+    def negotiation_test(self):
+        """The bot identifies with NickServ instead."""
+        self.assertEqual(self.bot.caps, set())
+        self.assertIsNone(self.bot.account)
+        self._wait(lambda: 'P1tr' in self.server.identified)
+
+    @test
+    def extended_join_test(self):
+        """Accounts are unknown without the capabilities."""
+        self._user('Ford', '#p1tr', identify=True)
+        self.assertIsNone(self.handler.channels.account('Ford'))
+
+    # These depend on the capabilities.
+    account_notify_test = account_tag_test = kick_account_test = None
+
+
+class ReloadTest(unittest.TestCase):
+    """
+    Runs a bot with only the authdefault and karma plugins, without a
+    connection.
+    """
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        config = configparser.ConfigParser()
+        config.read_dict({'General': {'home': self.home,
+            'plugin_blacklist': '', 'signal_character': '+',
+            'lazy_plugins': 'False', 'checkpoint_interval': '0'},
+            'irc.example.org': {'nick': 'P1tr', 'port': '6667',
+                'master': 'Ford'}})
+        config['General']['plugin_blacklist'] = ' '.join(name
+                for name in discover_plugins(config)
+                if not name in ('authdefault', 'karma'))
+        self.client = ReplayClient(BotHandler, 'irc.example.org', 6667,
+                'P1tr')
+        self.handler = self.client.command_handler
+        self.handler.load_config(config)
+        self.handler.load_plugins()
+
+    def tearDown(self):
+        self.handler.exit()
+        p1tr.p1tr.load_by_name = load_by_name
+        shutil.rmtree(self.home)
+
+    def _nirvana(self, nick):
+        """Lets nick run the op command nirvana; True if it was executed."""
+        self.client.lines = []
+        self.handler.privmsg(nick.encode() + b'!user@example.org', b'#p1tr',
+                b'+nirvana Arthur')
+        return any(b'clean slate' in line for line in self.client.lines)
+
+    @test
+    def failed_reload_test(self):
+        """
+        The old instance of a plugin stays in place if its new one cannot be
+        initialized.
+        """
+        provider = self.handler.auth_provider
+        def load_failing(plugin_name, fresh=False):
+            plugin = load_by_name(plugin_name, fresh)
+            def initialize():
+                raise RuntimeError('Broken')
+            plugin.initialize = initialize
+            return plugin
+        p1tr.p1tr.load_by_name = load_failing
+        with self.assertRaises(PluginError):
+            self.handler.reload_plugin('authdefault')
+        self.assertIs(self.handler.auth_provider, provider)
+        self.assertIs(self.handler.plugins['authdefault'], provider)
+        self.assertIsNotNone(self.handler.dispatch['nirvana'].authorizer)
+        self.assertTrue('user_data' in provider._storages)
+        self.assertFalse(self._nirvana('Marvin'))
+        # A successful reload replaces the authorizers.
+        p1tr.p1tr.load_by_name = load_by_name
+        self.handler.reload_plugin('authdefault')
+        provider = self.handler.auth_provider
+        self.assertIs(self.handler.plugins['authdefault'], provider)
+        self.assertEqual(self.handler.dispatch['nirvana'].authorizer,
+                provider.authorize_op)
+
+    @test
+    def no_provider_test(self):
+        """Without an auth provider, only the master runs master commands."""
+        self.handler.unload_plugin('authdefault')
+        self.handler._build_dispatch_table()
+        self.handler._build_subscriber_index()
+        self.assertFalse(self._nirvana('Marvin'))
+        self.assertFalse(self._nirvana('Ford'))
+
+
+class StorageNamespaceTest(unittest.TestCase):
+    """Connects to two servers with only the karma plugin."""
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.config = configparser.ConfigParser()
+        self.config.read_dict({'General': {'home': self.home,
+            'plugin_blacklist': '', 'signal_character': '+',
+            'lazy_plugins': 'False', 'checkpoint_interval': '0'},
+            'irc.example.org': {'nick': 'P1tr', 'port': '6667'},
+            'irc.example.net': {'nick': 'P1tr', 'port': '6667'}})
+        self.config['General']['plugin_blacklist'] = ' '.join(name
+                for name in discover_plugins(self.config) if name != 'karma')
+        self.clients = {}
+
+    def tearDown(self):
+        for client in self.clients.values():
+            client.command_handler.exit()
+        shutil.rmtree(self.home)
+
+    @test
+    def separate_storages_test(self):
+        """Connections to several servers do not share storages."""
+        self.clients = connect_servers(self.config)
+        paths = [client.command_handler.plugins['karma'].data_path
+                for client in self.clients.values()]
+        self.assertEqual(sorted(paths), [os.path.join(self.home, 'data',
+            'karma', section) for section in ('irc.example.net',
+                'irc.example.org')])
+        plugin = self.clients['irc.example.org'].command_handler.plugins[
+                'karma']
+        with self.assertRaises(PluginError):
+            plugin.load_storage('karma')
+
+    @test
+    def single_server_test(self):
+        """With a single server, the storages are not namespaced."""
+        self.config.remove_section('irc.example.net')
+        self.clients = connect_servers(self.config)
+        self.assertEqual(self.clients['irc.example.org'].command_handler
+                .plugins['karma'].data_path, os.path.join(self.home, 'data',
+                    'karma'))
+
+    @test
+    def shared_data_test(self):
+        """Data kept for a single server is copied for each server."""
+        other = dict(self.config['irc.example.net'])
+        self.config.remove_section('irc.example.net')
+        clients = connect_servers(self.config)
+        clients['irc.example.org'].command_handler.plugins['karma'].karma[
+                'Arthur'] = [0, 42, None]
+        clients['irc.example.org'].command_handler.exit()
+        self.config.read_dict({'irc.example.net': other})
+        self.clients = connect_servers(self.config)
+        for client in self.clients.values():
+            self.assertEqual(client.command_handler.plugins['karma'].karma[
+                'Arthur'], [0, 42, None])
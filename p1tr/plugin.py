@@ -1,14 +1,24 @@
 """
 Plugin base class and related utilities.
 """
+import functools
 import glob
+import importlib
 import os
 import os.path
-import shelve
 from string import ascii_lowercase
+import sys
+try:
+    import fcntl
+except ImportError: # Not available on all platforms.
+    fcntl = None
 from p1tr.config import read_or_default
+from p1tr.event import Event, HOOK_FIELDS, event_from_arguments
 from p1tr.helpers import pretty_list
 from p1tr.logwrap import *
+from p1tr.sendqueue import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from p1tr.storage import DEFAULT_BACKEND, MAX_CACHED, open_storage, \
+        storage_exists
 
 def discover_plugins(config):
     """
@@ -76,7 +86,7 @@ def discover_plugins(config):
     return plugin_names
 
 
-def load_by_name(plugin_name):
+def load_by_name(plugin_name, fresh=False):
     """
     Attempts to load a plugin. The steps for that are as follows:
     1. Search for a directory named the all-lowercase version of plugin_name.
@@ -96,11 +106,20 @@ def load_by_name(plugin_name):
 
     The parameter config should be an instance of ConfigParser, which has
     already parsed the config file.
+
+    If fresh is True, a previously imported plugin module is imported again,
+    so that changes to its source file take effect.
     """
+    module_name = 'plugins.' + plugin_name + '.' + plugin_name
     try:
-        module = __import__('plugins.' + plugin_name + '.' + plugin_name)
+        if fresh and module_name in sys.modules:
+            importlib.reload(sys.modules[module_name])
+        module = __import__(module_name)
     except ImportError:
         raise PluginError('Plugin "' + plugin_name + '" not found.')
+    except Exception as e: # Errors in the plugin's module
+        raise PluginError('Plugin "%s" could not be imported: %s' %
+                (plugin_name, e))
 
     # Create instance and check type.
     instance = getattr(getattr(getattr(module, plugin_name), plugin_name),
@@ -110,6 +129,46 @@ def load_by_name(plugin_name):
     return instance
 
 
+"""
+Lock files of the storages opened by this process, by absolute storage path;
+None without fcntl support. Forked processes start over with an empty
+registry, since the locks belong to their parent.
+"""
+_storage_locks = {}
+_storage_locks_pid = os.getpid()
+
+def _lock_storage(path):
+    """
+    Takes an exclusive lock on the storage at path, so that a storage file is
+    only used once at a time. Raises PluginError if the storage is already
+    open in this process, or if another process holds the lock. Without fcntl
+    support, only the former is checked.
+    """
+    global _storage_locks, _storage_locks_pid
+    if _storage_locks_pid != os.getpid():
+        _storage_locks = {}
+        _storage_locks_pid = os.getpid()
+    key = os.path.abspath(path)
+    if key in _storage_locks:
+        raise PluginError('Storage %s is already open.' % path)
+    lock_file = None
+    if fcntl:
+        lock_file = open(path + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise PluginError('Storage %s is in use by another process.' %
+                    path)
+    _storage_locks[key] = lock_file
+
+def _unlock_storage(path):
+    """Releases a lock taken by _lock_storage."""
+    lock_file = _storage_locks.pop(os.path.abspath(path), None)
+    if lock_file:
+        lock_file.close()
+
+
 # Decorators:
 def _add_annotation(decoratable, key, value):
     """Adds value at key in decoratable's __annotations__ attribute."""
@@ -147,6 +206,28 @@ def require_voice(func):
 def require_authenticated(func):
     return _add_annotation(func, 'require_authenticated', True)
 
+def event_hook(func):
+    """
+    Hooks decorated with this receive a single p1tr.event.Event instead of the
+    positional arguments documented in Plugin, so that they do not have to
+    decode or split anything themselves. Only applicable to the hooks listed
+    in p1tr.event.HOOK_FIELDS.
+
+    The bot calls the undecorated function directly. Calls using the
+    positional arguments, for example from test cases, keep working; an Event
+    is built from the arguments in that case.
+    """
+    hook = func.__name__
+    if not hook in HOOK_FIELDS:
+        raise PluginError('%s cannot receive events.' % hook)
+    @functools.wraps(func)
+    def shim(self, *args):
+        if len(args) == 1 and isinstance(args[0], Event):
+            return func(self, args[0])
+        return func(self, event_from_arguments(hook, args))
+    shim.__annotations__ = dict(func.__annotations__)
+    return _add_annotation(shim, 'event_hook', func)
+
 def has_annotation(plugin, command, annotation):
     """Checks if an annotation is set for a given command in a given plugin."""
     if not hasattr(plugin, command): return false
@@ -171,9 +252,13 @@ class Plugin:
 
     Please note that the docstring of your plugin's class, which inherits from
     Plugin, is used to describe the plugin in the help message.
+
+    Hooks dealing with user activity may be decorated with event_hook, in which
+    case they receive a single p1tr.event.Event instead of the positional
+    arguments documented below.
     """
 
-    """Registry of all open storages."""
+    """Registry of all open storages of a plugin instance, by identifier."""
     _storages = {}
 
     """
@@ -189,10 +274,23 @@ class Plugin:
     """
     data_path = ''
 
+    """
+    Name of the backend of the storages opened with load_storage; see
+    p1tr.storage. Set at plugin instantiation, like data_path.
+    """
+    storage_backend = DEFAULT_BACKEND
+
+    """
+    Number of values each storage opened with load_storage keeps cached, unless
+    given otherwise. Set at plugin instantiation, like data_path.
+    """
+    storage_cache_size = MAX_CACHED
+
     def __init__(self):
         """
         Use the initialize method instead!
         """
+        self._storages = {}
 
     def initialize(self):
         """
@@ -222,21 +320,33 @@ class Plugin:
                 if __name__.lower() + '.' in key:
                     settings[__name__.__len__() + 1:] = section[key]
 
-    def load_storage(self, identifier):
+    def load_storage(self, identifier, cache_size=None):
         """
         Persistent storage mechanism for P1tr plugins. Calling this method
-        returns a dictionary-like key-value-storage, backed by Python's shelve
-        module. Pretty much anything can be serialized using this mechanism. For
-        details, refer to the documentation of the shelve module.
+        returns a dictionary-like key-value-storage with str keys. Pretty much
+        anything can be stored, as values are serialized with pickle, and
+        values may be modified in place, like with Python's shelve module with
+        writeback enabled. For details, refer to p1tr.storage.
 
         The pickle protocol version 3 is used, which was introduced with Python
         3 and is not backward compatible.
 
         The file behind this storage instance is stored in the file at
-        $home/data/$plugin/$identifier.db, whereas $home is the bot home
+        $home/data/$plugin/$identifier.sqlite, whereas $home is the bot home
         directory, $plugin the name of this plugin, and $identifier the
         parameter supplied at the method call. A plugin can have an arbitrary
-        number of storage files.
+        number of storage files. With the shelve backend, the file names depend
+        on the dbm module in use.
+
+        The storage uses the backend configured by the storage_backend setting.
+
+        The values read from the storage are cached. At most cache_size values
+        are kept, defaulting to the storage_cache_size setting; the least
+        recently used ones are written back and evicted. Storages with large
+        values may use a smaller cache.
+
+        A storage file may only be open once at a time. If it is already open,
+        in this process or another one, PluginError is raised.
 
         You can explicitly save the storage by calling the save_storage method.
         All storages are automatically saved and closed on termination of the
@@ -244,24 +354,30 @@ class Plugin:
         """
         path = os.path.join(self.data_path, identifier)
         try:
-            storage = shelve.open(path, protocol=3, writeback=True)
-            self._storages[identifier] = storage
-            debug('Loaded storage at: ' + path)
-            return storage
-        except Exception as e:
-            warning('Unable to load storage file at %s. Attempting directory \
-creation....' % path)
-            try:
+            if self.data_path and not os.path.isdir(self.data_path):
                 os.makedirs(self.data_path)
-                storage = shelve.open(path, protocol=3, writeback=True)
-                self._storages[identifier] = storage
-                debug('Loaded storage at: ' + path)
-                return storage
-            except Exception as e:
-                error('Unable to load storage file at ' + path + ':',
-                        plugin=self.__class__.__name__.lower())
-                error(str(e))
-                raise
+            _lock_storage(path)
+            storage = open_storage(path, self.storage_backend,
+                    cache_size or self.storage_cache_size)
+        except PluginError:
+            raise
+        except Exception as e:
+            _unlock_storage(path)
+            error('Unable to load storage file at ' + path + ':',
+                    plugin=self.__class__.__name__.lower())
+            error(str(e))
+            raise
+        self._storages[identifier] = storage
+        debug('Loaded storage at: ' + path)
+        return storage
+
+    def has_storage(self, identifier):
+        """
+        True if the storage with the given identifier exists, whether it is
+        loaded or not. Useful for migrating data from a storage which is no
+        longer used, without creating it.
+        """
+        return storage_exists(os.path.join(self.data_path, identifier))
 
     def save_storage(self, identifier=None, storage=None):
         """
@@ -296,21 +412,47 @@ creation....' % path)
             else:
                 self._storages[identifier].close()
                 del self._storages[identifier]
+                _unlock_storage(os.path.join(self.data_path, identifier))
                 debug('Storage "' + identifier + '" closed.',
                         plugin=self.__class__.__name__.lower())
         elif storage:
             storage.close()
             # In case the storage is referenced in self._storages, remove it to
             # avoid redundant closing on plugin termination.
-            identifier = [key for key, value in self._storages.iteritems()
+            identifier = [key for key, value in self._storages.items()
                     if value == storage]
             if len(identifier) > 0:
                 del self._storages[identifier[0]]
+                _unlock_storage(os.path.join(self.data_path, identifier[0]))
             debug('Storage "' + str(storage) + '" closed.',
                     plugin=self.__class__.__name__.lower())
         else:
             raise ValueError('Specify identifier or storage for closing.')
 
+    def checkpoint_storages(self):
+        """
+        This method is periodically called by the plugin container (the bot).
+        It starts writing the changes of all storages to disk. Returns a list
+        of (identifier, Future) tuples of the writes running in the
+        background (see p1tr.storage), or None if the plugin has no storages.
+        """
+        if not self._storages:
+            return None
+        writes = []
+        for identifier, storage in self._storages.items():
+            future = storage.checkpoint()
+            if future:
+                writes.append((identifier, future))
+        return writes
+
+    def storage_cache_info(self):
+        """
+        Returns the p1tr.storage.CacheInfo of every open storage, in a
+        dictionary by identifier.
+        """
+        return dict((identifier, storage.cache_info())
+                for identifier, storage in self._storages.items())
+
     def close_all_storages(self):
         """
         This method is automatically called on plugin termination by the plugin
@@ -320,6 +462,8 @@ creation....' % path)
         for storage in self._storages:
             self._storages[storage].sync()
             self._storages[storage].close()
+            _unlock_storage(os.path.join(self.data_path, storage))
+        self._storages = {}
 
     def on_privmsg(self, server, channel, user, message):
         """
@@ -416,11 +560,19 @@ class AuthorizationProvider(Plugin):
     master = None
 
     def execute(self, server, channel, nick, message, plugin, cmd):
-        """Executes a plugin command."""
-        ret_val = getattr(plugin, cmd)(server, channel, nick,
-                message.split()[1:])
+        """
+        Executes a plugin command. The timed method from the bot's dispatch
+        table is used, if available.
+        """
+        entry = self.bot.dispatch.get(cmd)
+        if entry and entry.plugin is plugin:
+            method = entry.method
+        else:
+            method = getattr(plugin, cmd)
+        ret_val = method(server, channel, nick, message.split()[1:])
         if isinstance(ret_val, str) or isinstance(ret_val, bytes):
-            self.bot.client.send('PRIVMSG', channel, ':' + ret_val)
+            self.bot.client.send('PRIVMSG', channel, ':' + ret_val,
+                    priority=PRIORITY_HIGH)
 
     def authorize_master(self, server, channel, nick, message, plugin, cmd):
         """
@@ -0,0 +1,121 @@
+"""
+Outbound message scheduling with flood control.
+
+IRC servers disconnect or throttle clients sending too many lines in a short
+time. The SendQueue paces outgoing lines with a token bucket: up to burst
+lines may be sent at once, after that, one line per 1/rate seconds. Lines are
+queued in priority lanes, so that command responses overtake memo deliveries
+and other bulk traffic. All lines which may be sent at a given moment are
+written to the socket in a single call.
+"""
+
+from collections import deque
+
+"""
+Priority lanes, from the most to the least important. Urgent lines (PONG,
+registration) bypass the token bucket. Pass one of these as the priority
+keyword argument to the send method of the bot's connection.
+"""
+PRIORITY_URGENT = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3
+
+"""Human-readable lane names, indexed by priority."""
+LANE_NAMES = ('urgent', 'high', 'normal', 'low')
+
+"""IRC commands which are always sent with PRIORITY_URGENT."""
+URGENT_COMMANDS = frozenset((b'PONG', b'PING', b'PASS', b'CAP',
+    b'AUTHENTICATE', b'NICK', b'USER', b'QUIT'))
+
+
+class SendQueue:
+    """
+    Token bucket scheduler for one connection. The write parameter is called
+    with the bytes to send; loop is the asyncio event loop used for timing.
+    A rate of 0 disables flood control.
+    """
+
+    def __init__(self, write, loop, rate=0.5, burst=5):
+        self._write = write
+        self._loop = loop
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = loop.time()
+        self._lanes = tuple(deque() for name in LANE_NAMES)
+        self._scheduled = None
+        self._sent = [0] * len(LANE_NAMES)
+        self._dropped = [0] * len(LANE_NAMES)
+        self._total_wait = [0.0] * len(LANE_NAMES)
+        self._max_wait = [0.0] * len(LANE_NAMES)
+
+    def put(self, line, priority=PRIORITY_NORMAL):
+        """Queues a line, which must be bytes including the line terminator."""
+        self._lanes[priority].append((line, self._loop.time()))
+        if not self._scheduled:
+            self._scheduled = self._loop.call_soon(self._flush)
+
+    def clear(self):
+        """Drops all queued lines, e.g. after the connection was lost."""
+        dropped = len(self)
+        for priority, lane in enumerate(self._lanes):
+            self._dropped[priority] += len(lane)
+            lane.clear()
+        if self._scheduled:
+            self._scheduled.cancel()
+            self._scheduled = None
+        return dropped
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self.burst,
+                    self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _flush(self):
+        """Sends as many lines as the bucket allows, in a single write."""
+        self._scheduled = None
+        now = self._loop.time()
+        self._refill(now)
+        batch = []
+        for priority, lane in enumerate(self._lanes):
+            while lane and (priority == PRIORITY_URGENT or not self.rate or
+                    self._tokens >= 1):
+                line, queued_at = lane.popleft()
+                if priority != PRIORITY_URGENT and self.rate:
+                    self._tokens -= 1
+                wait = now - queued_at
+                self._sent[priority] += 1
+                self._total_wait[priority] += wait
+                self._max_wait[priority] = max(self._max_wait[priority], wait)
+                batch.append(line)
+        if batch:
+            self._write(b''.join(batch))
+        if len(self) > 0:
+            self._scheduled = self._loop.call_later(
+                    (1 - self._tokens) / self.rate, self._flush)
+
+    def stats(self):
+        """
+        Returns a dictionary with an entry per lane name, each holding the
+        current queue depth, the numbers of lines sent and dropped, and the
+        total, average and maximum time in seconds lines had to wait in the
+        queue.
+        """
+        result = {}
+        for priority, name in enumerate(LANE_NAMES):
+            sent = self._sent[priority]
+            result[name] = {
+                    'depth': len(self._lanes[priority]),
+                    'sent': sent,
+                    'dropped': self._dropped[priority],
+                    'total_wait': self._total_wait[priority],
+                    'average_wait': self._total_wait[priority] / sent
+                        if sent else 0.0,
+                    'max_wait': self._max_wait[priority]
+                    }
+        return result
@@ -0,0 +1,534 @@
+"""
+Persistent key-value storages of the plugins.
+
+A storage is a dictionary-like object mapping str keys to any picklable
+values, with four additional methods: sync, which writes all changes to
+disk, checkpoint, which starts writing them in the background if the backend
+supports this, close, which syncs and releases the storage, and cache_info,
+which returns the CacheInfo of its cache.
+Plugin.load_storage opens one using the backend named by the storage_backend
+setting, unless the plugin asks for a specific one; see BACKENDS.
+
+Plugins are used to shelve's writeback behavior: values may be modified in
+place, e.g. self.memory[nick].append(item), and the change is saved on the
+next sync. All backends keep this behavior. Values read are cached, up to a
+number of entries given when opening the storage; the least recently used
+ones are written back and evicted when the cache is full. References to
+values must therefore not be kept and modified across events.
+
+Assignments are buffered in the cache as well, and reads see the latest
+value. Nothing is written until the next checkpoint or sync, or until the
+value is evicted, so a key assigned on every message, like the entry of a
+chatty user, is written once per checkpoint. The disk I/O thus scales with
+the number of distinct keys changed, not with the number of changes.
+"""
+
+import collections
+import collections.abc
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import dbm
+import os
+import os.path
+import pickle
+import shelve
+import sqlite3
+from time import perf_counter
+from p1tr.logwrap import *
+
+"""Pickle protocol of the stored values. Version 3 was used by shelve."""
+PICKLE_PROTOCOL = 3
+
+"""
+Default number of values a storage keeps cached, which bounds its memory
+usage.
+"""
+MAX_CACHED = 10000
+
+"""
+Statistics of the cache of a storage: reads served from it, reads from disk,
+values evicted, and the maximum and current number of cached values.
+"""
+CacheInfo = collections.namedtuple('CacheInfo',
+        'hits misses evictions maxsize currsize')
+
+"""Types of values which cannot be modified in place."""
+_IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None),
+        datetime.datetime, datetime.date, datetime.time, datetime.timedelta)
+
+
+def _is_immutable(value):
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(item) for item in value)
+    return isinstance(value, _IMMUTABLE_TYPES)
+
+
+def _read_shelve(path):
+    """
+    Returns the (key, pickle) tuples stored in the shelve storage at path, or
+    an empty list if there is none.
+    """
+    if not dbm.whichdb(path):
+        return []
+    with dbm.open(path, 'r') as shelf:
+        return [(key.decode('utf-8'), shelf[key]) for key in shelf.keys()]
+
+
+class ShelveStorage(shelve.DbfilenameShelf):
+    """
+    A shelf with writeback: values read or assigned stay cached until they
+    are evicted or the shelf is synced, and are then pickled and written
+    again, whether they were modified or not. The files are named after path,
+    with extensions depending on the available dbm module.
+    """
+
+    def __init__(self, path, max_cached=MAX_CACHED):
+        shelve.DbfilenameShelf.__init__(self, path, protocol=PICKLE_PROTOCOL,
+                writeback=True)
+        self.cache = collections.OrderedDict()
+        self.max_cached = max_cached
+        self.hits = self.misses = self.evictions = 0
+        self._unwritten = set() # Keys assigned, but not written yet
+
+    def __getitem__(self, key):
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            value = shelve.DbfilenameShelf.__getitem__(self, key)
+            self._evict()
+            return value
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if not self.writeback: # Writing back, while syncing
+            shelve.DbfilenameShelf.__setitem__(self, key, value)
+            return
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        self._unwritten.add(key)
+        self._evict()
+
+    def __delitem__(self, key):
+        if key in self._unwritten:
+            del self.cache[key]
+            self._unwritten.discard(key)
+            if shelve.DbfilenameShelf.__contains__(self, key):
+                del self.dict[key.encode(self.keyencoding)]
+        else:
+            shelve.DbfilenameShelf.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self.cache or \
+                shelve.DbfilenameShelf.__contains__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        self._write_back(list(self._unwritten))
+        return shelve.DbfilenameShelf.__iter__(self)
+
+    def __len__(self):
+        self._write_back(list(self._unwritten))
+        return shelve.DbfilenameShelf.__len__(self)
+
+    def _write_back(self, keys):
+        for key in keys:
+            self.dict[key.encode(self.keyencoding)] = pickle.dumps(
+                    self.cache[key], self._protocol)
+            self._unwritten.discard(key)
+
+    def _evict(self):
+        """Writes back and evicts the least recently used values."""
+        while len(self.cache) > self.max_cached:
+            key = next(iter(self.cache))
+            self._write_back((key,))
+            del self.cache[key]
+            self.evictions += 1
+
+    def sync(self):
+        shelve.DbfilenameShelf.sync(self)
+        self.cache = collections.OrderedDict()
+        self._unwritten.clear()
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                self.max_cached, len(self.cache))
+
+    def checkpoint(self):
+        """Syncs right away; shelves cannot be written in the background."""
+        self.sync()
+        return None
+
+
+"""Background writer thread of this process; see _writer."""
+_writer_executor = None
+_writer_pid = None
+
+def _writer():
+    """
+    Returns the executor running all background writes of this process. It
+    has a single thread, so writes are carried out in the order they were
+    submitted. Forked processes get their own.
+    """
+    global _writer_executor, _writer_pid
+    if _writer_pid != os.getpid():
+        _writer_executor = ThreadPoolExecutor(max_workers=1)
+        _writer_pid = os.getpid()
+    return _writer_executor
+
+
+class SQLiteStorage(collections.abc.MutableMapping):
+    """
+    Storage in an SQLite database at path + '.sqlite', which is used in
+    write-ahead logging mode, so that a sync costs a single sequential write.
+
+    Assigned and deleted keys are tracked, and only these are written, in a
+    single transaction. Values which can be modified in place, and were read
+    since the last checkpoint, are pickled again and written only if the
+    pickle changed. Immutable values, like the tuples most plugins store, are
+    not looked at again.
+
+    At most max_cached values are cached. When the cache is full, the least
+    recently used tenth of it is evicted, and the changes of the evicted
+    values are handed over to the writer as one batch.
+
+    Writes happen in a background thread: checkpoint collects and pickles the
+    changes, which has to happen on the thread using the storage, and hands
+    them over to the writer. Until they are committed, reads are served from
+    the pickles handed over. A crash loses at most the changes since the last
+    committed checkpoint; the database is never left half-written. If a write
+    fails, its changes are written again with the next checkpoint.
+
+    Data of a shelve storage at path is imported when the database is
+    created.
+    """
+
+    def __init__(self, path, max_cached=MAX_CACHED):
+        self.path = path + '.sqlite'
+        self.max_cached = max_cached
+        self.hits = self.misses = self.evictions = 0
+        # Values read or assigned, from the least to the most recently used.
+        self._cache = collections.OrderedDict()
+        self._pickled = {} # Pickles of the cached mutable values, as written
+        self._read = set() # Keys read since the last checkpoint
+        self._dirty = set() # Keys assigned since the last checkpoint
+        self._deleted = set() # Keys deleted since the last checkpoint
+        # Keys looked up, but not stored, up to max_cached; plugins check for
+        # the same absent keys on every message.
+        self._absent = set()
+        # Changes handed over to the writer, as (batch number, pickle or None
+        # if deleted) by key, and the number of the last committed batch.
+        self._pending = {}
+        self._batches = 0
+        self._committed = 0
+        # Numbers of the failed batches, whose pending changes are kept until
+        # they are written again, and the (batch number, changes) of these
+        # batches, to be collected again. Added to by the writer thread.
+        self._failed_batches = set()
+        self._failed = collections.deque()
+        self._last_write = None # Future of the last batch
+        exists = os.path.exists(self.path)
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._writer_db = None
+        try:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            # A crash may lose the last transactions, but never corrupts the
+            # database.
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS storage (key TEXT \
+PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID')
+            if not exists:
+                self._import_shelve(path)
+            # Used by the writer thread only.
+            self._writer_db = sqlite3.connect(self.path,
+                    isolation_level=None, check_same_thread=False)
+            self._writer_db.execute('PRAGMA synchronous=NORMAL')
+        except Exception:
+            self._db.close()
+            if not exists: # Import again next time.
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(self.path + suffix):
+                        os.remove(self.path + suffix)
+            raise
+
+    def _import_shelve(self, path):
+        """Copies the pickled values of the shelve storage at path, if any."""
+        rows = _read_shelve(path)
+        if not rows:
+            return
+        self._db.execute('BEGIN')
+        self._db.executemany('INSERT INTO storage VALUES (?, ?)', rows)
+        self._db.execute('COMMIT')
+        info('Imported shelve storage %s into %s. The old files are no longer \
+used.' % (path, self.path))
+
+    def _pending_pickle(self, key):
+        """
+        Returns the uncommitted pickle of key, None if key was deleted, or
+        False if there is no uncommitted change.
+        """
+        pending = self._pending.get(key)
+        if pending is None or self._is_committed(pending[0]):
+            return False
+        return pending[1]
+
+    def _is_committed(self, batch):
+        return batch <= self._committed and not batch in self._failed_batches
+
+    def _load(self, key):
+        pickled = self._pending_pickle(key)
+        if pickled is False:
+            row = self._db.execute('SELECT value FROM storage WHERE key = ?',
+                    (key,)).fetchone()
+            pickled = row[0] if row else None
+        if pickled is None:
+            self._add_absent(key)
+            raise KeyError(key)
+        value = pickle.loads(pickled)
+        self._cache[key] = value
+        if not _is_immutable(value):
+            self._pickled[key] = pickled
+            self._read.add(key)
+        self._evict()
+        return value
+
+    def __getitem__(self, key):
+        try:
+            value = self._cache[key]
+        except KeyError:
+            if key in self._deleted or key in self._absent:
+                raise
+            self.misses += 1
+            return self._load(key)
+        self.hits += 1
+        self._cache.move_to_end(key)
+        if key in self._pickled:
+            self._read.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        self._pickled.pop(key, None)
+        self._dirty.add(key)
+        self._deleted.discard(key)
+        self._absent.discard(key)
+        self._evict()
+
+    def __delitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+        self._cache.pop(key, None)
+        self._pickled.pop(key, None)
+        self._read.discard(key)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def _changed(self, key):
+        """
+        Returns the pickle of the cached value of key if it has to be
+        written, or None.
+        """
+        value = self._cache[key]
+        if key in self._dirty:
+            return pickle.dumps(value, PICKLE_PROTOCOL)
+        if key in self._read and key in self._pickled:
+            current = pickle.dumps(value, PICKLE_PROTOCOL)
+            if current != self._pickled[key]:
+                return current
+        return None
+
+    def _evict(self):
+        """
+        Evicts the least recently used tenth of the cache if it is full, and
+        hands the changes of the evicted values over to the writer.
+        """
+        if len(self._cache) <= self.max_cached:
+            return
+        changes = []
+        while len(self._cache) > self.max_cached - self.max_cached // 10:
+            key = next(iter(self._cache))
+            pickled = self._changed(key)
+            if pickled is not None:
+                changes.append((key, pickled))
+            del self._cache[key]
+            self._pickled.pop(key, None)
+            self._read.discard(key)
+            self._dirty.discard(key)
+            self.evictions += 1
+        if changes:
+            self._submit(changes)
+
+    def __contains__(self, key):
+        if key in self._cache:
+            return True
+        if key in self._deleted or key in self._absent:
+            return False
+        pickled = self._pending_pickle(key)
+        if pickled is not False:
+            return pickled is not None
+        if self._db.execute('SELECT 1 FROM storage WHERE key = ?',
+                (key,)).fetchone() is None:
+            self._add_absent(key)
+            return False
+        return True
+
+    def _add_absent(self, key):
+        if len(self._absent) >= self.max_cached:
+            self._absent.clear()
+        self._absent.add(key)
+
+    def __iter__(self):
+        self._flush(wait=True)
+        return iter([row[0] for row in
+            self._db.execute('SELECT key FROM storage')])
+
+    def __len__(self):
+        self._flush(wait=True)
+        return self._db.execute('SELECT COUNT(*) FROM storage').fetchone()[0]
+
+    def _collect(self):
+        """
+        Returns the changes since the last call as a list of (key, pickle or
+        None if deleted) tuples, including those of failed writes which were
+        not superseded since.
+        """
+        changes = []
+        for key in self._dirty | self._read:
+            pickled = self._changed(key)
+            if pickled is None:
+                continue
+            changes.append((key, pickled))
+            if key in self._pickled or \
+                    not _is_immutable(self._cache[key]): # May change in place
+                self._pickled[key] = pickled
+        changes.extend((key, None) for key in self._deleted)
+        self._read.clear()
+        self._dirty.clear()
+        self._deleted.clear()
+        changed = set(key for key, pickled in changes)
+        while self._failed:
+            batch, failed = self._failed.popleft()
+            for key, pickled in failed:
+                # Skip changes superseded by a later batch, or by this one.
+                if not key in changed and \
+                        self._pending.get(key, (None,))[0] == batch:
+                    changes.append((key, pickled))
+                    changed.add(key)
+            # The pending changes of the batch are replaced when the changes
+            # are submitted, right after this.
+            self._failed_batches.discard(batch)
+        return changes
+
+    def _flush(self, wait=False):
+        """
+        Hands the changes over to the writer. Returns the Future of the
+        write, or None if there was nothing to write. If wait is True, blocks
+        until all changes are written.
+        """
+        changes = self._collect()
+        future = self._submit(changes) if changes else None
+        if wait and self._last_write:
+            try:
+                self._last_write.result()
+            except sqlite3.Error:
+                pass # Logged by the writer.
+        return future
+
+    def _submit(self, changes):
+        """
+        Hands a batch of changes, as (key, pickle or None if deleted) tuples,
+        over to the writer. Returns the Future of the write.
+        """
+        # Forget the committed changes.
+        for key in [key for key, (batch, pickled) in self._pending.items()
+                if self._is_committed(batch)]:
+            del self._pending[key]
+        self._batches += 1
+        for key, pickled in changes:
+            self._pending[key] = (self._batches, pickled)
+        self._last_write = _writer().submit(self._write, self._batches,
+                changes)
+        return self._last_write
+
+    def _write(self, batch, changes):
+        """
+        Writes a batch of changes in a single transaction. Runs in the writer
+        thread. Returns the time it took.
+        """
+        start = perf_counter()
+        try:
+            self._writer_db.execute('BEGIN')
+            try:
+                self._writer_db.executemany('DELETE FROM storage WHERE \
+key = ?', ((key,) for key, pickled in changes if pickled is None))
+                self._writer_db.executemany('INSERT OR REPLACE INTO storage \
+VALUES (?, ?)', ((key, pickled) for key, pickled in changes
+                    if pickled is not None))
+                self._writer_db.execute('COMMIT')
+            except sqlite3.Error:
+                self._writer_db.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            error('Unable to write to %s: %s' % (self.path, e))
+            self._failed_batches.add(batch)
+            self._failed.append((batch, changes))
+            raise
+        self._committed = batch
+        return perf_counter() - start
+
+    def checkpoint(self):
+        """
+        Starts writing all changes in the background. Returns the Future of
+        the write, whose result is the time the write took, or None if there
+        was nothing to write.
+        """
+        return self._flush()
+
+    def sync(self):
+        """Writes all changes."""
+        self._flush(wait=True)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                self.max_cached, len(self._cache))
+
+    def close(self):
+        if self._db is None:
+            return
+        self.sync()
+        self._cache.clear()
+        self._pickled.clear()
+        self._db.close()
+        self._writer_db.close()
+        self._db = None
+
+
+"""Storage classes by the name used for the storage_backend setting."""
+BACKENDS = {'sqlite': SQLiteStorage, 'shelve': ShelveStorage}
+
+"""Backend used unless configured otherwise."""
+DEFAULT_BACKEND = 'sqlite'
+
+
+def storage_exists(path):
+    """True if a storage of any backend exists at path."""
+    return os.path.exists(path + '.sqlite') or bool(dbm.whichdb(path))
+
+
+def open_storage(path, backend=DEFAULT_BACKEND, max_cached=MAX_CACHED):
+    """
+    Opens the storage at path with the named backend, caching up to
+    max_cached values. Raises ValueError if there is no such backend.
+    """
+    if not backend in BACKENDS:
+        raise ValueError('Unknown storage backend "%s". Available: %s' % (
+            backend, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[backend](path, max_cached)
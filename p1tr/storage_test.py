@@ -0,0 +1,159 @@
+import os
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from p1tr.storage import BACKENDS, ShelveStorage, SQLiteStorage, \
+        open_storage
+from p1tr.test import test
+
+class _FailingConnection:
+    """Wraps an SQLite connection, failing the next COMMIT once."""
+
+    def __init__(self, db):
+        self.db = db
+        self.fail = True
+
+    def execute(self, statement, *args):
+        if statement == 'COMMIT' and self.fail:
+            self.fail = False
+            raise sqlite3.OperationalError('disk I/O error')
+        return self.db.execute(statement, *args)
+
+    def executemany(self, statement, rows):
+        return self.db.executemany(statement, rows)
+
+    def close(self):
+        self.db.close()
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'storage')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _reopen(self, storage, backend, max_cached=10):
+        storage.close()
+        return open_storage(self.path, backend, max_cached)
+
+    @test
+    def roundtrip_test(self):
+        """Values are kept across closing and reopening the storage."""
+        for backend in BACKENDS:
+            self.path = os.path.join(self.directory, backend)
+            storage = open_storage(self.path, backend, 10)
+            storage['tuple'] = ('Ford', 42)
+            storage['list'] = [1, 2]
+            storage['gone'] = 'soon'
+            storage = self._reopen(storage, backend)
+            self.assertEqual(storage['tuple'], ('Ford', 42), backend)
+            self.assertEqual(storage['list'], [1, 2], backend)
+            del storage['gone']
+            self.assertFalse('gone' in storage, backend)
+            storage = self._reopen(storage, backend)
+            self.assertFalse('gone' in storage, backend)
+            self.assertEqual(sorted(storage), ['list', 'tuple'], backend)
+            self.assertEqual(len(storage), 2, backend)
+            storage.close()
+
+    @test
+    def mutation_test(self):
+        """Values modified in place are saved."""
+        for backend in BACKENDS:
+            self.path = os.path.join(self.directory, backend)
+            storage = open_storage(self.path, backend, 10)
+            storage['list'] = [1]
+            storage['nested'] = {'#p1tr': {'ford': 1}}
+            storage = self._reopen(storage, backend)
+            storage['list'].append(2)
+            storage['nested']['#p1tr']['ford'] += 1
+            storage['nested']['#p1tr']['arthur'] = 1
+            storage.checkpoint()
+            storage['nested']['#p1tr'].pop('arthur')
+            storage = self._reopen(storage, backend)
+            self.assertEqual(storage['list'], [1, 2], backend)
+            self.assertEqual(storage['nested'], {'#p1tr': {'ford': 2}},
+                    backend)
+            storage.close()
+
+    @test
+    def eviction_test(self):
+        """Values are written back when they are evicted from the cache."""
+        for backend in ('sqlite', 'shelve'):
+            self.path = os.path.join(self.directory, backend)
+            storage = open_storage(self.path, backend, 10)
+            for number in range(30):
+                storage[str(number)] = [number]
+            self.assertTrue(storage.cache_info().evictions > 0, backend)
+            self.assertTrue(storage.cache_info().currsize <= 10, backend)
+            storage['0'].append('changed')
+            for number in range(1, 30):
+                self.assertEqual(storage[str(number)], [number], backend)
+            self.assertEqual(storage['0'], [0, 'changed'], backend)
+            storage = self._reopen(storage, backend)
+            for number in range(1, 30):
+                self.assertEqual(storage[str(number)], [number], backend)
+            self.assertEqual(storage['0'], [0, 'changed'], backend)
+            storage.close()
+
+    @test
+    def wal_crash_test(self):
+        """Synced changes survive a crash before the database is closed."""
+        storage = SQLiteStorage(self.path)
+        storage['ford'] = 'prefect'
+        storage.sync()
+        # Copying the files of the open database is what a crash leaves.
+        crashed = os.path.join(self.directory, 'crashed')
+        for suffix in ('.sqlite', '.sqlite-wal'):
+            shutil.copy(self.path + suffix, crashed + suffix)
+        storage.close()
+        storage = SQLiteStorage(crashed)
+        self.assertEqual(storage['ford'], 'prefect')
+        storage.close()
+
+    @test
+    def failed_write_test(self):
+        """
+        Changes of a failed write are written again, even if later batches
+        were committed meanwhile.
+        """
+        storage = SQLiteStorage(self.path, 10)
+        storage['ford'] = 'prefect'
+        storage.sync()
+        storage['ford'] = 'perfect'
+        storage._writer_db = _FailingConnection(storage._writer_db)
+        with self.assertRaises(sqlite3.OperationalError):
+            storage.checkpoint().result()
+        # Evict ford, committing a batch of the evicted values.
+        for number in range(20):
+            storage[str(number)] = number
+        storage._last_write.result()
+        self.assertEqual(storage['ford'], 'perfect')
+        for number in range(20, 40):
+            storage[str(number)] = number
+        storage.checkpoint().result()
+        storage.close()
+        storage = SQLiteStorage(self.path, 10)
+        self.assertEqual(storage['ford'], 'perfect')
+        self.assertEqual(storage['39'], 39)
+        storage.close()
+
+    @test
+    def shelve_import_test(self):
+        """Shelve storages are imported into SQLite storages."""
+        storage = ShelveStorage(self.path)
+        storage['ford'] = ['prefect']
+        storage.close()
+        storage = SQLiteStorage(self.path)
+        self.assertEqual(storage['ford'], ['prefect'])
+        storage['arthur'] = 'dent'
+        storage.close()
+        storage = SQLiteStorage(self.path)
+        self.assertEqual(storage['ford'], ['prefect'])
+        self.assertEqual(storage['arthur'], 'dent')
+        storage.close()
@@ -0,0 +1,162 @@
+"""
+Process-per-network operation.
+
+By default, all server sections of the configuration are served by a single
+process, so a plugin keeping the CPU busy on one network stalls all others.
+In sharded mode (--shard), the Supervisor forks one worker process per server
+section instead. Workers hand their log messages to the supervisor through
+a queue; the supervisor writes the logs and restarts workers which crashed.
+Workers serve their metrics themselves, like a bot without shards, if
+metrics_port is set in their server sections; see p1tr.metrics.
+
+Like the connections of a single process, each worker keeps its plugins'
+storages in a sub-directory named after its server section, i.e.
+data/<plugin>/<section>, so no two workers share a storage file. The data
+kept in data/<plugin> before is copied there on the first start.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from p1tr.config import load_config, read_or_default
+from p1tr.logwrap import *
+
+"""Seconds to wait before restarting a crashed worker for the first time."""
+RESTART_DELAY = 5
+
+"""
+Upper limit for the restart delay, which doubles every time a worker crashes.
+Workers which ran for longer than this are restarted after RESTART_DELAY
+again.
+"""
+MAX_RESTART_DELAY = 300
+
+"""Seconds to wait for the workers to close their storages on shutdown."""
+SHUTDOWN_TIMEOUT = 10
+
+
+def server_sections(config):
+    """Returns the names of all server sections of the configuration."""
+    return [section for section in config
+            if section != 'General' and not '|' in section and
+            config.has_option(section, 'port') and
+            config.has_option(section, 'nick')]
+
+
+def _run_worker(config_path, section, records, connect, run):
+    """Entry point of a worker process serving a single server section."""
+    set_forwarding(records)
+    config = load_config(config_path)
+    set_loglevel(read_or_default(config, 'General', 'loglevel', logging.ERROR,
+        lambda val: getattr(logging, val)))
+    run(connect(config, [section]))
+
+
+class Supervisor:
+    """
+    Runs one worker process per server section and watches them. The connect
+    and run parameters are the functions used by the workers to set up and
+    serve their connections: connect(config, sections) returns a dictionary
+    of connections, which is passed to run(clients).
+
+    A worker exiting with status 0 was shut down intentionally, e.g. by the
+    quit command, and is not restarted.
+    """
+
+    def __init__(self, config_path, config, connect, run):
+        self.config_path = config_path
+        self.sections = server_sections(config)
+        self.connect = connect
+        self.run_clients = run
+        self.records = multiprocessing.Queue()
+        self.workers = {} # Process by section
+        self.started_at = {} # Start time of the worker, by section
+        self.restart_at = {} # Scheduled restarts, by section
+        self.restart_delay = {} # Next restart delay, by section
+
+    def start_worker(self, section):
+        """Forks a worker process for the given server section."""
+        process = multiprocessing.Process(target=_run_worker,
+                name='p1tr-' + section,
+                args=(self.config_path, section, self.records, self.connect,
+                    self.run_clients))
+        process.start()
+        self.workers[section] = process
+        self.started_at[section] = time.monotonic()
+        info('Started worker %d for %s.' % (process.pid, section))
+
+    def run(self):
+        """
+        Starts all workers and supervises them until all of them have been
+        shut down, or KeyboardInterrupt is raised.
+        """
+        for section in self.sections:
+            self.start_worker(section)
+        info('Startup complete.')
+        try:
+            while self.workers or self.restart_at:
+                self._drain(timeout=1)
+                self._check_workers()
+        except KeyboardInterrupt:
+            self.stop()
+        info('All workers terminated. Goodbye!')
+
+    def stop(self):
+        """Asks all workers to shut down and waits for them to do so."""
+        for process in self.workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for section, process in self.workers.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                warning('Worker for %s did not shut down in time.' % section)
+                process.terminate()
+        self._drain()
+        self.workers = {}
+        self.restart_at = {}
+
+    def _drain(self, timeout=None):
+        """
+        Processes all records the workers have sent. Waits up to timeout
+        seconds for the first one, if given.
+        """
+        try:
+            if timeout:
+                record = self.records.get(timeout=timeout)
+            else:
+                record = self.records.get_nowait()
+            while True:
+                self._handle(record)
+                record = self.records.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _handle(self, record):
+        if record[0] == 'log':
+            forward_record(record)
+
+    def _check_workers(self):
+        """Schedules restarts of crashed workers and performs due restarts."""
+        now = time.monotonic()
+        for section, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            del self.workers[section]
+            if process.exitcode == 0:
+                info('Worker for %s shut down.' % section)
+                continue
+            if now - self.started_at[section] > MAX_RESTART_DELAY:
+                self.restart_delay[section] = RESTART_DELAY
+            delay = self.restart_delay.get(section, RESTART_DELAY)
+            error('Worker for %s exited with status %s. Restarting in %d \
+seconds.' % (section, process.exitcode, delay))
+            self.restart_at[section] = now + delay
+            self.restart_delay[section] = min(delay * 2, MAX_RESTART_DELAY)
+        for section, restart_at in list(self.restart_at.items()):
+            if restart_at <= now:
+                del self.restart_at[section]
+                self.start_worker(section)
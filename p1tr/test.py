@@ -2,6 +2,7 @@
 
 import inspect
 from collections import namedtuple
+import os
 import sys
 import unittest
 from p1tr.logwrap import info, warning
@@ -100,11 +101,41 @@ def get_suite(plugin, config, module):
                     test_cases.append(test_class(member[0]))
                     test_cases[-1].plugin = load_by_name(plugin)
                     #TODO: Add bot instance simulation
-                    test_cases[-1].plugin.data_path = 'test_data'
+                    # Storages may only be opened once at a time.
+                    test_cases[-1].plugin.data_path = os.path.join(
+                            'test_data', plugin, str(len(test_cases)))
                     test_cases[-1].plugin.initialize()
                     test_cases[-1].plugin.load_settings(config)
     return unittest.TestSuite(test_cases)
 
+def get_core_suite(module):
+    """
+    Creates a test suite of the test methods of all unittest.TestCase
+    classes found in a test module of the bot itself.
+    """
+    test_cases = []
+    for test_class in [member[1] for member in inspect.getmembers(module)
+            if isinstance(member[1], type) and \
+                    issubclass(member[1], unittest.TestCase) and \
+                    not issubclass(member[1], PluginTestCase)]:
+        for member in inspect.getmembers(test_class):
+            if 'test' in getattr(member[1], '__annotations__', {}):
+                test_cases.append(test_class(member[0]))
+    return unittest.TestSuite(test_cases)
+
+def discover_core_tests():
+    """
+    Returns the test modules of the bot itself: the modules of the p1tr
+    package whose name ends with _test.
+    """
+    modules = []
+    for filename in sorted(os.listdir(os.path.dirname(__file__))):
+        if filename.endswith('_test.py'):
+            name = filename[:-3]
+            modules.append(getattr(__import__('p1tr.%s' % name), name))
+            info('Loaded core tests "%s".' % name, test=True)
+    return modules
+
 def _reduce_test_results(results):
     """Summarizes test results to a tuple with counts."""
     total = [0, 0, 0, 0, 0, 0, 0]
@@ -120,7 +151,8 @@ def _reduce_test_results(results):
 
 def run_tests(config, silent=False):
     """
-    Discovers plugins and runs their test cases. Returns success as boolean.
+    Discovers plugins and runs their test cases, after those of the bot
+    itself. Returns success as boolean.
     Logs info to test.log with the configured loglevel.
     Requires a properly loaded ConfigParser object as parameter.
     """
@@ -137,12 +169,15 @@ def run_tests(config, silent=False):
         except ImportError:
             warning('Failed to load tests of plugin "%s". Do they exist?' %
                     plugin, test=True)
+    core_modules = discover_core_tests()
     info('Running tests...', test=True)
     # Load suites and run tests
     test_runner = unittest.TextTestRunner()
-    results = [test_runner.run(case)
+    results = [test_runner.run(get_core_suite(module))
+            for module in core_modules]
+    results.extend(test_runner.run(case)
             for case in [get_suite(entry[1], config, entry[0])
-                for entry in test_modules]]
+                for entry in test_modules])
     # Summarize results through reduction
     total = _reduce_test_results(results)
     info('%d errors, %d failures, %d skipped, %d expected failures, %d \
@@ -0,0 +1,93 @@
+from p1tr.helpers import clean_string
+from p1tr.plugin import *
+from p1tr.sendqueue import LANE_NAMES
+
+@meta_plugin
+class Admin(Plugin):
+    """Provides commands for maintaining the running bot."""
+
+    @command
+    @require_master
+    def reload(self, server, channel, nick, params):
+        """
+        Usage: reload PLUGIN - loads the current version of PLUGIN from its
+        source file, without disconnecting. The plugin's storages are closed and
+        opened again.
+        """
+        if len(params) < 1:
+            return clean_string(self.reload.__doc__)
+        try:
+            self.bot.reload_plugin(params[0])
+        except PluginError as pe:
+            return str(pe)
+        return 'Plugin %s was reloaded.' % params[0]
+
+    @command
+    @require_master
+    def stats(self, server, channel, nick, params):
+        """
+        Usage: stats [PLUGIN] - shows the plugins which took the most time to
+        handle events and commands so far. If PLUGIN is specified, the figures
+        for each of its hooks and commands are shown instead.
+        """
+        metrics = self.bot.metrics
+        if len(params) < 1:
+            totals = sorted((item for item in metrics.plugin_totals().items()
+                if item[1][0] > 0), key=lambda item: item[1][2], reverse=True)
+            if len(totals) < 1:
+                return 'No plugin has been called yet.'
+            return 'Time spent per plugin: ' + ', '.join(
+                    '%s %.1f ms (%d calls, %d errors)' % (plugin,
+                        total * 1000, count, errors)
+                    for plugin, (count, errors, total) in totals[:5])
+        series = sorted((series for series in metrics.series.values()
+            if series.plugin == params[0] and series.count > 0),
+            key=lambda series: series.total, reverse=True)
+        if len(series) < 1:
+            return 'Plugin %s has not been called yet.' % params[0]
+        return '; '.join(_describe(each) for each in series)
+
+    @command
+    @require_master
+    def cachestats(self, server, channel, nick, params):
+        """
+        Usage: cachestats [PLUGIN] - shows the hit rates and sizes of the
+        caches of the plugins' storages, or of PLUGIN's storages only.
+        """
+        caches = sorted((key, info) for key, info in
+                self.bot.storage_cache_info().items()
+                if len(params) < 1 or key[0] == params[0])
+        if len(caches) < 1:
+            return 'No storages are open.'
+        return '; '.join('%s/%s: %d%% hits, %d of %s cached, %d evicted' % (
+            plugin, identifier, info.hits * 100 // (info.hits + info.misses)
+            if info.hits + info.misses else 0, info.currsize,
+            info.maxsize if info.maxsize else 'all', info.evictions)
+            for (plugin, identifier), info in caches)
+
+    @command
+    @require_master
+    def queuestats(self, server, channel, nick, params):
+        """
+        Usage: queuestats - shows how many lines wait in each lane of the send
+        queue, how many were sent and dropped, and how long they waited.
+        """
+        stats = self.bot.send_queue_stats()
+        if len(stats) < 1:
+            return 'There is no send queue.'
+        return '; '.join('%s: %d waiting, %d sent, %d dropped, %.1f ms \
+average wait, %.1f ms max' % (lane, stats[lane]['depth'], stats[lane]['sent'],
+            stats[lane]['dropped'], stats[lane]['average_wait'] * 1000,
+            stats[lane]['max_wait'] * 1000) for lane in LANE_NAMES)
+
+
+def _describe(series):
+    """Summarizes the figures of a hook or command in a few words."""
+    p99 = series.quantile(0.99)
+    name = series.name
+    if series.kind == 'checkpoint':
+        name = 'checkpoint ' + name
+    return '%s: %d calls, %d errors, %.2f ms average, 99%% %s' % (
+            name, series.count, series.errors,
+            series.total / series.count * 1000,
+            'within %g ms' % (p99 * 1000) if p99 else 'beyond 5 s')
@@ -3,14 +3,35 @@ import datetime
 import hashlib
 import random
 import string
+from time import monotonic
 from p1tr.plugin import *
 from p1tr.helpers import *
 from p1tr.logwrap import *
 
-def User(rank, registered_at, authenticated_at, password_hash):
-    """Generates a user data structure."""
+"""Ranks which can be assigned to users, from the least to the most powerful."""
+RANKS = ('none', 'voice', 'half-op', 'op', 'owner', 'master')
+
+"""
+Level of each rank; a user has a rank if their level is at least as high.
+Users registered by older versions have the rank ''.
+"""
+RANK_LEVELS = dict((rank, level) for level, rank in enumerate(RANKS))
+RANK_LEVELS[''] = RANK_LEVELS['none']
+RANK_LEVELS['hop'] = RANK_LEVELS['half-op']
+
+"""
+An authenticated user's level, and the time their authentication expires at
+(in terms of time.monotonic), or None.
+"""
+Session = namedtuple('Session', ['level', 'expires_at'])
+
+def User(rank, registered_at, password_hash):
+    """
+    Generates a user data structure. Records written by older versions also
+    contain an authenticated_at entry, which is ignored.
+    """
     return {'rank': rank, 'registered_at': registered_at,
-            'authenticated_at': authenticated_at, 'password_hash': None }
+            'password_hash': password_hash}
 
 def hash_password(username, password):
     """
@@ -41,6 +62,10 @@ class Authdefault(AuthorizationProvider):
     gain the rank "authenticated". If the user has been assigned a higher rank
     by the master, this rank is in effect then. Note that all ranks are
     server-wide.
+
+    Authentications are not persistent. They end when the user changes their
+    nick, leaves a channel, is kicked, or after authdefault.session_ttl
+    seconds (General section, default: 86400; 0 disables this).
     """
 
     def load_settings(self, config):
@@ -50,23 +75,42 @@ class Authdefault(AuthorizationProvider):
         they are active that they should change the password via query.
         If there was a previous master, remove their privileges.
         """
+        self.session_ttl = read_or_default(config, 'General',
+                'authdefault.session_ttl', 86400, float)
         user = config.get(self.bot.client.host, 'master')
         # Replace old master
         if ':master' in self.users and user != self.users[':master']:
             self.users[self.users[':master']]['rank'] = 'none'
+            self._sessions.pop(self.users[':master'], None)
         if not user in self.users:
-            self.users[user] = User('master', datetime.datetime.now(), None,
+            self.users[user] = User('master', datetime.datetime.now(),
                     hash_password(user, user))
+        elif self.users[user]['rank'] != 'master':
+            self.users[user]['rank'] = 'master'
         if not ':master' in self.users or self.users[':master'] != user:
             self.users[':master'] = user
             self.users[':new_master'] = True
 
     def initialize(self):
+        # Only registered users are stored. Records which were read are
+        # checked for changes on sync, so they are only read when needed.
         self.users = self.load_storage('user_data')
-        # De-authenticate all users
-        for user in self.users:
-            if user[0] != ':':
-                self.users[user]['authenticated_at'] = None
+        self._sessions = {} # Session by nick of authenticated users
+
+    def _authenticate(self, user):
+        """Starts a session with the rank user has."""
+        self._sessions[user] = Session(
+                RANK_LEVELS.get(self.users[user]['rank'], 0),
+                monotonic() + self.session_ttl if self.session_ttl else None)
+
+    def _session(self, user):
+        """Returns the session of user, or None if they are not authenticated."""
+        session = self._sessions.get(user)
+        if session and session.expires_at is not None and \
+                monotonic() >= session.expires_at:
+            del self._sessions[user]
+            return None
+        return session
 
     @command
     @require_master
@@ -75,16 +119,17 @@ class Authdefault(AuthorizationProvider):
         Usage: assign_rank NICK none|voice|half-op|op|owner - assigns the rank
         to the specified user.
         """
-        if len(params) < 2 or \
-                not params[1] in ('none', 'voice', 'half-op', 'op', 'owner'):
+        if len(params) < 2 or not params[1] in RANKS[:-1]:
             return clean_string(self.assign_rank.__doc__)
         user = params[0]
         if not user in self.users:
-            return '%s is not registered.'
+            return '%s is not registered.' % user
         else:
             info('The rank of %s was changed to %s.' % (user, params[1]),
                     plugin='authdefault')
-            self.users[user].rank = params[1]
+            self.users[user]['rank'] = params[1]
+            if self._session(user):
+                self._authenticate(user)
             return 'The rank of %s was changed to %s.' % (user, params[1])
 
     @command
@@ -100,13 +145,13 @@ class Authdefault(AuthorizationProvider):
         password = ' '.join(params)
         if not user in self.users:
             return '%s: You are not registered yet.' % user
-        if self.users[user]['authenticated_at']:
+        if self._session(user):
             return '%s: You are already authenticated.' % user
         if hash_password(user, password) == self.users[user]['password_hash']:
             # Password correct
             info('Successful authentication attempt by %s.' % user,
                     plugin='authdefault')
-            self.users[user]['authenticated_at'] = datetime.datetime.now()
+            self._authenticate(user)
             return '%s: You are now authenticated.' % user
         else:
             # Password incorrect
@@ -123,10 +168,10 @@ class Authdefault(AuthorizationProvider):
         user = nick.split('!')[0]
         if not user in self.users:
             return '%s: You are not registered yet.' % user
-        if not self.users[user]['authenticated_at']:
+        if not self._session(user):
             return '%s: You are not authenticated.' % user
         info('%s was de-authenticated manually.' % user, plugin='authdefault')
-        self.users[user]['authenticated_at'] = None
+        del self._sessions[user]
         return '%s: You are no longer authenticated.' % user
 
     @command
@@ -142,8 +187,9 @@ class Authdefault(AuthorizationProvider):
         if user in self.users:
             return '%s: You are already registered.' % user
         info('%s registered.' % user, plugin='authdefault')
-        self.users[user] = User('', datetime.datetime.now(),
-                datetime.datetime.now(), hash_password(user, password))
+        self.users[user] = User('none', datetime.datetime.now(),
+                hash_password(user, password))
+        self._authenticate(user)
         return '%s: You are registered and authenticated now!' % user
 
     @command
@@ -159,7 +205,7 @@ class Authdefault(AuthorizationProvider):
         # necessary.
         user = nick.split('!')[0]
         password = ' '.join(params)
-        info('%s changed their password.', plugin='authdefault')
+        info('%s changed their password.' % user, plugin='authdefault')
         self.users[user]['password_hash'] = hash_password(user, password)
         # If this was the master changing their password for the first time,
         # clear the master first time flag.
@@ -182,7 +228,7 @@ class Authdefault(AuthorizationProvider):
             return '%s is no registered yet.' % user
         new_password = generate_password()
         self.users[user]['password_hash'] = hash_password(user, new_password)
-        self.bot.client.send('PRIVMSG', 'user', ':Your password has been reset \
+        self.bot.client.send('PRIVMSG', user, ':Your password has been reset \
 to: %s' % new_password)
         return 'The password of %s was reset successfully.' % user
 
@@ -192,44 +238,46 @@ to: %s' % new_password)
     # Also notify the new master to change their password, if necessary
     #############################
 
-    def _request_pwd_change(self, nick):
+    def _request_pwd_change(self, user):
         """
         If a new master is in the house, and they haven't changed their password
         yet, remind them on join, rename, and when they are talking.
         Also, authenticate the user so they can change their password.
         """
-        user = nick.split('!')[0]
         if ':new_master' in self.users and user == self.users[':master']:
-            self.users[user]['authenticated_at'] = datetime.datetime.now()
+            self._authenticate(user)
             self.bot.client.send('PRIVMSG', user, ':Please change your \
 password as soon as possible using the change_password command!')
 
-    def on_userjoin(self, server, channel, nick):
+    @event_hook
+    def on_userjoin(self, event):
         """Check for new master, and request password change if applicable."""
-        self._request_pwd_change(nick)
+        self._request_pwd_change(event.nick)
 
-    def _try_deauthenticate(self, nick):
-        """De-authenticates a user, if they exist."""
-        user = nick.split('!')[0]
-        if user in self.users:
-            self.users[user]['authenticated_at'] = None
+    def _try_deauthenticate(self, user):
+        """De-authenticates a user, if they are authenticated."""
+        self._sessions.pop(user, None)
 
-    def on_userpart(self, server, channel, nick, message):
+    @event_hook
+    def on_userpart(self, event):
         """De-authenticate user."""
-        self._try_deauthenticate(nick)
+        self._try_deauthenticate(event.nick)
 
-    def on_userrenamed(self, server, oldnick, newnick):
+    @event_hook
+    def on_userrenamed(self, event):
         """De-authenticate user."""
-        self._request_pwd_change(newnick)
-        self._try_deauthenticate(oldnick)
+        self._request_pwd_change(event.message)
+        self._try_deauthenticate(event.nick)
 
-    def on_userkicked(self, server, channel, nick, reason):
+    @event_hook
+    def on_userkicked(self, event):
         """De-authenticate user."""
-        self._try_deauthenticate(nick)
+        self._try_deauthenticate(event.nick)
 
-    def on_privmsg(self, server, channel, nick, message):
+    @event_hook
+    def on_privmsg(self, event):
         """Check for new master, and request password change if applicable."""
-        self._request_pwd_change(nick)
+        self._request_pwd_change(event.nick)
 
 
     #############################
@@ -239,32 +287,16 @@ password as soon as possible using the change_password command!')
     def _has_rank(self, nick, rank):
         """
         Determines if nick has a given rank. Defaults to false if nick is not
-        registered.
+        authenticated.
         """
-        user = nick.split('!')[0]
-        if user in self.users and self.users[user]['authenticated_at']:
-            actual_rank = self.users[user]['rank']
-            if rank == 'none':
-                return True
-            if rank == 'voice' and actual_rank in ('voice', 'half-op', 'op',
-                    'owner', 'master'):
-                return True
-            if rank == 'half-op' and actual_rank in ('half-op', 'op', 'owner',
-                    'master'):
-                return True
-            if rank == 'op' and actual_rank in ('op', 'owner', 'master'):
-                return True
-            if rank == 'owner' and actual_rank in ('owner', 'master'):
-                return True
-            if rank == 'master' and actual_rank == 'master':
-                return True
-            return False
-        return False
+        session = self._session(nick.split('!')[0])
+        return session is not None and session.level >= RANK_LEVELS[rank]
 
     def _return_failure(self, nick, channel):
         """Sends nick a message indicating that they are not authorized."""
         self.bot.client.send('PRIVMSG', channel,
-                ':%s: You are not authorized to to that.' % nick.split('!')[0])
+                ':%s: You are not authorized to to that.' % nick.split('!')[0],
+                priority=PRIORITY_HIGH)
 
     def authorize_master(self, server, channel, nick, message, plugin, cmd):
         if self._has_rank(nick, 'master'):
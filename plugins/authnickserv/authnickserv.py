@@ -1,7 +1,21 @@
+from collections import namedtuple
+from time import monotonic
+from p1tr.channels import irc_lower
 from p1tr.helpers import *
 from p1tr.plugin import *
 from oyoyo.helpers import ns, cs
 
+"""
+A privileged command waiting for information from services. next_queue is
+the queue the command is moved to once the user's identity is confirmed, if
+any. The command is dropped at deadline (in terms of time.monotonic).
+"""
+QueuedCommand = namedtuple('QueuedCommand', ['next_queue', 'plugin',
+    'command', 'server', 'channel', 'nick', 'message', 'deadline'])
+
+"""Channel prefix required by the rank queues."""
+RANK_PREFIXES = {'voice': '+', 'half-op': '%', 'op': '@'}
+
 @meta_plugin
 class Authnickserv(AuthorizationProvider):
     """
@@ -17,45 +31,174 @@ class Authnickserv(AuthorizationProvider):
     This authorization mechanism was developed for and tested on the freenode
     network. It may or may not work on other networks with the services NickServ
     and ChanServ.
+
+    Confirmed NickServ identities are remembered for authnickserv.acc_ttl
+    seconds (General section, default: 300; 0 disables this), so that further
+    privileged commands of the same user run without asking NickServ again.
+    A user's identity is forgotten as soon as they change their nick, leave a
+    channel, are kicked, or quit. Since the bot only notices this for users
+    sharing a channel with it, remembered identities are only used while the
+    user does, and all are forgotten when the bot leaves a channel or
+    reconnects.
+
+    Channel ranks are looked up in the bot's channel tracker. Only if the
+    member list of the channel is not known, the server is asked for it.
+    Likewise, if the server reports the services accounts of the channel
+    members (IRCv3 extended-join, account-notify or account-tag), users logged
+    in to the account of their nick are authenticated without asking NickServ.
+
+    Commands waiting for an answer from services are dropped after
+    authnickserv.request_timeout seconds (default: 30), and each user may have
+    at most authnickserv.max_queued commands waiting (default: 5).
     """
 
     """
-    Each rank contains a dictionary with the nick as key, which has a list as
-    value with a (next_queue, plugin, command, server, channel, nick, message)
-    tuple as elements. If the notice listener detects a response from services
-    concerning the nick, commands may be executed, depending on the response.
-    If next_queue is set to another command queue, the tuple is forwarded to
-    this queue for further processing.
-
-    There is no queue for the master rank, since this can be checked instantly.
-
-    If an authorization attempt fails, the tuple is moved to the next higher
-    queue to check if the user has a rank higher than the required minimum to
-    execute the command.
+    Each rank contains a dictionary with the nick as key, which has a list of
+    QueuedCommand tuples as value. If the notice listener detects a response
+    from services concerning the nick, commands may be executed, depending on
+    the response. If next_queue is set to another command queue, the command
+    is forwarded to this queue for further processing.
+
+    If an authorization attempt fails, the command is moved to the master
+    queue to check if the user is the bot master, who may execute everything.
+
+    Empty lists are removed, so the queues only hold users with pending
+    commands.
     """
-    _command_queues = {
-            'authenticated': {},
-            'voice': {},
-            'half-op': {},
-            'op': {},
-            'owner': {},
-            'master': {}
-            }
+    def initialize(self):
+        self._command_queues = {
+                'authenticated': {},
+                'voice': {},
+                'half-op': {},
+                'op': {},
+                'owner': {},
+                'master': {}
+                }
+        # Time of the last positive ACC response, by user
+        self._identified = {}
+        # Deadlines of the requests sent to services or the server, by
+        # ('ACC', user), ('NAMES', channel) or ('FLAGS', channel, user). As
+        # long as a request is pending, it is not sent again.
+        self._requests = {}
+        self._sweep_timer = None
+
+    def load_settings(self, config):
+        self.acc_ttl = read_or_default(config, 'General',
+                'authnickserv.acc_ttl', 300, float)
+        self.request_timeout = read_or_default(config, 'General',
+                'authnickserv.request_timeout', 30, float)
+        self.max_queued = read_or_default(config, 'General',
+                'authnickserv.max_queued', 5, int)
+
+    def on_quit(self):
+        if self._sweep_timer:
+            self._sweep_timer.cancel()
+            self._sweep_timer = None
+
+    def _queued_count(self, user):
+        return sum(len(queue.get(user, ()))
+                for queue in self._command_queues.values())
 
     def _enqueue(self, queue_name, next_queue, plugin, command, server, channel,
-            nick, message):
-        """Adds a command to the appropriate queue for later processing."""
+            nick, message, deadline=None):
+        """
+        Adds a command to the appropriate queue for later processing. Returns
+        False, and denies the command, if the user has too many commands
+        waiting already.
+        """
         user = nick.split('!')[0]
-        if not user in self._command_queues[queue_name]:
-            self._command_queues[queue_name][user] = []
-        self._command_queues[queue_name][user].append(
-                (next_queue, plugin, command, server, channel, nick,
-                    ' '.join(message)))
+        if deadline is None:
+            if self._queued_count(user) >= self.max_queued:
+                self._respond_denial(server, channel, nick,
+                        'You have too many commands waiting for services.')
+                return False
+            deadline = monotonic() + self.request_timeout
+        self._command_queues[queue_name].setdefault(user, []).append(
+                QueuedCommand(next_queue, plugin, command, server, channel,
+                    nick, message, deadline))
+        self._schedule_sweep()
+        return True
+
+    def _request(self, key, send, *args):
+        """
+        Calls send with the given arguments, unless the request identified by
+        key is already pending. The request stops being pending when it is
+        answered, see _answered, or after the request timeout.
+        """
+        now = monotonic()
+        if self._requests.get(key, 0) > now:
+            return
+        self._requests[key] = now + self.request_timeout
+        send(*args)
+        self._schedule_sweep()
+
+    def _answered(self, key):
+        self._requests.pop(key, None)
+
+    def _schedule_sweep(self):
+        if not self._sweep_timer:
+            self._sweep_timer = self.bot.client.call_later(
+                    self.request_timeout, self._sweep)
+
+    def _sweep(self):
+        """
+        Drops queued commands and pending requests which are past their
+        deadline. Runs as long as there is anything left to wait for.
+        """
+        self._sweep_timer = None
+        now = monotonic()
+        for queue in self._command_queues.values():
+            for user in list(queue):
+                for command in queue[user]:
+                    if command.deadline <= now:
+                        self._respond_denial(command.server, command.channel,
+                                command.nick, 'Services did not respond in \
+time. Please try again later.')
+                queue[user] = [command for command in queue[user]
+                        if command.deadline > now]
+                if not queue[user]:
+                    del queue[user]
+        for key, deadline in list(self._requests.items()):
+            if deadline <= now:
+                del self._requests[key]
+        if self._requests or any(self._command_queues.values()):
+            self._schedule_sweep()
+
+    def _check_identity(self, user):
+        """
+        Processes the authenticated queue of user right away if their identity
+        was confirmed recently, or their account is known. Asks NickServ
+        otherwise.
+        """
+        confirmed_at = self._identified.get(user)
+        if confirmed_at is not None and \
+                monotonic() - confirmed_at < self.acc_ttl and \
+                self.bot.channels.channels_of(user):
+            self._process_acc(user, True)
+            return
+        self._identified.pop(user, None)
+        account = self.bot.channels.account(user)
+        casemapping = self.bot.channels.casemapping
+        if account == '': # Known not to be logged in
+            self._process_acc(user, False)
+        elif account and irc_lower(account, casemapping) == \
+                irc_lower(user, casemapping):
+            self._process_acc(user, True)
+        else: # Unknown, or another account, which the nick may be grouped to
+            self._request(('ACC', user), ns, self.bot.client, 'ACC', user)
 
-    def _respond_denial(self, server, channel, nick):
+    def _forget_identity(self, nick):
+        self._identified.pop(nick, None)
+
+    def _respond_denial(self, server, channel, nick,
+            reason='You are not authorized to execute this command.'):
         """Sends reponse to unauthorized users."""
         self.bot.client.send('PRIVMSG', channel, ':' + nick.split('!')[0] +
-                ': You are not authorized to execute this command.')
+                ': ' + reason, priority=PRIORITY_HIGH)
+
+    def _execute(self, command):
+        self.execute(command.server, command.channel, command.nick,
+                command.message, command.plugin, command.command)
 
     def authorize_master(self, server, channel, nick, message, plugin, cmd):
         """
@@ -66,9 +209,9 @@ class Authnickserv(AuthorizationProvider):
             self.master = self.bot.master
         user = nick.split('!')[0]
         if user == self.master:
-            self._enqueue('authenticated', None, plugin, cmd, server, channel,
-                    nick, message)
-            ns(self.bot.client, 'ACC', user)
+            if self._enqueue('authenticated', None, plugin, cmd, server,
+                    channel, nick, message):
+                self._check_identity(user)
         else:
             self._respond_denial(server, channel, nick)
 
@@ -87,9 +230,9 @@ class Authnickserv(AuthorizationProvider):
         only works if the bot is identified, because ChanServ (at least on
         FreeNode) entrusts that info only to identified users.
         """
-        self._enqueue('authenticated', 'op', plugin, cmd, server, channel, nick,
-                message)
-        ns(self.bot.client, 'ACC', nick.split('!')[0])
+        if self._enqueue('authenticated', 'op', plugin, cmd, server, channel,
+                nick, message):
+            self._check_identity(nick.split('!')[0])
 
     def authorize_hop(self, server, channel, nick, message, plugin, cmd):
         """
@@ -98,9 +241,9 @@ class Authnickserv(AuthorizationProvider):
         latter only works if the bot is identified, because ChanServ (at least
         on FreeNode) entrusts that info only to identified users.
         """
-        self._enqueue('authenticated', 'half-op', plugin, cmd, server, channel,
-                nick, message)
-        ns(self.bot.client, 'ACC', nick.split('!')[0])
+        if self._enqueue('authenticated', 'half-op', plugin, cmd, server,
+                channel, nick, message):
+            self._check_identity(nick.split('!')[0])
 
     def authorize_voice(self, server, channel, nick, message, plugin, cmd):
         """
@@ -109,96 +252,129 @@ class Authnickserv(AuthorizationProvider):
         only works if the bot is identified, because ChanServ (at least on
         FreeNode) entrusts that info only to identified users.
         """
-        self._enqueue('authenticated', 'voice', plugin, cmd, server, channel,
-                nick, message)
-        ns(self.bot.client, 'ACC', nick.split('!')[0])
+        if self._enqueue('authenticated', 'voice', plugin, cmd, server,
+                channel, nick, message):
+            self._check_identity(nick.split('!')[0])
 
     def authorize_authenticated(self, server, channel, nick, message, plugin,
             cmd):
         """Nick must be authenticated with NickServ."""
-        self._enqueue('authenticated', None, plugin, cmd, server, channel, nick,
-                message)
-        ns(self.bot.client, 'ACC', nick.split('!')[0])
+        if self._enqueue('authenticated', None, plugin, cmd, server, channel,
+                nick, message):
+            self._check_identity(nick.split('!')[0])
 
     def on_notice(self, server, channel, nick, message):
         if nick.startswith('NickServ!NickServ@services'):
             parts = message.split()
+            if len(parts) < 3 or not parts[1] == 'ACC':
+                return # Response not of interest
             user = parts[0]
-            if not parts[1] == 'ACC': return # Response not of interest
-            if not parts[2] == '3':
-                # User is not authenticated. Privileged commands not available.
-                for command in self._command_queues['authenticated'][user]:
-                    self._respond_denial(command[3], command[4], command[5])
-                self._command_queues['authenticated'][user] = [] # queues clear
-                # Do the same for master commands, if any:
-                for command in self._command_queues['master'][user]:
-                    self._respond_denial(command[3], command[4], command[5])
-                self._command_queues['master'][user] = []
-                return
-            # Un-justified master commands have been purged. The rest can be
-            # executed now.
-            for command in self._command_queues['master'][user]:
-                self.execute(command[3], command[4], command[5],
-                        command[6].split(), command[1], command[2])
-            self._command_queues['master'][user] = []
-            # By now, it is confirmed that the user is authenticated.
-            # If there is a next queue defined, transfer the command. Otherwise,
-            # execute it.
-            for command in self._command_queues['authenticated'][user]:
-                if not command[0]: # No next queue
-                    self.execute(command[3], command[4], command[5],
-                            command[6].split(), command[1], command[2])
-                else:
-                    # Depending on the type of queue, certain information
-                    # needs to be requested from the services. Launch request
-                    # upon enqueueing.
-                    self._enqueue(command[0], None, command[1], command[2],
-                            command[3], command[4], command[5], command[6])
-                    print(command)
-                    if command[0] in ('voice', 'half-op', 'op'):
-                        self.bot.client.send('NAMES', command[4])
-                    elif command[0] == 'owner':
-                        cs(self.bot.client, 'FLAGS', channel, user)
-            # Clear queue after executing/passing on commands.
-            self._command_queues['authenticated'][user] = []
+            self._answered(('ACC', user))
+            if parts[2] == '3' and self.acc_ttl > 0:
+                self._identified[user] = monotonic()
+            self._process_acc(user, parts[2] == '3')
             return
         if nick.startswith('ChanServ!ChanServ@services'):
             pass
 
+    def _process_acc(self, user, authenticated):
+        """Handles the queued commands of user once their status is known."""
+        if not authenticated:
+            # User is not authenticated. Privileged commands not available.
+            for command in self._command_queues['authenticated'].pop(user, []):
+                self._respond_denial(command.server, command.channel,
+                        command.nick)
+            # Do the same for master commands, if any:
+            for command in self._command_queues['master'].pop(user, []):
+                self._respond_denial(command.server, command.channel,
+                        command.nick)
+            return
+        # Commands which failed their rank check may still be executed by the
+        # master.
+        if not self.master:
+            self.master = self.bot.master
+        for command in self._command_queues['master'].pop(user, []):
+            if user == self.master:
+                self._execute(command)
+            else:
+                self._respond_denial(command.server, command.channel,
+                        command.nick)
+        # By now, it is confirmed that the user is authenticated.
+        # If there is a next queue defined, transfer the command. Otherwise,
+        # execute it.
+        for command in self._command_queues['authenticated'].pop(user, []):
+            if not command.next_queue:
+                self._execute(command)
+                continue
+            prefix = RANK_PREFIXES.get(command.next_queue)
+            if prefix and self.bot.channels.is_synced(command.channel):
+                if user == self.master or self.bot.channels.has_prefix(
+                        command.channel, user, prefix):
+                    self._execute(command)
+                else:
+                    self._respond_denial(command.server, command.channel,
+                            command.nick)
+                continue
+            # Depending on the type of queue, certain information needs to be
+            # requested from the server or services. All commands waiting for
+            # the same information share one request.
+            self._enqueue(command.next_queue, None, command.plugin,
+                    command.command, command.server, command.channel,
+                    command.nick, command.message, command.deadline)
+            if prefix:
+                self._request(('NAMES', command.channel), self.bot.client.send,
+                        'NAMES', command.channel)
+            elif command.next_queue == 'owner':
+                self._request(('FLAGS', command.channel, user), cs,
+                        self.bot.client, 'FLAGS', command.channel, user)
+
+    @event_hook
+    def on_userrenamed(self, event):
+        self._forget_identity(event.nick)
+
+    @event_hook
+    def on_userquit(self, event):
+        self._forget_identity(event.nick)
+
+    @event_hook
+    def on_userpart(self, event):
+        self._forget_identity(event.nick)
+
+    @event_hook
+    def on_userkicked(self, event):
+        self._forget_identity(event.nick)
+
+    def on_part(self, server, channel):
+        self._identified = {}
+
+    def on_kicked(self, server, channel, reason):
+        self._identified = {}
+
+    def on_connect(self, server):
+        self._identified = {}
+
     def on_names(self, server, channel, names):
-        for name in names:
-            if names[name] in ('+', '%', '@') and \
-                    name in self._command_queues['voice']: # Has at least voice
-                for command in self._command_queues['voice'][name]:
-                    self.execute(command[3], command[4], command[5],
-                            command[6].split(), command[1], command[2])
-                self._command_queues['voice'][name] = []
-            if names[name] in ('%', '@') and \
-                    name in self._command_queues['half-op']: # Has at least Half-OP
-                for command in self._command_queues['half-op'][name]:
-                    self.execute(command[3], command[4], command[5],
-                            command[6].split(), command[1], command[2])
-                self._command_queues['half-op'][name] = []
-            if names[name] == '@' and \
-                    name in self._command_queues['op']: # Has OP
-                for command in self._command_queues['op'][name]:
-                    self.execute(command[3], command[4], command[5],
-                            command[6].split(), command[1], command[2])
-                self._command_queues['op'][name] = []
-            # Move the remaining commands to the owner queue
-            if not name in self._command_queues['master']:
-                self._command_queues['master'][name] = []
-            if name in self._command_queues['voice']:
-                self._command_queues['master'][name] += \
-                        self._command_queues['voice'][name]
-                self._command_queues['voice'][name] = []
-            if name in self._command_queues['half-op']:
-                self._command_queues['master'][name] += \
-                        self._command_queues['half-op'][name]
-                self._command_queues['half-op'][name] = []
-            if name in self._command_queues['op']:
-                self._command_queues['master'][name] += \
-                        self._command_queues['op'][name]
-                self._command_queues['op'][name] = []
-            if len(self._command_queues['master'][name]) > 0:
-                ns(self.bot.client, 'ACC', name)
+        self._answered(('NAMES', channel))
+        ranks = ('+', '%', '@')
+        for queue_name, required in RANK_PREFIXES.items():
+            minimum = ranks.index(required)
+            queue = self._command_queues[queue_name]
+            for user in [user for user in queue
+                    if any(command.channel == channel
+                        for command in queue[user])]:
+                prefix = names.get(user, '')
+                granted = prefix in ranks and ranks.index(prefix) >= minimum
+                waiting = []
+                for command in queue.pop(user):
+                    if command.channel != channel:
+                        waiting.append(command)
+                    elif granted:
+                        self._execute(command)
+                    else:
+                        # Move the command to the master queue
+                        self._command_queues['master'].setdefault(user,
+                                []).append(command)
+                if waiting:
+                    queue[user] = waiting
+                if user in self._command_queues['master']:
+                    self._check_identity(user)
@@ -0,0 +1,185 @@
+from time import monotonic
+from p1tr.channels import ChannelTracker
+from p1tr.test import *
+
+NICKSERV = 'NickServ!NickServ@services.'
+
+class _Timer:
+    def cancel(self):
+        pass
+
+
+class _Client:
+    """Records the lines sent instead of sending them."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, *args, **kwargs):
+        self.sent.append(' '.join(args))
+
+    def call_later(self, delay, callback, *args):
+        return _Timer()
+
+
+class _Bot:
+    def __init__(self):
+        self.client = _Client()
+        self.channels = ChannelTracker()
+        self.dispatch = {}
+        self.master = 'Ford'
+
+
+class _Answer:
+    """A plugin with a single command."""
+
+    def answer(self, server, channel, nick, params):
+        return '42'
+
+
+class AuthnickservTest(PluginTestCase):
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.plugin.bot = _Bot()
+        self.plugin.bot.channels.joined('#p1tr', 'P1tr', own=True)
+        self.plugin.bot.channels.joined('#p1tr', 'Ford')
+        self.sent = self.plugin.bot.client.sent
+        self.answer = _Answer()
+
+    def _command(self, nick='Ford'):
+        self.plugin.authorize_authenticated('irc.example.org', '#p1tr',
+                nick + '!ford@example.org', '+answer', self.answer, 'answer')
+
+    def _acc(self, nick='Ford', status=3):
+        self.plugin.on_notice('irc.example.org', 'P1tr', NICKSERV,
+                '%s ACC %d' % (nick, status))
+
+    @test
+    def acc_test(self):
+        """Commands are executed once NickServ confirms the identity."""
+        self._command()
+        self.assertEqual(self.sent, ['PRIVMSG NickServ :ACC Ford'])
+        self._acc()
+        self.assertEqual(self.sent[1:], ['PRIVMSG #p1tr :42'])
+        self._command('Arthur')
+        self._acc('Arthur', 0)
+        self.assertEqual(self.sent[3:], ['PRIVMSG #p1tr :Arthur: You are not \
+authorized to execute this command.'])
+
+    @test
+    def acc_cache_test(self):
+        """Confirmed identities are remembered until the TTL is over."""
+        self._command()
+        self._acc()
+        self._command()
+        self.assertEqual(self.sent, ['PRIVMSG NickServ :ACC Ford',
+            'PRIVMSG #p1tr :42', 'PRIVMSG #p1tr :42'])
+        self.plugin._identified['Ford'] = monotonic() - self.plugin.acc_ttl
+        self._command()
+        self.assertEqual(self.sent[3:], ['PRIVMSG NickServ :ACC Ford'])
+
+    @test
+    def query_only_test(self):
+        """Identities of users sharing no channel with the bot are not used."""
+        self.plugin.bot.channels.parted('#p1tr', 'Ford')
+        self._command()
+        self._acc()
+        self._command()
+        self.assertEqual(self.sent[2:], ['PRIVMSG NickServ :ACC Ford'])
+
+    @test
+    def reconnect_forgets_test(self):
+        """Identities are forgotten when the bot reconnects or leaves."""
+        for leave in (lambda: self.plugin.on_connect('irc.example.org'),
+                lambda: self.plugin.on_part('irc.example.org', '#other'),
+                lambda: self.plugin.on_kicked('irc.example.org', '#other',
+                    'Bye')):
+            self._command()
+            self._acc()
+            leave()
+        self._command()
+        self.assertEqual([line for line in self.sent
+            if line.startswith('PRIVMSG NickServ')],
+            ['PRIVMSG NickServ :ACC Ford'] * 4)
+
+    @test
+    def acc_cache_disabled_test(self):
+        """NickServ is asked every time if the TTL is 0."""
+        self.plugin.acc_ttl = 0
+        self._command()
+        self._acc()
+        self._command()
+        self.assertEqual(self.sent[2:], ['PRIVMSG NickServ :ACC Ford'])
+
+    @test
+    def rename_forgets_test(self):
+        """Identities are forgotten when the user changes their nick."""
+        self._command()
+        self._acc()
+        self.plugin.on_userrenamed('irc.example.org', 'Ford!ford@example.org',
+                'Ix')
+        self._command()
+        self.assertEqual(self.sent[2:], ['PRIVMSG NickServ :ACC Ford'])
+
+    @test
+    def quit_forgets_test(self):
+        """Identities are forgotten when the user quits."""
+        self._command()
+        self._acc()
+        self.plugin.on_userquit('irc.example.org', 'Ford!ford@example.org',
+                'So long')
+        self._command()
+        self.assertEqual(self.sent[2:], ['PRIVMSG NickServ :ACC Ford'])
+
+    @test
+    def part_kick_forgets_test(self):
+        """Identities are forgotten when the user leaves a channel."""
+        self._command()
+        self._acc()
+        self.plugin.on_userpart('irc.example.org', '#p1tr',
+                'Ford!ford@example.org', '')
+        self._command()
+        self._acc()
+        self.plugin.on_userkicked('irc.example.org', '#p1tr',
+                'Ford!ford@example.org', '')
+        self._command()
+        self.assertEqual([line for line in self.sent
+            if line.startswith('PRIVMSG NickServ')],
+            ['PRIVMSG NickServ :ACC Ford'] * 3)
+
+    @test
+    def account_test(self):
+        """Users logged in to the account of their nick are not looked up."""
+        channels = self.plugin.bot.channels
+        channels.joined('#p1tr', 'P1tr', own=True)
+        channels.joined('#p1tr', 'Ford', account='ford')
+        channels.joined('#p1tr', 'Arthur', account='*')
+        self._command()
+        self._command('Arthur')
+        self.assertEqual(self.sent, ['PRIVMSG #p1tr :42', 'PRIVMSG #p1tr :\
+Arthur: You are not authorized to execute this command.'])
+
+    @test
+    def queue_bound_test(self):
+        """Users may only have max_queued commands waiting."""
+        self.plugin.max_queued = 2
+        for attempt in range(3):
+            self._command()
+        self.assertEqual(self.sent, ['PRIVMSG NickServ :ACC Ford',
+            'PRIVMSG #p1tr :Ford: You have too many commands waiting for \
+services.'])
+        self._acc()
+        self.assertEqual(self.sent[2:], ['PRIVMSG #p1tr :42'] * 2)
+
+    @test
+    def timeout_test(self):
+        """Commands are dropped if services do not answer in time."""
+        self.plugin.request_timeout = 0
+        self._command()
+        self.plugin._sweep()
+        self.assertEqual(self.sent[1:], ['PRIVMSG #p1tr :Ford: Services did \
+not respond in time. Please try again later.'])
+        self.assertEqual(self.plugin._requests, {})
+        self._acc()
+        self.assertEqual(len(self.sent), 2)
@@ -18,29 +18,27 @@ class Help(Plugin):
         if len(params) < 1:
             return clean_string(self.help.__doc__)
         if len(params) < 2:
-            if params[0] in self.bot.plugins: # Plugin found
-                help_msg = clean_string(self.bot.plugins[params[0]].__doc__ or \
+            plugin = self.bot.get_plugin(params[0])
+            if plugin: # Plugin found
+                help_msg = clean_string(plugin.__doc__ or \
                         'Sorry, no help message available.')
                 commands = sorted(list(name \
                         for name, member \
-                        in inspect.getmembers(self.bot.plugins[params[0]])
+                        in inspect.getmembers(plugin)
                         if hasattr(member, '__annotations__') \
                                 and 'command' in member.__annotations__))
                 if len(commands) > 0:
                     help_msg += ' Commands: %s' % pretty_list(commands)
                 return clean_string(help_msg)
-            elif params[0] in self.bot.commands: # Command found
-                return clean_string(getattr(
-                    self.bot.commands[params[0]], params[0]).__doc__ or \
+            entry = self.bot.get_command(params[0])
+            if entry: # Command found
+                return clean_string(entry.method.__doc__ or \
                             'Sorry, no help message available.')
-            else:
-                return 'Plugin or command "%s" not found.' % params[0]
+            return 'Plugin or command "%s" not found.' % params[0]
         # Only Plugin->Command left now. Try to find it...
-        if params[1] in self.bot.commands and \
-                self.bot.commands[params[1]].__class__.__name__.lower() \
-                == params[0]:
-            return clean_string(getattr(
-                self.bot.plugins[params[0]], params[1]).__doc__ or \
+        entry = self.bot.get_command(params[1])
+        if entry and entry.plugin.__class__.__name__.lower() == params[0]:
+            return clean_string(entry.method.__doc__ or \
                         'Sorry, no help message available.')
         # If everything fails:
         return 'Command "%s" from plugin "%s" not found.' % (params[1],
@@ -49,7 +47,8 @@ class Help(Plugin):
     @command
     def list_commands(self, server, channel, nick, params):
         """Lists all available commands."""
-        return pretty_list(self.bot.commands.keys())
+        return pretty_list(list(self.bot.dispatch.keys()) +
+                list(self.bot.lazy_commands.keys()))
 
     @command
     def list_plugins(self, server, channel, nick, params):
@@ -57,4 +56,4 @@ class Help(Plugin):
         Lists all active plugins. Plugins on the global- or server-wide
         blacklist are not shown.
         """
-        return pretty_list(self.bot.plugins.keys())
+        return pretty_list(self.bot.manifest.keys())
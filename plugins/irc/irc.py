@@ -46,4 +46,5 @@ class Irc(Plugin):
         Usage: quit - Tell the bot to disconnect from the server.
         """
         self.bot.intended_disconnect = True
+        self.bot.client.send('QUIT')
         self.bot.exit()
@@ -170,10 +170,11 @@ class Karma(Plugin):
             self.karma[target][1] += 1
         self.karma[target][2] = datetime.datetime.now()
 
-    def on_privmsg(self, server, channel, nick, message):
+    @event_hook
+    def on_privmsg(self, event):
         """Listens for nick++ and nick--."""
-        user = nick.split('!')[0]
-        words = message.split()
+        user = event.nick
+        words = event.message.split()
         if len(words) < 1:
             return
         word = words[0]
@@ -24,10 +24,11 @@ class Logger(Plugin):
                     self._restricted_channels.append('#' +
                             section.split('|')[1])
 
-    def on_privmsg(self, server, channel, user, message):
-        if channel in self._restricted_channels: return
-        plain('<' + user.split('!')[0] + '> ' + message,
-                server=server, channel=channel)
+    @event_hook
+    def on_privmsg(self, event):
+        if event.channel in self._restricted_channels: return
+        plain('<' + event.nick + '> ' + event.message,
+                server=event.server, channel=event.channel)
 
     def on_motd(self, server, message):
         info(' * MOTD: %s' % message, server=server)
@@ -71,27 +72,31 @@ class Logger(Plugin):
         plain(' ** ' + nick + ' was kicked: ' + reason or 'no reason',
                 server=server, channel=channel)
 
-    def on_userrenamed(self, server, oldnick, newnick):
-        info(' ** %s is now known as %s.' % (oldnick.split('!')[0], newnick),
-                server=server)
-
-    def on_useraction(self, server, channel, nick, message):
-        if channel in self._restricted_channels: return
-        plain(' * ' + nick.split('!')[0] + ' ' + message, server=server,
-                channel=channel)
-
-    def on_userquit(self, server, nick, message):
-        if len(message) > 0:
-            message = ', saying: %s' % message
+    @event_hook
+    def on_userrenamed(self, event):
+        info(' ** %s is now known as %s.' % (event.nick, event.message),
+                server=event.server)
+
+    @event_hook
+    def on_useraction(self, event):
+        if event.channel in self._restricted_channels: return
+        plain(' * ' + event.nick + ' ' + event.message, server=event.server,
+                channel=event.channel)
+
+    @event_hook
+    def on_userquit(self, event):
+        if len(event.message) > 0:
+            message = ', saying: %s' % event.message
         else:
             message = '.'
-        info(' ** %s disconnected from the server%s' % (nick.split('!')[0],
-            message), server=server)
-
-    def on_notice(self, server, channel, nick, message):
-        if channel in self._restricted_channels: return
-        info(' * NOTICE from ' + nick.split('!')[0] + ': ' + message,
-                server=server)
+        info(' ** %s disconnected from the server%s' % (event.nick,
+            message), server=event.server)
+
+    @event_hook
+    def on_notice(self, event):
+        if event.channel in self._restricted_channels: return
+        info(' * NOTICE from ' + event.nick + ': ' + event.message,
+                server=event.server)
 
     def on_connect(self, server):
         info('Connected to the server.', server=server)
@@ -15,12 +15,13 @@ class Memo(Plugin):
         # {'recipient': [(sender, time, message, confidential_flag)]}
         self._mailbag = self.load_storage('mailbag')
 
-    def _try_deliver(self, nick, channel):
+    def _try_deliver(self, user, channel):
         """
         Sends waiting memos to the specified user. Respects the confidentiality
         flag.
         """
-        user = nick.split('!')[0]
+        # This runs on every message, and the storage remembers keys which are
+        # not stored, so delivered memos are removed along with their key.
         if user in self._mailbag:
             for memo in self._mailbag[user]:
                 message = '%s: %s left a memo for you %s ago: %s' % \
@@ -28,10 +29,12 @@ class Memo(Plugin):
                             humanize_time(datetime.datetime.now() - memo[1]),
                             memo[2])
                 if memo[3]: # Is confidential
-                    self.bot.client.send('PRIVMSG', user, ':' + message)
+                    self.bot.client.send('PRIVMSG', user, ':' + message,
+                            priority=PRIORITY_LOW)
                 else:
-                    self.bot.client.send('PRIVMSG', channel, ':' + message)
-                self._mailbag[user].remove(memo)
+                    self.bot.client.send('PRIVMSG', channel, ':' + message,
+                            priority=PRIORITY_LOW)
+            del self._mailbag[user]
 
     def _add_message(self, recipient, sender, message, is_confidential):
         """Adds a memo for recipient to the mailbag."""
@@ -76,11 +79,14 @@ class Memo(Plugin):
         return '%d memos are waiting for delivery.' % memo_count
 
     # Listeners to detect user activity:
-    def on_privmsg(self, server, channel, nick, message):
-        self._try_deliver(nick, channel)
+    @event_hook
+    def on_privmsg(self, event):
+        self._try_deliver(event.nick, event.channel)
 
-    def on_userjoin(self, server, channel, nick):
-        self._try_deliver(nick, channel)
+    @event_hook
+    def on_userjoin(self, event):
+        self._try_deliver(event.nick, event.channel)
 
-    def on_useraction(self, server, channel, nick, message):
-        self._try_deliver(nick, channel)
+    @event_hook
+    def on_useraction(self, event):
+        self._try_deliver(event.nick, event.channel)
@@ -1,7 +1,101 @@
+from bisect import bisect_left
 import datetime
-from p1tr.helpers import clean_string, humanize_time
+import re
+import struct
+from time import time
+from p1tr.channels import irc_lower
+from p1tr.helpers import clean_string, humanize_time, pretty_list
 from p1tr.plugin import *
+from p1tr.logwrap import *
 
+"""Codes of the activities a user can be seen doing."""
+SAYING, ACTION, JOINING, LEAVING, KICKED, RENAMING, OTHER = range(7)
+
+"""
+Descriptions of the activities, without and with a payload. The nick is
+available as %(nick)s, and the payload as %(payload)s.
+"""
+ACTIVITIES = {
+        SAYING: ('saying ""', 'saying "%(payload)s"'),
+        ACTION: ('saying "* %(nick)s"', 'saying "* %(nick)s %(payload)s"'),
+        JOINING: ('joining the channel', 'joining the channel'),
+        LEAVING: ('leaving the channel',
+            'leaving the channel, saying "%(payload)s"'),
+        KICKED: ('getting kicked', 'getting kicked because: %(payload)s'),
+        RENAMING: ('changing his nick', 'changing his nick to %(payload)s'),
+        OTHER: ('', '%(payload)s')
+        }
+
+"""Messages longer than this are truncated before being remembered."""
+PAYLOAD_LENGTH = 120
+
+"""Version of the storage format; see Seen.initialize."""
+FORMAT = 3
+
+"""
+Header of a record: timestamp in seconds since the epoch, channel id,
+activity code and length of the nick. The UTF-8 encoded nick and payload
+follow.
+"""
+RECORD = struct.Struct('>IHBB')
+
+"""Matches of a wildcard query beyond which none are shown."""
+MAX_MATCHES = 50
+
+"""
+Channel id of records whose channel is unknown, or which was seen after all
+other ids were taken.
+"""
+NO_CHANNEL = 0xffff
+
+
+def _truncate(payload):
+    if len(payload) > PAYLOAD_LENGTH:
+        return payload[:PAYLOAD_LENGTH - 3] + '...'
+    return payload
+
+
+def _unpack(record):
+    """
+    Returns the timestamp, channel id, code, nick and payload of a record.
+    """
+    timestamp, channel_id, code, length = RECORD.unpack_from(record)
+    end = RECORD.size + length
+    return (timestamp, channel_id, code, record[RECORD.size:end].decode(
+        'utf-8', 'replace'), record[end:].decode('utf-8'))
+
+
+def _glob(pattern):
+    """
+    Returns the literal prefix of a pattern with the wildcards * and ?, and a
+    compiled regular expression matching the whole pattern.
+    """
+    prefix = re.split(r'[*?]', pattern, 1)[0]
+    return prefix, re.compile(''.join('.*' if char == '*' else '.'
+        if char == '?' else re.escape(char) for char in pattern) + r'\Z',
+        re.DOTALL)
+
+
+def _parse_activity(activity, nick):
+    """
+    Returns the activity code and payload of an activity description of the
+    first storage format, which held the whole description.
+    """
+    for code, prefix in ((LEAVING, 'leaving the channel, saying "'),
+            (ACTION, 'saying "* %s ' % nick), (SAYING, 'saying "')):
+        if activity.startswith(prefix) and activity.endswith('"'):
+            return code, activity[len(prefix):-1]
+    for code, prefix in ((KICKED, 'getting kicked because: '),
+            (RENAMING, 'changing his nick to ')):
+        if activity.startswith(prefix):
+            return code, activity[len(prefix):]
+    for code in (JOINING, LEAVING, KICKED):
+        if activity == ACTIVITIES[code][0]:
+            return code, ''
+    return OTHER, activity
+
+
+@meta_plugin
 class Seen(Plugin):
     """
     Tracks all user's most recent time of activity.
@@ -9,53 +103,194 @@ class Seen(Plugin):
 
     def initialize(self):
         Plugin.__init__(self)
-        # Storage format: key = username,
-        # value = (timestamp, channel, lastActivity)
-        self.memory = self.load_storage('memory')
+        # Storage format: key = nick in lower case according to the server's
+        # case mapping, which is kept in self.channels['casemapping'], value =
+        # record as bytes; see RECORD. The channel id indexes the list of
+        # channel names in self.channels['names']. The packed records take
+        # about a third of the memory of the (datetime, channel, activity)
+        # tuples stored before.
+        self.memory = self.load_storage('nicks')
+        self.channels = self.load_storage('channels')
+        if not 'names' in self.channels:
+            self.channels['names'] = []
+        self._casemapping = self.channels.get('casemapping', 'rfc1459')
+        self._channel_ids = dict((name, channel_id) for channel_id, name in
+                enumerate(self.channels['names']))
+        if self.channels.get('format', 1) < FORMAT:
+            # The first format was stored by nick, in the memory storage.
+            if self.has_storage('memory'):
+                self._migrate(self.load_storage('memory'))
+                self.close_storage('memory')
+            else:
+                self.channels['format'] = FORMAT
+        # All keys, sorted, for prefix and wildcard queries.
+        self._index = sorted(self.memory)
+
+    def _migrate(self, old):
+        """
+        Converts the entries of the old storage, which are (datetime, channel,
+        activity description) tuples by nick, into records of the nicks
+        storage, and removes them from the old storage. The old storage is
+        only emptied once all entries are converted, so an interrupted
+        migration is started over. Entries of nicks differing only in case are
+        merged, keeping the most recent one.
+        """
+        for nick in list(old):
+            timestamp, channel, activity = old[nick]
+            timestamp = timestamp.timestamp()
+            code, payload = _parse_activity(activity, nick)
+            key = irc_lower(nick, self._casemapping)
+            if key in self.memory and \
+                    _unpack(self.memory[key])[0] > int(round(timestamp)):
+                continue
+            self.memory[key] = self._record(timestamp, channel, code, nick,
+                    payload)
+        self.channels['format'] = FORMAT
+        self.save_storage('nicks')
+        self.save_storage('channels')
+        for nick in list(old):
+            del old[nick]
+        if len(self.memory):
+            info('Converted %d entries to the current format.' %
+                    len(self.memory), plugin='seen')
+
+    def _lower(self, nick):
+        """
+        Returns the key of a nick, according to the case mapping of the server.
+        If the server uses another case mapping than the keys, which happens
+        after a migration or on changing networks, the keys are converted
+        first.
+        """
+        casemapping = self.bot.channels.casemapping
+        if casemapping != self._casemapping:
+            self._convert_keys(casemapping)
+        return irc_lower(nick, casemapping)
+
+    def _convert_keys(self, casemapping):
+        """
+        Lowers the nicks of all records according to another case mapping.
+        Records whose keys become equal are merged, keeping the most recent
+        one.
+        """
+        records = {}
+        for key in list(self.memory):
+            record = self.memory[key]
+            new_key = irc_lower(_unpack(record)[3], casemapping)
+            if not new_key in records or RECORD.unpack_from(
+                    records[new_key])[0] < RECORD.unpack_from(record)[0]:
+                records[new_key] = record
+            del self.memory[key]
+        for key, record in records.items():
+            self.memory[key] = record
+        self._index = sorted(records)
+        self._casemapping = self.channels['casemapping'] = casemapping
+        info('Converted the keys to the %s case mapping.' % casemapping,
+                plugin='seen')
+
+    def _channel_id(self, channel):
+        if channel in (None, 'some channel'): # Unknown; see on_userrenamed
+            return NO_CHANNEL
+        channel_id = self._channel_ids.get(channel)
+        if channel_id is None:
+            if len(self._channel_ids) >= NO_CHANNEL: # No ids left
+                return NO_CHANNEL
+            channel_id = len(self._channel_ids)
+            self.channels['names'].append(channel)
+            self._channel_ids[channel] = channel_id
+        return channel_id
+
+    def _matches(self, pattern):
+        """
+        Returns the keys matching a pattern with the wildcards * and ?, up to
+        one more than MAX_MATCHES. Only the keys starting with the literal
+        prefix of the pattern are looked at.
+        """
+        prefix, regex = _glob(self._lower(pattern))
+        matches = []
+        for key in self._index[bisect_left(self._index, prefix):]:
+            if not key.startswith(prefix):
+                break
+            if regex.match(key):
+                matches.append(key)
+                if len(matches) > MAX_MATCHES:
+                    break
+        return matches
+
+    def _describe(self, record):
+        timestamp, channel_id, code, nick, payload = _unpack(record)
+        return '%s was last seen %s ago in %s, %s.' % (nick,
+                humanize_time(datetime.timedelta(seconds=max(0,
+                    time() - timestamp))),
+                'some channel' if channel_id == NO_CHANNEL else
+                    self.channels['names'][channel_id],
+                ACTIVITIES[code][1 if payload else 0] % {'nick': nick,
+                    'payload': payload})
 
     @command
     def seen(self, server, channel, nick, params):
         """
         Usage: seen NICK - Shows how long ago the given nick was seen for the
-        last time, and what they were doing then.
+        last time, and what they were doing then. Case does not matter. NICK
+        may contain the wildcards * and ?, e.g. "seen ford*", in which case
+        the nick seen most recently is shown, along with other matches.
         """
         if len(params) < 1:
             return clean_string(self.seen.__doc__)
         subject = params[0]
-        if not subject in self.memory:
-            return 'I have not seen %s before.' % subject
-        entry = self.memory[subject]
-        return '%s was last seen %s ago in %s, %s.' % (subject,
-                humanize_time(datetime.datetime.now() - entry[0]),
-                entry[1], entry[2])
-
-    def _remember(self, channel, nick, activity):
+        if not '*' in subject and not '?' in subject:
+            key = self._lower(subject)
+            if not key in self.memory:
+                return 'I have not seen %s before.' % subject
+            return self._describe(self.memory[key])
+        matches = self._matches(subject)
+        if len(matches) < 1:
+            return 'I have not seen anyone matching %s.' % subject
+        if len(matches) > MAX_MATCHES:
+            return 'More than %d nicks match %s. Please be more specific.' % (
+                    MAX_MATCHES, subject)
+        records = sorted((self.memory[key] for key in matches),
+                key=lambda record: RECORD.unpack_from(record)[0],
+                reverse=True)
+        if len(records) == 1:
+            return self._describe(records[0])
+        return '%s Also matching: %s.' % (self._describe(records[0]),
+                pretty_list([_unpack(record)[3] for record in records[1:6]]) +
+                (' and %d more' % (len(records) - 6) if len(records) > 6
+                    else ''))
+
+    def _record(self, timestamp, channel, code, nick, payload):
+        nick = nick.encode('utf-8')[:255]
+        return RECORD.pack(int(round(timestamp)), self._channel_id(channel),
+                code, len(nick)) + nick + _truncate(payload).encode('utf-8')
+
+    def _remember(self, channel, nick, code, payload=''):
         """Helper for saving user activities to memory."""
-        self.memory[nick.split('!')[0]] = (datetime.datetime.now(), channel,
-                activity)
-
-    def on_privmsg(self, server, channel, nick, message):
-        self._remember(channel, nick, 'saying "%s"' % message)
-
-    def on_useraction(self, server, channel, nick, message):
-        self._remember(channel, nick,
-                'saying "* %s %s"' % (nick.split('!')[0], message))
-
-    def on_userjoin(self, server, channel, nick):
-        self._remember(channel, nick, 'joining the channel')
-
-    def on_userpart(self, server, channel, nick, message):
-        activity = 'leaving the channel'
-        if len(message) > 0:
-            activity += ', saying "%s"' % message
-        self._remember(channel, nick, activity)
-
-    def on_userkicked(self, server, channel, nick, reason):
-        activity = 'getting kicked'
-        if len(reason) > 0:
-            activity += ' because: %s' % reason
-        self._remember(channel, nick, activity)
-
-    def on_userrenamed(self, server, oldnick, newnick):
-        self._remember('some channel', oldnick, 'changing his nick to %s' %
-                newnick)
+        key = self._lower(nick)
+        self.memory[key] = self._record(time(), channel, code, nick, payload)
+        position = bisect_left(self._index, key)
+        if position == len(self._index) or self._index[position] != key:
+            self._index.insert(position, key)
+
+    @event_hook
+    def on_privmsg(self, event):
+        self._remember(event.channel, event.nick, SAYING, event.message)
+
+    @event_hook
+    def on_useraction(self, event):
+        self._remember(event.channel, event.nick, ACTION, event.message)
+
+    @event_hook
+    def on_userjoin(self, event):
+        self._remember(event.channel, event.nick, JOINING)
+
+    @event_hook
+    def on_userpart(self, event):
+        self._remember(event.channel, event.nick, LEAVING, event.message)
+
+    @event_hook
+    def on_userkicked(self, event):
+        self._remember(event.channel, event.nick, KICKED, event.message)
+
+    @event_hook
+    def on_userrenamed(self, event):
+        self._remember(None, event.nick, RENAMING, event.message)
@@ -1,8 +1,20 @@
+import datetime
+from p1tr.channels import ChannelTracker
 from p1tr.test import *
 from p1tr.helpers import *
+from plugins.seen.seen import NO_CHANNEL, PAYLOAD_LENGTH
+
+class _Bot:
+    def __init__(self):
+        self.channels = ChannelTracker()
+
 
 class SeenTest(PluginTestCase):
 
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.plugin.bot = _Bot()
+
     @test
     def seen_invalid_test(self):
         """Test wrong use of the command."""
@@ -97,3 +109,99 @@ he acted silly.' % (data.nick.split('!')[0], data.channel))
                     self.dummy_data[1].nick, data.nick.split('!')[0]),
                 '%s was last seen 0 seconds ago in some channel, changing his \
 nick to Arthur.' % (data.nick.split('!')[0]))
+
+    @test
+    def seen_action_test(self):
+        """Test for a target that has been seen in an action."""
+        data = self.dummy_data[0]
+        self.plugin.on_useraction(data.server, data.channel, data.nick,
+                'waves')
+        self.assertEqual(self.plugin.seen(data.server, data.channel,
+                    self.dummy_data[1].nick, data.nick.split('!')[0]),
+                '%s was last seen 0 seconds ago in %s, saying "* %s waves".' %
+                (data.nick.split('!')[0], data.channel,
+                    data.nick.split('!')[0]))
+
+    @test
+    def seen_truncated_test(self):
+        """Long messages are truncated."""
+        data = self.dummy_data[0]
+        self.plugin.on_privmsg(data.server, data.channel, data.nick, 'x' * 500)
+        self.assertEqual(self.plugin.seen(data.server, data.channel,
+                    self.dummy_data[1].nick, data.nick.split('!')[0]),
+                '%s was last seen 0 seconds ago in %s, saying "%s...".' % (
+                    data.nick.split('!')[0], data.channel,
+                    'x' * (PAYLOAD_LENGTH - 3)))
+
+    @test
+    def seen_migration_test(self):
+        """Entries of the first storage format are converted."""
+        self.plugin._migrate({
+            'Ford': (datetime.datetime.now(), '#p1tr',
+                'saying "* Ford waves"'),
+            'Zaphod': (datetime.datetime.now(), 'some channel',
+                'changing his nick to Zaphod_')})
+        self.assertEqual(self.plugin.seen(None, None, None, ['Ford']),
+                'Ford was last seen 0 seconds ago in #p1tr, saying "* Ford \
+waves".')
+        self.assertEqual(self.plugin.seen(None, None, None, ['Zaphod']),
+                'Zaphod was last seen 0 seconds ago in some channel, \
+changing his nick to Zaphod_.')
+
+    @test
+    def seen_case_test(self):
+        """Nicks are looked up regardless of their case."""
+        data = self.dummy_data[1]
+        self.plugin.on_userjoin(data.server, data.channel, 'Slarti[Bart]')
+        self.assertEqual(self.plugin.seen(data.server, data.channel,
+                    data.nick, ['sLARTI{bart}']),
+                'Slarti[Bart] was last seen 0 seconds ago in %s, joining the \
+channel.' % data.channel)
+
+    @test
+    def seen_casemapping_test(self):
+        """Keys are converted when the server uses another case mapping."""
+        data = self.dummy_data[1]
+        self.plugin.on_userjoin(data.server, data.channel, 'Slarti[Bart]')
+        self.plugin.bot.channels.set_isupport(['CASEMAPPING=ascii'])
+        self.assertEqual(self.plugin.seen(data.server, data.channel,
+                    data.nick, ['slarti{bart}']),
+                'I have not seen slarti{bart} before.')
+        self.assertEqual(self.plugin.seen(data.server, data.channel,
+                    data.nick, ['sLARTI[bart]']),
+                'Slarti[Bart] was last seen 0 seconds ago in %s, joining the \
+channel.' % data.channel)
+        self.assertEqual(self.plugin.channels['casemapping'], 'ascii')
+        self.plugin.on_userjoin(data.server, data.channel, 'Slarti{Bart}')
+        self.assertEqual(self.plugin._matches('slarti?bart?'),
+                ['slarti[bart]', 'slarti{bart}'])
+
+    @test
+    def seen_wildcard_test(self):
+        """Nicks can be looked up with wildcards."""
+        data = self.dummy_data[1]
+        self.plugin.on_userjoin(data.server, data.channel, 'Trillian')
+        self.plugin.on_userjoin(data.server, data.channel, 'Tricia')
+        self.assertEqual(self.plugin.seen(data.server, data.channel,
+                    data.nick, ['trill*']),
+                'Trillian was last seen 0 seconds ago in %s, joining the \
+channel.' % data.channel)
+        self.assertTrue(self.plugin.seen(data.server, data.channel,
+                    data.nick, ['tri*i*']).endswith('Also matching: Tricia.')
+                or self.plugin.seen(data.server, data.channel, data.nick,
+                    ['tri*i*']).endswith('Also matching: Trillian.'))
+        self.assertEqual(self.plugin.seen(data.server, data.channel,
+                    data.nick, ['*zaphod?']),
+                'I have not seen anyone matching *zaphod?.')
+
+    @test
+    def seen_channel_ids_test(self):
+        """Channels seen after all ids were taken are unknown."""
+        names = self.plugin.channels['names']
+        for channel_id in range(len(names), NO_CHANNEL):
+            self.plugin._channel_ids['#%d' % channel_id] = channel_id
+        self.plugin.on_userjoin(None, '#new', 'Marvin')
+        self.assertEqual(self.plugin.seen(None, None, None, ['Marvin']),
+                'Marvin was last seen 0 seconds ago in some channel, joining \
+the channel.')
+        self.assertFalse('#new' in self.plugin._channel_ids)
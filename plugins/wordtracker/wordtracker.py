@@ -1,13 +1,33 @@
+import heapq
 from p1tr.plugin import *
 from p1tr.helpers import *
 
 class Wordtracker(Plugin):
-    """Tracks how often a certain word is mentioned, and provides stats."""
+    """
+    Tracks how often a certain word is mentioned, and provides stats.
+
+    Words are only tracked on request, so there are few of them; the
+    trackstats command looks at the totals of all of them on each call,
+    which is meant for tens of tracked words, not thousands.
+    """
 
     def initialize(self):
-        Plugin.__init__(self)
         # Structure: {word: {channel: {nick: count}}}
         self.tracklist = self.load_storage('tracklist')
+        # Running totals, so that the stats commands need not walk the
+        # tracklist: mentions by word, and by channel and by nick for each
+        # word, i.e. {word: {channel: count}} and {word: {nick: count}}.
+        self._word_totals = {}
+        self._channel_totals = {}
+        self._nick_totals = {}
+        for word in self.tracklist:
+            channel_totals = self._channel_totals[word] = {}
+            nick_totals = self._nick_totals[word] = {}
+            for channel, counts in self.tracklist[word].items():
+                channel_totals[channel] = sum(counts.values())
+                for nick, count in counts.items():
+                    nick_totals[nick] = nick_totals.get(nick, 0) + count
+            self._word_totals[word] = sum(channel_totals.values())
 
     @command
     def track(self, server, channel, nick, params):
@@ -21,6 +41,9 @@ class Wordtracker(Plugin):
             return 'Already tracking "%s".' % params[0]
         # Add to tracklist
         self.tracklist[params[0]] = {}
+        self._word_totals[params[0]] = 0
+        self._channel_totals[params[0]] = {}
+        self._nick_totals[params[0]] = {}
         return '"%s" is now being tracked.' % params[0]
 
     @command
@@ -36,12 +59,15 @@ class Wordtracker(Plugin):
             return '"%s" is not tracked.' % params[0]
         # Remove from tracklist
         del self.tracklist[params[0]]
+        del self._word_totals[params[0]]
+        del self._channel_totals[params[0]]
+        del self._nick_totals[params[0]]
         return '"%s" has been untracked.' % params[0]
 
     @command
     def tracked_words(self, server, channel, nick, params):
         """Lists all words tracked by the bot."""
-        words = self.tracklist.keys()
+        words = sorted(self._word_totals)
         if len(words) < 1:
             return 'No words are being tracked.'
         return pretty_list(words)
@@ -56,62 +82,48 @@ class Wordtracker(Plugin):
         if len(params) < 1: # Show usage if no word is supplied
             return clean_string(self.wordstats.__doc__)
         word = params[0]
-        if not word in self.tracklist: # Unknown word
+        if not word in self._word_totals: # Unknown word
             return '"%s" is not tracked.' % word
         # Show normal stats, or specialized stats if enough parameters supplied.
         if len(params) < 2: # Normal stats
-            mention_count = 0
-            for channel in self.tracklist[word]:
-                for user in self.tracklist[word][channel]:
-                    mention_count += self.tracklist[word][channel][user]
-            return '"%s" has been mentioned %d times.' % (word, mention_count)
+            return '"%s" has been mentioned %d times.' % (word,
+                    self._word_totals[word])
         # Specialized stats:
         if params[1].startswith('#'): # Show channel stats
-            mention_count = 0
-            for user in self.tracklist[word][params[1]]:
-                mention_count += self.tracklist[word][params[1]][user]
             return '"%s" has been mentioned %d times in %s.' % (word,
-                    mention_count, params[1])
+                    self._channel_totals[word].get(params[1], 0), params[1])
         else: # Show user stats
-            mention_count = 0
-            for channel in self.tracklist[word]:
-                mention_count += self.tracklist[word][channel][params[1]]
             return '%s has mentioned "%s" %d times.' % (params[1], word,
-                    mention_count)
+                    self._nick_totals[word].get(params[1], 0))
 
     @command
     def trackstats(self, server, channel, nick, params):
         """
         Provides some factoids about the tracked words on a server-wide scope.
         """
-        word_mentions = {}
-        # Get absolute number of mentions
-        for word in self.tracklist:
-            word_mentions[word] = 0
-            for channel in self.tracklist[word]:
-                for nick in self.tracklist[word][channel]:
-                    word_mentions[word] += self.tracklist[word][channel][nick]
-        words = list(self.tracklist.keys())
-        # Sort by mentions in ascending order
-        words = sorted(words, key=lambda item: word_mentions[item])
-        words.reverse()
-        print(str(words))
-        top_words = words[:3]
+        word_mentions = self._word_totals
+        if len(word_mentions) < 1:
+            return 'No words are being tracked.'
+        # Only the three most popular words are needed, not a sorted list.
+        top_words = heapq.nlargest(3, word_mentions, key=word_mentions.get)
+        least_popular = min(word_mentions, key=word_mentions.get)
         message = 'The most popular words are: '
         message += pretty_list(
                 ['%s (%d)' % (word, word_mentions[word])
                     for word in top_words])
-        message += '. The least popular word is %s (%d).' % (words[-1],
-                word_mentions[words[-1]])
+        message += '. The least popular word is %s (%d).' % (least_popular,
+                word_mentions[least_popular])
         return message
 
     def on_privmsg(self, server, channel, nick, message):
         # Increase stats whenever seeing the word:
         user = nick.split('!')[0]
         for word in message.split():
-            if word in self.tracklist:
-                if not channel in self.tracklist[word]:
-                    self.tracklist[word][channel] = {}
-                if not user in self.tracklist[word][channel]:
-                    self.tracklist[word][channel][user] = 0
-                self.tracklist[word][channel][user] += 1
+            if word in self._word_totals:
+                counts = self.tracklist[word].setdefault(channel, {})
+                counts[user] = counts.get(user, 0) + 1
+                self._word_totals[word] += 1
+                channel_totals = self._channel_totals[word]
+                channel_totals[channel] = channel_totals.get(channel, 0) + 1
+                nick_totals = self._nick_totals[word]
+                nick_totals[user] = nick_totals.get(user, 0) + 1
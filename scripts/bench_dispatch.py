@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the PRIVMSG hot path of BotHandler.
+
+Loads all plugins found in ./plugins (except the logger, whose file I/O would
+dominate the numbers) against a throwaway bot home and feeds a mix of plain
+chatter and commands through BotHandler.privmsg. Run it from the repository
+root, once on the revision before a change and once after, to get comparable
+numbers:
+
+    $ python3 scripts/bench_dispatch.py [ITERATIONS]
+"""
+
+import configparser
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+sys.path.insert(0, os.getcwd())
+
+from p1tr.logwrap import set_loglevel, set_logdir, CRITICAL
+from p1tr.p1tr import BotHandler
+
+
+class FakeClient:
+    """Stands in for oyoyo's IRCClient; records instead of sending."""
+
+    def __init__(self, host, port, nick):
+        self.host = host
+        self.port = port
+        self.nick = nick
+        self.sent = 0
+        self.caps = set()
+        self.command_handler = BotHandler(self)
+
+    def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+def make_bot(home):
+    config = configparser.ConfigParser()
+    config['General'] = {'home': home, 'plugin_blacklist': 'logger',
+            'signal_character': '+'}
+    config['bench.local'] = {'host': 'bench.local', 'port': '6667',
+            'nick': 'P1tr', 'master': 'master'}
+    client = FakeClient('bench.local', 6667, 'P1tr')
+    client.command_handler.load_config(config)
+    client.command_handler.load_plugins()
+    return client
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    home = tempfile.mkdtemp(prefix='p1tr-bench-')
+    set_logdir(home)
+    set_loglevel(CRITICAL)
+    try:
+        client = make_bot(home)
+        bot = client.command_handler
+        lines = [
+            (b'someone!user@host', b'#p1tr', b'just some chatter in here'),
+            (b'someone!user@host', b'#p1tr', b'+hello'),
+            (b'someone!user@host', b'#p1tr', b'+list_plugins'),
+            (b'someone!user@host', b'#p1tr', b'+unknown command'),
+            (b'someone!user@host', b'P1tr', b'hello'),
+        ]
+        def run():
+            for line in lines:
+                bot.privmsg(*line)
+        seconds = timeit.timeit(run, number=iterations)
+        messages = iterations * len(lines)
+        print('%d messages in %.3fs: %.2f us/message, %d messages/s' % (
+            messages, seconds, seconds / messages * 1e6, messages / seconds))
+        bot.exit()
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
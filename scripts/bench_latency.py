@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Measures the command round-trip latency of a real P1tr process.
+
+Starts the stand-in IRC server from p1tr.ircd, launches the bot from this
+working copy against it as a separate process, and then sends commands to
+the bot one at a time from a test user, timing how long it takes for each
+reply to arrive. Run it from the repository root:
+
+    $ python3 scripts/bench_latency.py [COMMANDS]
+"""
+
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.getcwd())
+
+from p1tr.ircd import StandInServer
+
+CHANNEL = '#bench'
+BOT_NICK = 'P1tr'
+
+CONFIG = """[General]
+home = %(home)s
+loglevel = ERROR
+plugin_blacklist = logger
+signal_character = +
+flood_rate = 0
+
+[127.0.0.1]
+nick = %(nick)s
+master = nobody
+port = %(port)d
+
+[127.0.0.1|%(channel)s]
+"""
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class TestUser(asyncio.Protocol):
+    """Client side of the test user; collects the bot's channel messages."""
+
+    def __init__(self):
+        self.replies = asyncio.Queue()
+        self._buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send('NICK bench')
+        self.send('USER bench localhost localhost :Benchmark')
+        self.send('JOIN ' + CHANNEL)
+
+    def send(self, line):
+        self.transport.write(line.encode('utf-8') + b'\r\n')
+
+    def data_received(self, data):
+        lines = (self._buffer + data).split(b'\r\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            if line.startswith(b':' + BOT_NICK.encode() + b'!') and \
+                    (' PRIVMSG %s :' % CHANNEL).encode() in line:
+                self.replies.put_nowait(time.perf_counter())
+
+
+async def bench(commands, home):
+    server = await StandInServer().start()
+    with open(os.path.join(home, 'config.cfg'), 'w') as config:
+        config.write(CONFIG % {'home': home, 'nick': BOT_NICK,
+            'port': server.port, 'channel': CHANNEL[1:]})
+    bot = subprocess.Popen([sys.executable, os.path.join('p1tr', 'p1tr.py'),
+        '-c', os.path.join(home, 'config.cfg')])
+    try:
+        loop = asyncio.get_event_loop()
+        _, user = await loop.create_connection(TestUser, '127.0.0.1',
+                server.port)
+        # Wait for the bot to show up in the channel.
+        started = time.time()
+        while not BOT_NICK in server.channels.get(CHANNEL, ()):
+            if time.time() - started > 30:
+                raise RuntimeError('The bot did not join %s.' % CHANNEL)
+            await asyncio.sleep(0.05)
+        latencies = []
+        for i in range(commands):
+            sent_at = time.perf_counter()
+            user.send('PRIVMSG %s :+hello' % CHANNEL)
+            received_at = await asyncio.wait_for(user.replies.get(), 10)
+            latencies.append((received_at - sent_at) * 1000)
+        print('%d commands: p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+            commands, percentile(latencies, 0.5),
+            percentile(latencies, 0.99), max(latencies)))
+    finally:
+        bot.terminate()
+        bot.wait()
+        server.stop()
+
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    home = tempfile.mkdtemp(prefix='p1tr-bench-')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(bench(commands, home))
+    finally:
+        loop.close()
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Drives a real P1tr process with synthetic channel traffic and measures how it
+copes.
+
+Starts the stand-in IRC server from p1tr.ircd and launches the bot from this
+working copy against it, joined to a number of channels. A number of test
+users, spread across these channels and identified with NickServ, then send
+chatter and +hello commands at the given total rate. The report shows the
+time the bot took from opening its connection to being identified and in
+all channels, the achieved rate, and the latency and throughput of the bot's
+replies. The load
+is generated from a fixed seed, so runs are comparable. Run it from the
+repository root:
+
+    $ python3 scripts/bench_load.py --channels 10 --users 50 --rate 200
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.getcwd())
+
+from p1tr.ircd import CAPS, StandInServer
+
+BOT_NICK = 'P1tr'
+
+CONFIG = """[General]
+home = %(home)s
+loglevel = ERROR
+plugin_blacklist = %(blacklist)s
+signal_character = +
+flood_rate = 0
+
+[127.0.0.1]
+nick = %(nick)s
+nick_password = secret
+master = nobody
+port = %(port)d
+"""
+
+CHANNEL_CONFIG = """
+[127.0.0.1|%(channel)s]
+logger.log = yes
+"""
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LoadUser(asyncio.Protocol):
+    """
+    Client side of a test user. If it observes a channel, it matches the
+    bot's replies there to the oldest pending command of that channel.
+    """
+
+    def __init__(self, nick, channels, stats):
+        self.nick = nick
+        self.channels = channels
+        self.observed = set()
+        self.stats = stats
+        self._buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send('NICK ' + self.nick)
+        self.send('USER %s localhost localhost :Load test' % self.nick)
+        self.send('PRIVMSG NickServ :IDENTIFY secret')
+        self.send('JOIN ' + ','.join(self.channels))
+
+    def send(self, line):
+        self.transport.write(line.encode('utf-8') + b'\r\n')
+
+    def data_received(self, data):
+        lines = (self._buffer + data).split(b'\r\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            if not line.startswith(b':' + BOT_NICK.encode() + b'!'):
+                continue
+            parts = line.decode('utf-8', 'replace').split(' ', 3)
+            if len(parts) == 4 and parts[1] == 'PRIVMSG' and \
+                    parts[2] in self.observed and \
+                    parts[3].startswith(':Hello, '):
+                self.stats.reply(parts[2])
+
+
+class LoadStats:
+    """Pending commands per channel and the latencies measured so far."""
+
+    def __init__(self):
+        self.pending = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.sent = 0
+        self.commands = 0
+        self.last_reply = None
+
+    def command(self, channel):
+        self.commands += 1
+        self.pending[channel].append(time.perf_counter())
+
+    def reply(self, channel):
+        if self.pending[channel]:
+            self.last_reply = time.perf_counter()
+            self.latencies.append((self.last_reply -
+                self.pending[channel].popleft()) * 1000)
+
+    def outstanding(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+
+async def wait_for(condition, timeout, message, interval=0.05):
+    started = time.time()
+    while not condition():
+        if time.time() - started > timeout:
+            raise RuntimeError(message)
+        await asyncio.sleep(interval)
+
+
+async def bench(args, home):
+    caps = [cap for cap in CAPS if cap != 'sasl' or args.sasl]
+    server = await StandInServer(caps=caps).start()
+    channels = ['#load%d' % i for i in range(args.channels)]
+    with open(os.path.join(home, 'config.cfg'), 'w') as config:
+        config.write(CONFIG % {'home': home, 'nick': BOT_NICK,
+            'port': server.port, 'blacklist': args.blacklist})
+        for channel in channels:
+            config.write(CHANNEL_CONFIG % {'channel': channel[1:]})
+    bot = subprocess.Popen([sys.executable, os.path.join('p1tr', 'p1tr.py'),
+        '-c', os.path.join(home, 'config.cfg')])
+    try:
+        loop = asyncio.get_event_loop()
+        stats = LoadStats()
+        users = []
+        for i in range(args.users):
+            # Every user joins one channel, and every other user a second one.
+            joined = [channels[i % len(channels)]]
+            if i % 2 and len(channels) > 1:
+                joined.append(channels[(i * 7 + 1) % len(channels)])
+            _, user = await loop.create_connection(
+                    lambda: LoadUser('user%d' % i, sorted(set(joined)), stats),
+                    '127.0.0.1', server.port)
+            users.append(user)
+        for channel in channels:
+            observer = next((user for user in users
+                if channel in user.channels), None)
+            if observer is None:
+                raise RuntimeError('There are fewer users than channels.')
+            observer.observed.add(channel)
+        await wait_for(lambda: BOT_NICK in server.identified and
+            all(BOT_NICK in server.channels.get(channel, ())
+                for channel in channels), 30,
+            'The bot did not identify and join all channels.', 0.001)
+        print('The bot was ready %.1f ms after connecting.' % ((
+            time.monotonic() - server.users[BOT_NICK].opened_at) * 1000))
+
+        rng = random.Random(args.seed)
+        interval = 1 / args.rate
+        started = time.perf_counter()
+        next_line = started
+        while next_line - started < args.duration:
+            now = time.perf_counter()
+            while next_line <= now:
+                user = rng.choice(users)
+                channel = rng.choice(user.channels)
+                if rng.random() < args.commands:
+                    user.send('PRIVMSG %s :+hello' % channel)
+                    stats.command(channel)
+                else:
+                    user.send('PRIVMSG %s :%s' % (channel, ' '.join(
+                        rng.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet',
+                            'P1tr', 'user%d' % rng.randrange(args.users)))
+                        for word in range(rng.randint(1, 12)))))
+                stats.sent += 1
+                next_line += interval
+            await asyncio.sleep(min(0.01, max(0, next_line -
+                time.perf_counter())))
+        sent_for = time.perf_counter() - started
+        try:
+            await wait_for(lambda: stats.outstanding() == 0, 10, '')
+        except RuntimeError:
+            pass
+        report(stats, sent_for, started)
+    finally:
+        bot.terminate()
+        bot.wait()
+        server.stop()
+
+
+def report(stats, sent_for, started):
+    print('Sent %d lines in %.1f s: %.0f lines/s, %d of them commands.' % (
+        stats.sent, sent_for, stats.sent / sent_for, stats.commands))
+    if not stats.latencies:
+        print('The bot did not reply.')
+        return
+    replied_for = stats.last_reply - started
+    print('%d replies (%d missing) in %.1f s: %.0f replies/s.' % (
+        len(stats.latencies), stats.outstanding(), replied_for,
+        len(stats.latencies) / replied_for))
+    print('Reply latency: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms'
+            % (percentile(stats.latencies, 0.5),
+                percentile(stats.latencies, 0.9),
+                percentile(stats.latencies, 0.99), max(stats.latencies)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a synthetic load test \
+against a local P1tr process.')
+    parser.add_argument('-c', '--channels', type=int, default=10,
+            help='Number of channels. Default: 10')
+    parser.add_argument('-u', '--users', type=int, default=50,
+            help='Number of users, at least one per channel. Default: 50')
+    parser.add_argument('-r', '--rate', type=float, default=100,
+            help='Lines sent per second by all users together. Default: 100')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+            help='Seconds to send for. Default: 10')
+    parser.add_argument('--commands', type=float, default=0.1,
+            help='Fraction of the lines which are commands. Default: 0.1')
+    parser.add_argument('--blacklist', default='',
+            help='Plugins not to load, separated by spaces.')
+    parser.add_argument('--no-sasl', dest='sasl', action='store_false',
+            help='Do not offer SASL, so the bot identifies with NickServ.')
+    parser.add_argument('--seed', type=int, default=1,
+            help='Seed of the generated load. Default: 1')
+    args = parser.parse_args()
+    home = tempfile.mkdtemp(prefix='p1tr-bench-')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(bench(args, home))
+    finally:
+        loop.close()
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
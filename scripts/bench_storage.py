@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Compares the storage backends of p1tr.storage on workloads shaped like those
+of the plugins with the largest storages:
+
+    seen         one packed (time, channel id, activity, message) record per
+                 nick, replaced on every message
+    karma        one [positive, negative, time] list per nick, modified in
+                 place
+    wordtracker  a few words with nested {channel: {nick: count}} counters,
+                 modified in place
+
+Each storage is filled with the given number of keys first, then reopened,
+and the events are applied to random keys, with a checkpoint after every
+--sync-every events, like the bot makes periodically. Reported are the times
+to open, to apply the events, to checkpoint (total and slowest) and to close
+the storage, and its size on disk. The checkpoint times are those the caller
+was blocked for; backends writing in the background report the time of
+their writes in the Writes column. Hits is the share of the reads served
+from the storage's cache of --cache-size values. Run it from the repository
+root:
+
+    $ python3 scripts/bench_storage.py --keys 20000 --events 100000
+"""
+
+import argparse
+import datetime
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.getcwd())
+
+from p1tr.storage import BACKENDS, MAX_CACHED, open_storage
+
+WORDS = 50
+
+"""Header of the records of the seen plugin."""
+SEEN_RECORD = struct.Struct('>IHB')
+
+
+def seen_fill(storage, keys):
+    now = int(time.time())
+    for i in range(keys):
+        storage['user%d' % i] = SEEN_RECORD.pack(now, i % 20, 0) + \
+                b'lorem ipsum dolor sit amet'
+
+def seen_event(storage, rng, keys):
+    storage['user%d' % rng.randrange(keys)] = SEEN_RECORD.pack(
+            int(time.time()), rng.randrange(20), 0) + b' '.join(
+                rng.choice((b'lorem', b'ipsum', b'dolor', b'sit', b'amet'))
+                for word in range(rng.randint(1, 12)))
+
+def karma_fill(storage, keys):
+    now = datetime.datetime.now()
+    for i in range(keys):
+        storage['user%d' % i] = [i % 7, i % 3, now]
+
+def karma_event(storage, rng, keys):
+    nick = 'user%d' % rng.randrange(keys)
+    if nick in storage:
+        storage[nick][rng.randrange(2)] += 1
+        storage[nick][2] = datetime.datetime.now()
+
+def wordtracker_fill(storage, keys):
+    # keys counters, spread across the tracked words.
+    for word in range(WORDS):
+        storage['word%d' % word] = dict(('#channel%d' % channel,
+            dict(('user%d' % nick, 1) for nick in range(
+                keys // WORDS // 20 + 1))) for channel in range(20))
+
+def wordtracker_event(storage, rng, keys):
+    counters = storage['word%d' % rng.randrange(WORDS)][
+            '#channel%d' % rng.randrange(20)]
+    nick = 'user%d' % rng.randrange(keys // WORDS // 20 + 1)
+    counters[nick] = counters.get(nick, 0) + 1
+
+WORKLOADS = {'seen': (seen_fill, seen_event),
+        'karma': (karma_fill, karma_event),
+        'wordtracker': (wordtracker_fill, wordtracker_event)}
+
+
+def disk_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory))
+
+
+def bench(backend, workload, args):
+    fill, event = WORKLOADS[workload]
+    directory = tempfile.mkdtemp(prefix='p1tr-storage-')
+    path = os.path.join(directory, workload)
+    try:
+        storage = open_storage(path, backend, args.cache_size)
+        fill(storage, args.keys)
+        storage.close()
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        storage = open_storage(path, backend, args.cache_size)
+        opened = time.perf_counter()
+        events = checkpoints = slowest = 0.0
+        writes = []
+        for i in range(args.events):
+            start = time.perf_counter()
+            event(storage, rng, args.keys)
+            events += time.perf_counter() - start
+            if (i + 1) % args.sync_every == 0:
+                start = time.perf_counter()
+                write = storage.checkpoint()
+                elapsed = time.perf_counter() - start
+                checkpoints += elapsed
+                slowest = max(slowest, elapsed)
+                if write:
+                    writes.append(write)
+        cache = storage.cache_info()
+        start = time.perf_counter()
+        storage.close()
+        closed = time.perf_counter() - start
+        print('%-12s %-8s %9.1f %10.1f %10.1f %9.1f %9.1f %9.1f %9.0f %5.0f%%'
+            % (workload, backend, (opened - started) * 1000, events * 1000,
+            checkpoints * 1000, slowest * 1000,
+            sum(write.result() for write in writes) * 1000, closed * 1000,
+            disk_size(directory) / 1024, cache.hits * 100 /
+            ((cache.hits + cache.misses) or 1)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the storage \
+backends on plugin-like workloads.')
+    parser.add_argument('-k', '--keys', type=int, default=20000,
+            help='Number of keys (nicks) stored. Default: 20000')
+    parser.add_argument('-e', '--events', type=int, default=100000,
+            help='Number of events applied. Default: 100000')
+    parser.add_argument('-s', '--sync-every', type=int, default=10000,
+            help='Events between two checkpoints. Default: 10000')
+    parser.add_argument('-c', '--cache-size', type=int, default=MAX_CACHED,
+            help='Number of values cached. Default: %d' % MAX_CACHED)
+    parser.add_argument('-b', '--backends', default=' '.join(sorted(BACKENDS)),
+            help='Backends to compare, separated by spaces. Default: all')
+    parser.add_argument('-w', '--workloads',
+            default=' '.join(sorted(WORKLOADS)),
+            help='Workloads to run, separated by spaces. Default: all')
+    parser.add_argument('--seed', type=int, default=1,
+            help='Seed of the generated events. Default: 1')
+    args = parser.parse_args()
+    print('%-12s %-8s %9s %10s %10s %9s %9s %9s %9s %6s' % ('Workload',
+        'Backend', 'Open (ms)', 'Events (ms)', 'Ckpts (ms)', 'Max ckpt',
+        'Writes', 'Close', 'Disk (KiB)', 'Hits'))
+    for workload in args.workloads.split():
+        for backend in args.backends.split():
+            bench(backend, workload, args)
+
+
+if __name__ == '__main__':
+    main()